@@ -0,0 +1,181 @@
+"""
+Memory benchmark for fetching the list of apps from Marathon in a sync.
+
+Compares the previous approach of buffering the whole ``/v2/apps`` response
+body, decoding it and parsing it with ``json.loads()`` before extracting the
+domains from the apps, with streaming the body through
+``JsonFieldStreamProtocol`` and extracting the domains from each app as it is
+parsed.
+
+Reports the peak memory traced by ``tracemalloc`` while each approach
+processes the body, which is delivered in 64KiB chunks as it would be by
+Twisted, and the time taken (measured separately without tracing). The body
+itself is created before tracing starts, as it arrives from the network
+either way.
+
+Also times bodies with a single very large app delivered in small chunks, as
+they may be from a slow connection, to check that the time taken to stream
+an app grows linearly with its size.
+
+Usage: python benchmarks/bench_apps_streaming.py
+"""
+import json
+import timeit
+import tracemalloc
+
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+from marathon_acme.json_stream import JsonFieldStreamProtocol
+from marathon_acme.label_extractor import LabelExtractor
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def make_body(count):
+    """
+    Create a ``/v2/apps`` response body with app definitions of a realistic
+    size: a few KiB each, mostly env vars, health checks and other fields
+    that marathon-acme doesn't need.
+    """
+    apps = []
+    for i in range(count):
+        apps.append({
+            'id': '/app-%d' % (i,),
+            'cmd': None,
+            'args': ['--port', '$PORT0'],
+            'cpus': 0.1,
+            'mem': 256.0,
+            'instances': 2,
+            'env': dict(
+                ('ENV_VAR_%d' % (j,), 'value-%d-%d' % (i, j) * 3)
+                for j in range(20)),
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'HAPROXY_0_VHOST': 'app-%d.example.com' % (i,),
+                'MARATHON_ACME_0_DOMAIN': 'app-%d.example.com' % (i,),
+            },
+            'container': {
+                'type': 'DOCKER',
+                'docker': {
+                    'image': 'example/app-%d:1.0.0' % (i,),
+                    'network': 'BRIDGE',
+                    'portMappings': [
+                        {'containerPort': 8000, 'hostPort': 0,
+                         'protocol': 'tcp'},
+                    ],
+                },
+            },
+            'healthChecks': [{
+                'path': '/health',
+                'protocol': 'HTTP',
+                'portIndex': 0,
+                'gracePeriodSeconds': 300,
+                'intervalSeconds': 60,
+                'timeoutSeconds': 20,
+                'maxConsecutiveFailures': 3,
+            }],
+            'constraints': [['hostname', 'UNIQUE']],
+            'portDefinitions': [
+                {'port': 10000 + i, 'protocol': 'tcp', 'labels': {}},
+            ],
+            'version': '2017-01-01T00:00:00.000Z',
+        })
+    return json.dumps({'apps': apps}).encode('utf-8')
+
+
+def make_large_app_body(size):
+    """
+    Create a ``/v2/apps`` response body with a single app definition of
+    roughly ``size`` bytes, mostly env vars.
+    """
+    app = {
+        'id': '/large-app',
+        'labels': {
+            'HAPROXY_GROUP': 'external',
+            'MARATHON_ACME_0_DOMAIN': 'large-app.example.com',
+        },
+        'portDefinitions': [{'port': 10000, 'protocol': 'tcp', 'labels': {}}],
+        'env': dict(
+            ('ENV_VAR_%d' % (i,), 'value "%d" {[]}' % (i,) * 3)
+            for i in range(size // 64)),
+    }
+    return json.dumps({'apps': [app]}).encode('utf-8')
+
+
+def chunks(body, chunk_size=CHUNK_SIZE):
+    for i in range(0, len(body), chunk_size):
+        yield body[i:i + chunk_size]
+
+
+def buffered(body, chunk_size=CHUNK_SIZE):
+    """ Buffer the whole body and parse it, as ``json_content`` did. """
+    data = b''.join(list(chunks(body, chunk_size)))
+    text = data.decode('utf-8')
+    apps = json.loads(text)['apps']
+    return LabelExtractor(['external']).extract_all(apps)
+
+
+def streamed(body, chunk_size=CHUNK_SIZE):
+    """ Parse the body as it is received and extract each app's domains. """
+    extractor = LabelExtractor(['external'])
+    apps_ports = {}
+
+    def extract(app):
+        apps_ports[app['id']] = extractor.extract(app)
+
+    protocol = JsonFieldStreamProtocol('apps', extract)
+    for chunk in chunks(body, chunk_size):
+        protocol.dataReceived(chunk)
+    protocol.connectionLost(Failure(ResponseDone()))
+    return apps_ports
+
+
+def peak_memory(func, body):
+    tracemalloc.start()
+    try:
+        func(body)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def main():
+    print('%-8s %10s %12s %12s %10s %10s' % (
+        'apps', 'body', 'buffered', 'streamed', 'buffered', 'streamed'))
+    for count in [1000, 10000, 50000]:
+        body = make_body(count)
+
+        # Check that both approaches agree
+        assert buffered(body) == streamed(body)
+
+        memory = [peak_memory(func, body) for func in [buffered, streamed]]
+        times = [min(timeit.repeat(lambda: func(body), number=1, repeat=3))
+                 for func in [buffered, streamed]]
+
+        print('%-8d %6.1f MiB %8.1f MiB %8.1f MiB %8.2f s %8.2f s' % (
+            (count, len(body) / 1024.0 / 1024) +
+            tuple(m / 1024.0 / 1024 for m in memory) + tuple(times)))
+
+    print()
+    print('%-8s %10s %10s %10s %10s' % (
+        'app', 'chunk', 'buffered', 'streamed', 'per MiB'))
+    for size in [512 * 1024, 2 * 1024 * 1024, 8 * 1024 * 1024]:
+        body = make_large_app_body(size)
+        for chunk_size in [1024, 4096]:
+            assert (buffered(body, chunk_size) ==
+                    streamed(body, chunk_size))
+
+            times = [min(timeit.repeat(lambda: func(body, chunk_size),
+                                       number=1, repeat=3))
+                     for func in [buffered, streamed]]
+
+            print('%4.1f MiB %6d B %8.3f s %8.3f s %8.3f s' % (
+                (len(body) / 1024.0 / 1024, chunk_size) + tuple(times) +
+                (times[1] / (len(body) / 1024.0 / 1024),)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark for extracting app domains from Marathon app labels during a sync.
+
+Compares ``LabelExtractor.extract_all()`` with the previous per-port
+implementation, which formatted and looked up the ``HAPROXY_{n}_GROUP`` and
+``MARATHON_ACME_{n}_DOMAIN`` labels for every port of every app, parsed every
+domain label and logged each app at debug level. The extractor's memo of
+parsed domain labels persists between syncs, so it is timed both on its first
+sync ("cold") and on later syncs of the same apps ("warm").
+
+Usage: python benchmarks/bench_label_extraction.py
+"""
+import timeit
+
+from twisted.logger import Logger
+
+from marathon_acme.label_extractor import LabelExtractor, parse_domain_label
+
+
+GROUPS = ['external']
+
+log = Logger()
+
+
+def app_ports_per_port(app, groups=GROUPS):
+    """
+    The previous implementation of ``MarathonAcme._app_ports()``, kept here
+    for comparison.
+    """
+    app_domains = {}
+    labels = app['labels']
+    app_group = labels.get('HAPROXY_GROUP')
+
+    if 'portDefinitions' in app:
+        ports = app['portDefinitions']
+    else:
+        ports = app['ports']
+
+    for port_index, _ in enumerate(ports):
+        port_group = labels.get(
+            'HAPROXY_%d_GROUP' % (port_index,), app_group)
+
+        if port_group in groups:
+            domain_label = labels.get(
+                'MARATHON_ACME_%d_DOMAIN' % (port_index,), '')
+            port_domains = parse_domain_label(domain_label)
+
+            if port_domains:
+                app_domains[port_index] = (port_group, port_domains)
+
+    log.debug(
+        'Found {len_domains} domains for app {app}: {domains}',
+        len_domains=len(app_domains), app=app['id'], domains=app_domains)
+
+    return app_domains
+
+
+def make_apps(count):
+    """
+    Create app definitions with a mix of the sorts of labels and ports that
+    apps have: most apps have a couple of ports and a handful of other
+    labels, and a third of them have marathon-acme domains.
+    """
+    apps = []
+    for i in range(count):
+        labels = {
+            'HAPROXY_GROUP': 'external' if i % 4 else 'internal',
+            'HAPROXY_0_VHOST': 'app-%d.example.com' % (i,),
+            'HAPROXY_0_REDIRECT_TO_HTTPS': 'true',
+            'HAPROXY_0_BACKEND_HEALTHCHECK_OPTIONS': 'option httpchk',
+            'DCOS_PACKAGE_VERSION': '1.0.%d' % (i % 10,),
+            'team': 'team-%d' % (i % 20,),
+        }
+        if i % 3 == 0:
+            labels['MARATHON_ACME_0_DOMAIN'] = (
+                'app-%d.example.com,www.app-%d.example.com' % (i, i))
+        if i % 9 == 0:
+            labels['HAPROXY_1_GROUP'] = 'external'
+            labels['MARATHON_ACME_1_DOMAIN'] = 'admin-%d.example.com' % (i,)
+        apps.append({
+            'id': '/app-%d' % (i,),
+            'labels': labels,
+            'portDefinitions': [
+                {'port': 10000 + i, 'protocol': 'tcp', 'labels': {}},
+                {'port': 20000 + i, 'protocol': 'tcp', 'labels': {}},
+                {'port': 30000 + i, 'protocol': 'tcp', 'labels': {}},
+            ],
+        })
+    return apps
+
+
+def per_port(apps):
+    return dict((app['id'], app_ports_per_port(app)) for app in apps)
+
+
+def main():
+    print('%-8s %12s %12s %12s %8s %8s' % (
+        'apps', 'per-port', 'cold', 'warm', 'cold', 'warm'))
+    for count in [1000, 10000, 50000]:
+        apps = make_apps(count)
+
+        # Check that the implementations agree
+        assert LabelExtractor(GROUPS).extract_all(apps) == per_port(apps)
+
+        number = max(1, 100000 // count)
+        old = min(timeit.repeat(
+            lambda: per_port(apps), number=number, repeat=3)) / number
+        cold = min(timeit.repeat(
+            lambda: LabelExtractor(GROUPS).extract_all(apps),
+            number=number, repeat=3)) / number
+        extractor = LabelExtractor(GROUPS)
+        extractor.extract_all(apps)
+        warm = min(timeit.repeat(
+            lambda: extractor.extract_all(apps),
+            number=number, repeat=3)) / number
+
+        print('%-8d %9.1f ms %9.1f ms %9.1f ms %7.1fx %7.1fx' % (
+            count, old * 1000, cold * 1000, warm * 1000, old / cold,
+            old / warm))
+
+
+if __name__ == '__main__':
+    main()
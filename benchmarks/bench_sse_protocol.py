@@ -0,0 +1,108 @@
+"""
+Throughput benchmark for ``SseProtocol.dataReceived``.
+
+Feeds a large Marathon-like ``api_post_event`` through the protocol in chunks
+of various sizes and compares the current line splitter with the previous
+``splitlines()``-based implementation, which re-copied and re-split the whole
+buffered line for every chunk received.
+
+Usage: python benchmarks/bench_sse_protocol.py
+"""
+import json
+import timeit
+
+from marathon_acme.sse_protocol import SseProtocol
+
+
+class NullTransport(object):
+    disconnecting = False
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+class SplitlinesSseProtocol(SseProtocol):
+    """
+    ``SseProtocol`` with the previous ``splitlines()``-based
+    ``dataReceived()``, kept here for comparison.
+    """
+
+    def __init__(self, handler):
+        super(SplitlinesSseProtocol, self).__init__(handler)
+        self._buffer = b''
+
+    def dataReceived(self, data):
+        lines = (self._buffer + data).splitlines()
+
+        if data.endswith(b'\n') or data.endswith(b'\r'):
+            self._buffer = b''
+        else:
+            self._buffer = lines.pop(-1)
+
+        for line in lines:
+            if self.transport.disconnecting:
+                return
+            if len(line) > self.MAX_LENGTH:
+                self.lineLengthExceeded(line)
+                return
+            else:
+                self.lineReceived(line)
+        if len(self._buffer) > self.MAX_LENGTH:
+            self.lineLengthExceeded(self._buffer)
+            return
+
+
+def make_event(size):
+    """
+    Create the bytes of an ``api_post_event`` with an app definition of
+    roughly the given size in bytes.
+    """
+    env = {}
+    i = 0
+    while len(json.dumps(env)) < size:
+        env['ENV_VAR_%d' % (i,)] = 'value-%d' % (i,) * 4
+        i += 1
+
+    event = {
+        'eventType': 'api_post_event',
+        'timestamp': '2017-01-01T00:00:00.000Z',
+        'uri': '/v2/apps/my-app',
+        'appDefinition': {'id': '/my-app', 'env': env, 'labels': {}},
+    }
+    return b'event: api_post_event\r\ndata: %s\r\n\r\n' % (
+        json.dumps(event).encode('utf-8'),)
+
+
+def chunks(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def run(protocol_class, parts):
+    protocol = protocol_class(lambda event, data: None)
+    protocol.transport = NullTransport()
+    for part in parts:
+        protocol.dataReceived(part)
+
+
+def main():
+    print('%-10s %-10s %14s %14s %8s' % (
+        'event', 'chunk', 'splitlines', 'incremental', 'speedup'))
+    for event_size in [10 * 1024, 100 * 1024, 500 * 1024]:
+        event = make_event(event_size)
+        for chunk_size in [512, 4096, 65536]:
+            parts = chunks(event, chunk_size)
+            number = max(1, 20 * 1024 * 1024 // (len(event) * len(parts)))
+            results = []
+            for protocol_class in [SplitlinesSseProtocol, SseProtocol]:
+                seconds = min(timeit.repeat(
+                    lambda: run(protocol_class, parts),
+                    number=number, repeat=3)) / number
+                results.append(len(event) / seconds / (1024 * 1024))
+            old, new = results
+            print('%-10s %-10s %9.1f MiB/s %9.1f MiB/s %7.1fx' % (
+                '%dKiB' % (len(event) // 1024,), chunk_size, old, new,
+                new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Replay benchmark for the Marathon event stream.
+
+Replays captures of the raw bytes of Marathon's ``/v2/events`` stream through
+``SseProtocol`` and the JSON event handler used by
+``MarathonClient.get_events()``, as fast as possible. Captures can be recorded
+from a live Marathon with ``marathon-acme --sse-record FILE``. Each connection
+in a capture is replayed through a new protocol, as it was received. If no
+captures are given, a synthetic capture of Marathon-like events is used.
+
+Reports events and bytes per second, and memory use per event from
+``tracemalloc``: the peak memory traced during the replay and the number of
+memory blocks still allocated afterwards. ``tracemalloc`` records sizes rather
+than a count of every allocation, so the replay is timed separately without
+tracing.
+
+Usage: python benchmarks/bench_sse_replay.py [--chunk-size N] [CAPTURE ...]
+"""
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+
+from marathon_acme.clients import json_event_handler
+from marathon_acme.sse_protocol import SseProtocol
+from marathon_acme.sse_recorder import split_connections
+
+
+# The event types that marathon-acme listens for
+EVENT_TYPES = ['api_post_event', 'event_stream_attached']
+
+
+class NullTransport(object):
+    disconnecting = False
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+def make_event(event_type, **kwargs):
+    event = {
+        'eventType': event_type,
+        'timestamp': '2017-01-01T00:00:00.000Z',
+    }
+    event.update(kwargs)
+    return b'event: %s\r\ndata: %s\r\n\r\n' % (
+        event_type.encode('utf-8'), json.dumps(event).encode('utf-8'))
+
+
+def make_synthetic_capture(apps=1000):
+    """
+    Create a capture of the sort of events Marathon sends when the event
+    stream isn't filtered by type: mostly task status updates with an
+    occasional app definition being posted.
+    """
+    parts = [make_event('event_stream_attached', remoteAddress='10.0.0.1')]
+    for i in range(apps):
+        app_id = '/app-%d' % (i,)
+        parts.append(make_event(
+            'api_post_event', clientIp='10.0.0.2', uri='/v2/apps' + app_id,
+            appDefinition={
+                'id': app_id,
+                'cmd': 'sleep 60',
+                'instances': 3,
+                'env': dict(('VAR_%d' % (j,), 'value') for j in range(20)),
+                'labels': {
+                    'HAPROXY_GROUP': 'external',
+                    'HAPROXY_0_VHOST': 'app-%d.example.com' % (i,),
+                    'MARATHON_ACME_0_DOMAIN': 'app-%d.example.com' % (i,),
+                },
+            }))
+        for j in range(10):
+            parts.append(make_event(
+                'status_update_event', slaveId='agent-1', taskStatus='RUNNING',
+                appId=app_id, taskId='%s.%d' % (app_id, j), host='10.0.1.1',
+                ports=[31000 + j], version='2017-01-01T00:00:00.000Z'))
+    parts.append(b': keepalive\r\n')
+    return b''.join(parts)
+
+
+def chunks(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def replay(connections):
+    """
+    Replay the parts of each connection in a capture, returning the number of
+    events received by the protocols and the number handled.
+    """
+    handled = []
+    callbacks = dict(
+        (event_type, handled.append) for event_type in EVENT_TYPES)
+    received = 0
+    for parts in connections:
+        protocol = SseProtocol(
+            json_event_handler(callbacks), event_types=EVENT_TYPES,
+            decode_data=False)
+        protocol.transport = NullTransport()
+        for part in parts:
+            protocol.dataReceived(part)
+        received += protocol.discarded_events + protocol.skipped_events
+
+    return received + len(handled), len(handled)
+
+
+def measure_memory(connections):
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    result = replay(connections)
+    blocks_after = sys.getallocatedblocks()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, blocks_after - blocks_before
+
+
+def benchmark(name, capture, chunk_size):
+    connections = [chunks(connection, chunk_size)
+                   for connection in split_connections(capture)]
+    (received, handled), peak, blocks = measure_memory(connections)
+
+    number = max(1, 50 * 1024 * 1024 // max(1, len(capture)))
+    seconds = min(timeit.repeat(
+        lambda: replay(connections), number=number, repeat=3)) / number
+
+    events = max(1, received)
+    print('%-24s %8d %8d %12.0f %10.1f %12.1f %10.2f' % (
+        name[-24:], received, handled, received / seconds,
+        len(capture) / seconds / (1024 * 1024), peak / float(events),
+        blocks / float(events)))
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--chunk-size', type=int, default=4096,
+                        help='The size of the chunks to replay the capture '
+                             'in (default: %(default)s)')
+    parser.add_argument('captures', metavar='CAPTURE', nargs='*',
+                        help='Files recorded with --sse-record')
+    args = parser.parse_args(args)
+
+    captures = []
+    for path in args.captures:
+        with open(path, 'rb') as f:
+            captures.append((path, f.read()))
+    if not captures:
+        captures.append(('synthetic', make_synthetic_capture()))
+
+    print('%-24s %8s %8s %12s %10s %12s %10s' % (
+        'capture', 'events', 'handled', 'events/s', 'MiB/s',
+        'peak B/event', 'blocks/ev'))
+    for name, capture in captures:
+        benchmark(name, capture, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,18 @@ from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.x509.oid import NameOID
+from pem import Certificate, Key
 from treq.client import HTTPClient
+from twisted.internet.defer import gatherResults, succeed
+from twisted.logger import Logger
 from twisted.web.client import Agent
-from txacme.client import Client as txacme_Client, JWSClient
+from txacme.client import (
+    Client as txacme_Client, JWSClient, answer_challenge, fqdn_identifier,
+    poll_until_valid)
 from txacme.interfaces import ICertificateStore
-from txacme.util import generate_private_key
+from txacme.messages import CertificateRequest
+from txacme.service import AcmeIssuingService
+from txacme.util import csr_for_names, generate_private_key, tap
 from zope.interface import implementer
 
 
@@ -94,6 +101,28 @@ def generate_wildcard_pem_bytes():
     ))
 
 
+def pem_cert_names(pem_objects):
+    """
+    Get the names (subjectAltNames) that the first certificate in a list of
+    PEM objects covers.
+
+    :return:
+        A list of domains, or None if there is no certificate or it has no
+        subjectAltNames.
+    """
+    for o in pem_objects:
+        if isinstance(o, Certificate):
+            cert = x509.load_pem_x509_certificate(
+                o.as_bytes(), default_backend())
+            try:
+                san = cert.extensions.get_extension_for_class(
+                    x509.SubjectAlternativeName)
+            except x509.ExtensionNotFound:
+                return None
+            return san.value.get_values_for_type(x509.DNSName)
+    return None
+
+
 @implementer(ICertificateStore)
 class MlbCertificateStore(object):
     """
@@ -124,3 +153,265 @@ class MlbCertificateStore(object):
 
     def as_dict(self):
         return self.certificate_store.as_dict()
+
+
+@implementer(ICertificateStore)
+class GroupCertificateStore(object):
+    """
+    An ``ICertificateStore`` that routes certificates to the stores for the
+    marathon-lb groups that they are for, so that one certificate can be
+    issued for a domain that is served by several groups.
+    """
+
+    def __init__(self, certificate_stores, groups_for):
+        """
+        :param certificate_stores:
+            A dict mapping group names to the ``ICertificateStore`` for each
+            group.
+        :param groups_for:
+            A callable that is called with a server name and returns the set
+            of groups that its certificate is for.
+        """
+        self.certificate_stores = certificate_stores
+        self.groups_for = groups_for
+
+    def get(self, server_name):
+        return self._groups_with(server_name).addCallback(
+            lambda groups: self.certificate_stores[groups[0]].get(server_name))
+
+    def store(self, server_name, pem_objects):
+        def store(groups):
+            return gatherResults(
+                [self.certificate_stores[group].store(server_name, pem_objects)
+                 for group in groups], consumeErrors=True)
+
+        return self._groups_with(server_name).addCallback(store)
+
+    def as_dict(self):
+        """
+        Get the certificates in the stores. A certificate is only included if
+        it is in the stores for all the groups that it is for, so that it is
+        issued again for any groups that are missing it.
+        """
+        groups = sorted(self.certificate_stores.keys())
+
+        def merge(group_certs):
+            group_certs = dict(zip(groups, group_certs))
+            certs = {}
+            for group in groups:
+                for server_name, objects in group_certs[group].items():
+                    if server_name in certs:
+                        continue
+                    # Certificates for server names that aren't known to be
+                    # for any group are included so that they're renewed
+                    cert_groups = self._known_groups(server_name)
+                    if all(server_name in group_certs[g]
+                           for g in cert_groups):
+                        certs[server_name] = objects
+            return certs
+
+        return gatherResults(
+            [self.certificate_stores[group].as_dict() for group in groups],
+            consumeErrors=True).addCallback(merge)
+
+    def _known_groups(self, server_name):
+        return sorted(
+            set(self.groups_for(server_name)) & set(self.certificate_stores))
+
+    def _groups_with(self, server_name):
+        """
+        Get the groups that a certificate is for. If the server name isn't
+        known to be for any group, e.g. because its app was removed, then get
+        the groups that already have a certificate for it.
+        """
+        groups = self._known_groups(server_name)
+        if groups:
+            return succeed(groups)
+
+        stores = sorted(self.certificate_stores.items())
+
+        def stored_groups(group_certs):
+            groups = [group for (group, _), certs in zip(stores, group_certs)
+                      if server_name in certs]
+            if not groups:
+                raise KeyError(server_name)
+            return groups
+
+        return gatherResults(
+            [store.as_dict() for _, store in stores],
+            consumeErrors=True).addCallback(stored_groups)
+
+
+class SanAcmeIssuingService(AcmeIssuingService):
+    """
+    An ``AcmeIssuingService`` that issues certificates with multiple names
+    (subjectAltNames). Certificates are still stored and renewed by a single
+    server name, but cover all the names for that server name, as given by
+    the ``names_for`` keyword argument.
+
+    Renewals found by the periodic check can also be handed off to the
+    ``renew`` keyword argument, for example to be prioritised against other
+    issuance.
+    """
+
+    log = Logger()
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param names_for:
+            A callable that is called with a server name and returns the list
+            of names that its certificate should cover, starting with the
+            server name, or None if the names aren't known, in which case the
+            names of the stored certificate are used. Defaults to just the
+            server name.
+        :param renew:
+            A callable that is called with a server name and whether its
+            certificate is close to expiry, and returns a deferred that fires
+            once the certificate has been renewed. Defaults to renewing with
+            ``issue_cert()``.
+        """
+        self._names_for = kwargs.pop('names_for', lambda name: [name])
+        self._renew = kwargs.pop('renew', None)
+        super(SanAcmeIssuingService, self).__init__(*args, **kwargs)
+
+    def _check_certs(self):
+        """
+        Check all of the certs in the store, and renew any that are expired
+        or close to expiring. This follows
+        ``AcmeIssuingService._check_certs()`` but renews through ``renew``.
+        """
+        if self._renew is None:
+            return super(SanAcmeIssuingService, self)._check_certs()
+
+        self.log.info('Starting scheduled check for expired certificates.')
+
+        def check(certs):
+            panicing = set()
+            expiring = set()
+            for server_name, objects in certs.items():
+                if len(objects) == 0:
+                    panicing.add(server_name)
+                for o in filter(lambda o: isinstance(o, Certificate), objects):
+                    cert = x509.load_pem_x509_certificate(
+                        o.as_bytes(), default_backend())
+                    until_expiry = cert.not_valid_after - self._now()
+                    if until_expiry <= self.panic_interval:
+                        panicing.add(server_name)
+                    elif until_expiry <= self.reissue_interval:
+                        expiring.add(server_name)
+
+            self.log.info(
+                'Found {panicing_count:d} overdue / expired and '
+                '{expiring_count:d} expiring certificates.',
+                panicing_count=len(panicing),
+                expiring_count=len(expiring))
+
+            d1 = (
+                gatherResults(
+                    [self._renew(server_name, True)
+                     .addErrback(self._panic, server_name)
+                     for server_name in panicing],
+                    consumeErrors=True)
+                .addCallback(done_panicing))
+            d2 = gatherResults(
+                [self._renew(server_name, False)
+                 .addErrback(
+                     lambda f, server_name=server_name: self.log.failure(
+                         u'Error issuing certificate for: {server_name!r}',
+                         f, server_name=server_name))
+                 for server_name in expiring],
+                consumeErrors=True)
+            return gatherResults([d1, d2], consumeErrors=True)
+
+        def done_panicing(ignored):
+            self.ready = True
+            for d in list(self._waiting):
+                d.callback(None)
+            self._waiting = []
+
+        return (
+            self._ensure_registered()
+            .addCallback(lambda _: self.cert_store.as_dict())
+            .addCallback(check)
+            .addErrback(
+                lambda f: self.log.failure(
+                    u'Error in scheduled certificate check.', f)))
+
+    def _issue_cert(self, client, server_name):
+        """
+        Issue a new certificate covering all the names for a server name. This
+        follows ``AcmeIssuingService._issue_cert()`` but authorizes each name
+        in turn before requesting a certificate for them all.
+        """
+        names = self._names_for(server_name)
+        if names is not None:
+            return self._issue_cert_names(client, server_name, names)
+
+        return self._stored_names(server_name).addCallback(
+            partial(self._issue_cert_names, client, server_name))
+
+    def _stored_names(self, server_name):
+        """
+        Get the names that the stored certificate for a server name covers, or
+        just the server name if there is no stored certificate.
+        """
+        def stored_names(pem_objects):
+            return pem_cert_names(pem_objects) or [server_name]
+
+        def not_stored(failure):
+            failure.trap(KeyError)
+            return [server_name]
+
+        return (self.cert_store.get(server_name)
+                .addCallbacks(stored_names, not_stored))
+
+    def _issue_cert_names(self, client, server_name, names):
+        self.log.info(
+            'Requesting a certificate for {server_name!r} with names '
+            '{names!r}.', server_name=server_name, names=names)
+        key = self._generate_key()
+        objects = [
+            Key(key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.TraditionalOpenSSL,
+                encryption_algorithm=serialization.NoEncryption()))]
+
+        def answer_and_poll(authzr):
+            def got_challenge(stop_responding):
+                return (
+                    poll_until_valid(authzr, self._clock, client)
+                    .addBoth(tap(lambda _: stop_responding())))
+            return (
+                answer_challenge(authzr, client, self._responders)
+                .addCallback(got_challenge))
+
+        def authorize(_, name):
+            return (client.request_challenges(fqdn_identifier(name))
+                    .addCallback(answer_and_poll))
+
+        def got_cert(certr):
+            objects.append(
+                Certificate(
+                    x509.load_der_x509_certificate(
+                        certr.body, default_backend())
+                    .public_bytes(serialization.Encoding.PEM)))
+            return certr
+
+        def got_chain(chain):
+            for certr in chain:
+                got_cert(certr)
+            self.log.info(
+                'Received certificate for {server_name!r}.',
+                server_name=server_name)
+            return objects
+
+        d = succeed(None)
+        for name in names:
+            d.addCallback(authorize, name)
+        return (
+            d.addCallback(lambda _: client.request_issuance(
+                CertificateRequest(csr=csr_for_names(names, key))))
+            .addCallback(got_cert)
+            .addCallback(client.fetch_chain)
+            .addCallback(got_chain)
+            .addCallback(partial(self.cert_store.store, server_name)))
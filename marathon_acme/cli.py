@@ -15,7 +15,10 @@ from txacme.store import DirectoryStore
 from marathon_acme.acme_util import (
     create_txacme_client_creator, generate_wildcard_pem_bytes, maybe_key)
 from marathon_acme.clients import MarathonClient, MarathonLbClient
+from marathon_acme.failure_cache import FailureCache
+from marathon_acme.rate_limiter import RateLimiter
 from marathon_acme.service import MarathonAcme
+from marathon_acme.sse_recorder import SseRecorder
 
 
 log = Logger()
@@ -38,14 +41,56 @@ parser.add_argument('-l', '--lb', metavar='LB[,LB,...]',
                     help='The addresses for the marathon-lb HTTP API '
                          '(default: %(default)s)',
                     default='http://marathon-lb.marathon.mesos:9090')
-parser.add_argument('-g', '--group',
-                    help='The marathon-lb group to issue certificates for '
+parser.add_argument('-g', '--group', metavar='GROUP[,GROUP,...]',
+                    help='The marathon-lb groups to issue certificates for '
                          '(default: %(default)s)',
                     default='external')
+parser.add_argument('--group-lb', metavar='GROUP=LB[,LB,...]',
+                    action='append', default=[],
+                    help='The addresses for the marathon-lb HTTP API for a '
+                         'group, if different to --lb. May be given once for '
+                         'each group.')
+parser.add_argument('--app-label', metavar='SELECTOR',
+                    help='A Marathon label selector that apps must match to '
+                         'have certificates issued for their domains, e.g. '
+                         '"HAPROXY_GROUP==external". Marathon filters the '
+                         'apps so that less data is fetched in each sync '
+                         '(optional)')
 parser.add_argument('--listen',
                     help='The address for the port to listen on (default: '
                          '%(default)s)',
                     default=':8000')
+parser.add_argument('--sse-timeout', metavar='SECONDS', type=float,
+                    help='Reconnect to the Marathon event stream if no data '
+                         'is received for this many seconds (default: never '
+                         'time out)')
+parser.add_argument('--sse-record', metavar='FILE',
+                    help='Append the raw bytes received from the Marathon '
+                         'event stream to this file, for replaying with '
+                         'benchmarks/bench_sse_replay.py (optional)')
+parser.add_argument('--sync-debounce', metavar='SECONDS', type=float,
+                    help='How long to wait after an event triggers a sync '
+                         'before starting it, so that a burst of events '
+                         'results in a single sync (default: %(default)s)',
+                    default=1.0)
+parser.add_argument('--reconcile-interval', metavar='SECONDS', type=float,
+                    help='How often to run a full sync in case any events '
+                         'were missed, or 0 to never (default: '
+                         '%(default)s). The interval stretches up to 4 times '
+                         'this while the event stream is healthy.',
+                    default=300.0)
+parser.add_argument('--issue-concurrency', metavar='N', type=int,
+                    help='The maximum number of certificates to issue at '
+                         'once (default: %(default)s)',
+                    default=4)
+parser.add_argument('--rate-limit-domain', metavar='N', type=int,
+                    help='The maximum number of certificates to issue per '
+                         'registered domain per week (default: %(default)s)',
+                    default=50)
+parser.add_argument('--rate-limit-account', metavar='N', type=int,
+                    help='The maximum number of certificate orders to make '
+                         'per 3 hours (default: %(default)s)',
+                    default=300)
 parser.add_argument('--log-level',
                     help='The minimum severity level to log messages at '
                          '(default: %(default)s)',
@@ -68,22 +113,46 @@ def main(reactor, raw_args=sys.argv[1:]):
     # Set up marathon-acme
     marathon_addrs = args.marathon.split(',')
     mlb_addrs = args.lb.split(',')
+    groups = args.group.split(',')
+    group_mlb_addrs = parse_group_lb(args.group_lb, groups)
 
     marathon_acme = create_marathon_acme(
         args.storage_dir, args.acme, args.email,
-        marathon_addrs, mlb_addrs, args.group,
-        reactor)
+        marathon_addrs, mlb_addrs, groups,
+        reactor, sse_timeout=args.sse_timeout, sse_record=args.sse_record,
+        sync_debounce=args.sync_debounce,
+        reconcile_interval=args.reconcile_interval,
+        issue_concurrency=args.issue_concurrency,
+        rate_limit_domain=args.rate_limit_domain,
+        rate_limit_account=args.rate_limit_account,
+        group_mlb_addrs=group_mlb_addrs,
+        app_label_selector=args.app_label)
 
     # Run the thing
     endpoint_description = parse_listen_addr(args.listen)
 
     log.info('Running marathon-acme with: storage-dir="{storage_dir}", '
              'acme="{acme}", email="{email}", marathon={marathon_addrs}, '
-             'lb={mlb_addrs}, group="{group}", '
-             'endpoint_description="{endpoint_desc}", ',
+             'lb={mlb_addrs}, groups={groups}, '
+             'group_lb={group_mlb_addrs}, app_label="{app_label}", '
+             'endpoint_description="{endpoint_desc}", '
+             'sse_timeout={sse_timeout}, sse_record="{sse_record}", '
+             'sync_debounce={sync_debounce}, '
+             'reconcile_interval={reconcile_interval}, '
+             'issue_concurrency={issue_concurrency}, '
+             'rate_limit_domain={rate_limit_domain}, '
+             'rate_limit_account={rate_limit_account}',
              storage_dir=args.storage_dir, acme=args.acme, email=args.email,
              marathon_addrs=marathon_addrs, mlb_addrs=mlb_addrs,
-             group=args.group, endpoint_desc=endpoint_description)
+             groups=groups, group_mlb_addrs=group_mlb_addrs,
+             app_label=args.app_label,
+             endpoint_desc=endpoint_description,
+             sse_timeout=args.sse_timeout, sse_record=args.sse_record,
+             sync_debounce=args.sync_debounce,
+             reconcile_interval=args.reconcile_interval,
+             issue_concurrency=args.issue_concurrency,
+             rate_limit_domain=args.rate_limit_domain,
+             rate_limit_account=args.rate_limit_account)
 
     return marathon_acme.run(endpoint_description)
 
@@ -95,6 +164,26 @@ def _to_unicode(string):
         return unicode(string, 'utf-8')
 
 
+def parse_group_lb(group_lbs, groups):
+    """
+    Parse a list of values of the form GROUP=LB[,LB,...] into a dict mapping
+    group names to lists of marathon-lb addresses.
+    """
+    group_mlb_addrs = {}
+    for group_lb in group_lbs:
+        if '=' not in group_lb:
+            raise ValueError(
+                "'%s' does not have the correct form for a group's "
+                'marathon-lb addresses: GROUP=LB[,LB,...]' % (group_lb,))
+        group, addrs = group_lb.split('=', 1)
+        if group not in groups:
+            raise ValueError(
+                "'%s' is not one of the groups to issue certificates for"
+                % (group,))
+        group_mlb_addrs[group] = addrs.split(',')
+    return group_mlb_addrs
+
+
 def parse_listen_addr(listen_addr):
     """
     Parse an address of the form [ipaddress]:port into a tcp or tcp6 Twisted
@@ -137,7 +226,11 @@ def _create_tx_endpoints_string(args, kwargs):
 
 def create_marathon_acme(storage_dir, acme_directory, acme_email,
                          marathon_addrs, mlb_addrs, group,
-                         reactor):
+                         reactor, sse_timeout=None, sse_record=None,
+                         sync_debounce=0, reconcile_interval=300.0,
+                         issue_concurrency=4, rate_limit_domain=50,
+                         rate_limit_account=300, group_mlb_addrs=None,
+                         app_label_selector=None):
     """
     Create a marathon-acme instance.
 
@@ -154,21 +247,80 @@ def create_marathon_acme(storage_dir, acme_directory, acme_email,
         certificate is issued.
     :param group:
         The marathon-lb group (``HAPROXY_GROUP``) to consider when finding
-        app domains.
+        app domains, or a list of groups. If there are several groups, each
+        group's certificates are stored in a directory named after the group
+        inside the certificates directory.
     :param reactor: The reactor to use.
+    :param sse_timeout:
+        Number of seconds the Marathon event stream may be idle before it is
+        reconnected, or None to never time out.
+    :param sse_record:
+        Path to a file to append the raw bytes of the Marathon event stream
+        to, or None to not record the event stream. The start of each
+        connection is marked in the file.
+    :param sync_debounce:
+        Number of seconds to wait after an event triggers a sync before
+        starting it.
+    :param reconcile_interval:
+        Number of seconds between periodic full syncs, or 0 to not run them.
+    :param issue_concurrency:
+        The maximum number of certificates to issue at once.
+    :param rate_limit_domain:
+        The maximum number of certificates to issue per registered domain per
+        week.
+    :param rate_limit_account:
+        The maximum number of certificate orders to make per 3 hours.
+    :param group_mlb_addrs:
+        Dict mapping group names to lists of addresses for the marathon-lb
+        instances for those groups. Groups not in the dict use ``mlb_addrs``.
+    :param app_label_selector:
+        A Marathon label selector that apps must match to have certificates
+        issued for their domains, or None to consider all apps.
     """
+    groups = list(group) if isinstance(group, (list, tuple)) else [group]
     storage_path, certs_path = init_storage_dir(storage_dir)
     acme_url = URL.fromText(_to_unicode(acme_directory))
     key = maybe_key(storage_path)
 
+    recorder = None
+    if sse_record is not None:
+        recorder = SseRecorder(sse_record)
+        reactor.addSystemEventTrigger('after', 'shutdown', recorder.close)
+
+    if len(groups) == 1:
+        cert_store = DirectoryStore(certs_path)
+    else:
+        cert_store = dict(
+            (g, DirectoryStore(init_group_certs_dir(certs_path, g)))
+            for g in groups)
+
+    if group_mlb_addrs is None:
+        group_mlb_addrs = {}
+    mlb_client = MarathonLbClient(mlb_addrs, reactor=reactor)
+    mlb_clients = dict(
+        (g, MarathonLbClient(group_mlb_addrs[g], reactor=reactor)
+            if g in group_mlb_addrs else mlb_client)
+        for g in groups)
+
     return MarathonAcme(
-        MarathonClient(marathon_addrs, reactor=reactor),
-        group,
-        DirectoryStore(certs_path),
-        MarathonLbClient(mlb_addrs, reactor=reactor),
+        MarathonClient(marathon_addrs, reactor=reactor,
+                       event_stream_timeout=sse_timeout,
+                       event_stream_recorder=recorder),
+        groups,
+        cert_store,
+        mlb_clients,
         create_txacme_client_creator(reactor, acme_url, key),
         reactor,
-        acme_email)
+        acme_email,
+        sync_debounce=sync_debounce,
+        reconcile_interval=reconcile_interval,
+        issue_concurrency=issue_concurrency,
+        rate_limiter=RateLimiter(
+            reactor, domain_limit=rate_limit_domain,
+            account_limit=rate_limit_account),
+        failure_cache=FailureCache(
+            reactor, path=storage_path.child('failures.json')),
+        app_label_selector=app_label_selector)
 
 
 def init_storage_dir(storage_dir):
@@ -194,6 +346,20 @@ def init_storage_dir(storage_dir):
     return storage_path, certs_path
 
 
+def init_group_certs_dir(certs_path, group):
+    """
+    Initialise the certificates directory for a marathon-lb group inside the
+    certificates directory.
+
+    :return: the group's certs path
+    """
+    group_certs_path = certs_path.child(group)
+    if not group_certs_path.exists():
+        group_certs_path.createDirectory()
+
+    return group_certs_path
+
+
 def init_logging(log_level):
     """
     Initialise the logging by adding an observer to the global log publisher.
@@ -1,13 +1,15 @@
 import cgi
+import hashlib
 import json
 
 from requests.exceptions import HTTPError
 from treq.client import HTTPClient as treq_HTTPClient
 from twisted.internet.defer import DeferredList
 from twisted.logger import Logger, LogLevel
-from twisted.web.http import OK
+from twisted.web.http import NOT_MODIFIED, OK
 from uritools import uricompose, uridecode, urisplit
 
+from marathon_acme.json_stream import JsonFieldStreamProtocol
 from marathon_acme.sse_protocol import SseProtocol
 
 
@@ -40,6 +42,25 @@ def json_content(response):
     return d.addCallback(json.loads)
 
 
+def json_field_content(response, field, handler):
+    """
+    Callback to incrementally parse the JSON content of a response that is an
+    object with an array in the given field, calling the handler with each
+    element of the array as it is received rather than buffering the whole
+    response.
+
+    :return:
+        A deferred that fires with the number of elements once the whole
+        response has been parsed.
+    """
+    raise_for_header(response, 'Content-Type', 'application/json')
+
+    protocol = JsonFieldStreamProtocol(field, handler)
+    finished = protocol.when_finished()
+    response.deliverBody(protocol)
+    return finished
+
+
 def raise_for_status(response):
     """
     Raises a `requests.exceptions.HTTPError` if the response did not succeed.
@@ -226,12 +247,12 @@ def raise_for_not_ok_status(response):
     return response
 
 
-def _sse_content_with_protocol(response, handler):
+def _sse_content_with_protocol(response, handler, **sse_kwargs):
     """
     Sometimes we need the protocol object so that we can manipulate the
     underlying transport in tests.
     """
-    protocol = SseProtocol(handler)
+    protocol = SseProtocol(handler, **sse_kwargs)
     finished = protocol.when_finished()
 
     response.deliverBody(protocol)
@@ -239,22 +260,94 @@ def _sse_content_with_protocol(response, handler):
     return finished, protocol
 
 
-def sse_content(response, handler):
+def sse_protocol(response, handler, **sse_kwargs):
     """
-    Callback to collect the Server-Sent Events content of a response. Callbacks
-    passed will receive event data.
+    Callback to start collecting the Server-Sent Events content of a response.
+    Callbacks passed will receive event data.
 
     :param response:
         The response from the SSE request.
     :param handler:
         The handler for the SSE protocol.
+    :param sse_kwargs:
+        Any other keyword arguments to pass to the ``SseProtocol``.
+    :return:
+        The ``SseProtocol`` that the content is being delivered to.
     """
     # An SSE response must be 200/OK and have content-type 'text/event-stream'
     raise_for_not_ok_status(response)
     raise_for_header(response, 'Content-Type', 'text/event-stream')
 
-    finished, _ = _sse_content_with_protocol(response, handler)
-    return finished
+    _, protocol = _sse_content_with_protocol(response, handler, **sse_kwargs)
+    return protocol
+
+
+def sse_content(response, handler, **sse_kwargs):
+    """
+    Callback to collect the Server-Sent Events content of a response. Callbacks
+    passed will receive event data.
+
+    :param response:
+        The response from the SSE request.
+    :param handler:
+        The handler for the SSE protocol.
+    :param sse_kwargs:
+        Any other keyword arguments to pass to the ``SseProtocol``.
+    :return:
+        A deferred that fires with the ``SseProtocol`` when the connection is
+        closed.
+    """
+    protocol = sse_protocol(response, handler, **sse_kwargs)
+    return protocol.when_finished().addCallback(lambda _: protocol)
+
+
+def _json_loads_bytes(data):
+    """
+    Deserialize JSON from UTF-8 bytes. ``json.loads()`` accepts bytes
+    directly on Python 2 and Python 3.6+, otherwise decode them first.
+    """
+    return json.loads(data.decode('utf-8'))
+
+
+try:
+    json.loads(b'null')
+except TypeError:  # pragma: no cover
+    json_loads_bytes = _json_loads_bytes
+else:
+    json_loads_bytes = json.loads
+
+
+def _app_fingerprint(app):
+    """
+    Serialise the parts of an app definition that affect which certificates
+    it needs: its ID, labels (which include its groups) and number of ports.
+    Fields that change as the app runs, like ``tasksRunning`` or
+    ``version``, are left out so that they don't make the apps look changed.
+    """
+    if 'portDefinitions' in app:
+        num_ports = len(app['portDefinitions'])
+    else:
+        num_ports = len(app.get('ports', []))
+    return json.dumps([app.get('id'), app.get('labels'), num_ports],
+                      sort_keys=True).encode('utf-8')
+
+
+def json_event_handler(callbacks):
+    """
+    Create an ``SseProtocol`` handler that deserializes the JSON data (in
+    bytes) of each event and passes it to the callback for the event's type,
+    if there is one. Use with an ``SseProtocol`` created with
+    ``decode_data=False``.
+
+    :param callbacks:
+        A dict mapping event types to functions that handle the event data.
+    """
+    def handler(event, data):
+        callback = callbacks.get(event)
+        # Deserialize JSON if a callback is present
+        if callback is not None:
+            callback(json_loads_bytes(data))
+    return handler
 
 
 class MarathonClient(JsonClient):
@@ -265,10 +358,33 @@ class MarathonClient(JsonClient):
             A priority-ordered list of Marathon endpoints. Each endpoint will
             be tried one-by-one until the request succeeds or all endpoints
             fail.
+        :param event_stream_timeout:
+            The number of seconds the event stream connection may be idle
+            before it is closed, or None to never time out.
+        :param event_stream_recorder:
+            An ``SseRecorder`` to record the raw bytes received from the event
+            stream to, or None to not record the event stream.
         """
+        self.event_stream_timeout = kwargs.pop('event_stream_timeout', None)
+        self.event_stream_recorder = kwargs.pop('event_stream_recorder', None)
         super(MarathonClient, self).__init__(*args, **kwargs)
         self.endpoints = endpoints
 
+        # Whether to ask Marathon to filter the event stream by event type.
+        # Older versions of Marathon ignore the filter, in which case we stop
+        # asking.
+        self.filter_event_types = True
+
+        # Label selector -> the validator for the last list of apps fetched
+        # with that selector: ('etag', ETag) if Marathon sent an ETag, or
+        # ('sha1', digest of the apps' certificate-related fields) if it
+        # didn't
+        self._apps_validators = {}
+        # The number of times the list of apps was fetched and found to be
+        # unchanged or changed since the last time it was fetched
+        self.apps_fingerprint_hits = 0
+        self.apps_fingerprint_misses = 0
+
     def request(self, *args, **kwargs):
         d = self._request(None, list(self.endpoints), *args, **kwargs)
         d.addErrback(self._log_all_endpoints_failed)
@@ -316,6 +432,28 @@ class MarathonClient(JsonClient):
         d.addCallback(self._get_json_field, field)
         return d
 
+    def stream_json_field(self, field, handler, **kwargs):
+        """
+        Perform a GET request and stream the elements of the array in a field
+        of the JSON response to a handler as they are received, so that the
+        whole response is never held in memory.
+
+        This method will raise an error if:
+        * There is an error response code
+        * The response isn't valid JSON
+        * The field with the given name cannot be found
+
+        :param handler:
+            A callable that is called with each element of the array.
+        :return:
+            A deferred that fires with the number of elements once the whole
+            response has been received.
+        """
+        d = self.request('GET', **kwargs)
+        d.addCallback(raise_for_status)
+        d.addCallback(json_field_content, field, handler)
+        return d
+
     def _get_json_field(self, response_json, field_name):
         """
         Get a JSON field from the response JSON.
@@ -332,32 +470,213 @@ class MarathonClient(JsonClient):
 
         return response_json[field_name]
 
-    def get_apps(self):
+    def get_apps(self, label=None):
         """
         Get the currently running Marathon apps, returning a list of app
         definitions.
+
+        :param label:
+            A label selector string for Marathon to filter the apps by, e.g.
+            ``HAPROXY_GROUP==external``. Filtering the apps in Marathon keeps
+            the response small when most apps don't need certificates.
+        """
+        params = {'label': label} if label is not None else {}
+        return self.get_json_field('apps', path='/v2/apps', params=params)
+
+    def stream_apps(self, handler, label=None, skip_unchanged=False):
+        """
+        Get the currently running Marathon apps, calling the handler with each
+        app definition as it is received rather than building a list of them.
+
+        The list of apps is fingerprinted so that it can be compared with the
+        last list fetched with the same label selector: using the ``ETag``
+        header if Marathon sends one, or else a hash of the fields of each app
+        that affect its certificates, so that changes to fields like
+        ``tasksRunning`` don't count.
+
+        :param handler: A callable that is called with each app definition.
+        :param label:
+            A label selector string for Marathon to filter the apps by.
+        :param skip_unchanged:
+            Whether to skip the apps if they haven't changed since they were
+            last fetched. If Marathon sent an ETag for them, it is sent back
+            in an ``If-None-Match`` header so that Marathon can skip sending
+            them. Otherwise, the apps are still passed to the handler because
+            they can only be compared once they have all been received.
+        :return:
+            A deferred that fires with the number of apps once they have all
+            been received, or None if ``skip_unchanged`` is true and they
+            haven't changed.
         """
-        return self.get_json_field('apps', path='/v2/apps')
+        params = {'label': label} if label is not None else {}
+        previous = self._apps_validators.get(label)
+        headers = {}
+        if skip_unchanged and previous is not None and previous[0] == 'etag':
+            headers['If-None-Match'] = previous[1]
+
+        d = self.request(
+            'GET', path='/v2/apps', params=params, headers=headers)
+        d.addCallback(raise_for_status)
+        d.addCallback(self._stream_apps_response, handler, label, previous,
+                      skip_unchanged)
+        return d
+
+    def _stream_apps_response(self, response, handler, label, previous,
+                              skip_unchanged):
+        if response.code == NOT_MODIFIED:
+            self.apps_fingerprint_hits += 1
+            return None
+
+        etags = response.headers.getRawHeaders('ETag')
+        digest = hashlib.sha1()
+        # Only hash the apps if there's no ETag to compare
+        if not etags:
+            app_handler = handler
+
+            def handler(app):
+                digest.update(_app_fingerprint(app))
+                digest.update(b'\n')
+                return app_handler(app)
+
+        def compare(count):
+            if etags:
+                current = ('etag', etags[-1])
+            else:
+                current = ('sha1', digest.hexdigest())
+            self._apps_validators[label] = current
+            if current != previous:
+                self.apps_fingerprint_misses += 1
+                return count
 
-    def get_events(self, callbacks):
+            self.apps_fingerprint_hits += 1
+            return None if skip_unchanged else count
+
+        d = json_field_content(response, 'apps', handler)
+        return d.addCallback(compare)
+
+    def get_events(self, callbacks, last_event_id=None):
         """
         Attach to Marathon's event stream using Server-Sent Events (SSE).
 
         :param callbacks:
             A dict mapping event types to functions that handle the event data
+        :param last_event_id:
+            The ID of the last event received from a previous connection to
+            the event stream. If provided, it is sent as the ``Last-Event-ID``
+            header so that the stream can be resumed.
+        :return:
+            A deferred that fires with the ``SseProtocol`` when the connection
+            to the event stream is closed. The protocol has the
+            ``last_event_id`` and ``reconnection_time`` for the stream.
         """
-        d = self.request('GET', path='/v2/events', headers={
-            'Accept': 'text/event-stream',
-            'Cache-Control': 'no-store'
-        })
+        d = self.connect_events(callbacks, last_event_id=last_event_id)
+
+        def wait_finished(protocol):
+            return protocol.when_finished().addCallback(lambda _: protocol)
+        return d.addCallback(wait_finished)
+
+    def connect_events(self, callbacks, last_event_id=None,
+                       skipped_callback=None):
+        """
+        Connect to Marathon's event stream using Server-Sent Events (SSE).
+
+        Only the event types that there are callbacks for are requested from
+        Marathon using the ``event_type`` query parameter. The filter is only
+        best-effort: events of other types are still discarded as they are
+        received. If Marathon rejects a filtered request, the request is
+        retried straight away without the filter. If Marathon accepts it but
+        sends events of other types anyway, it is ignoring the filter. In
+        either case, the filter is not requested again.
+
+        If no data is received for ``event_stream_timeout`` seconds, the
+        connection is closed so that a stalled stream can be reconnected.
 
-        def handler(event, data):
-            callback = callbacks.get(event)
-            # Deserialize JSON if a callback is present
-            if callback is not None:
-                callback(json.loads(data))
+        :param callbacks:
+            A dict mapping event types to functions that handle the event data
+        :param last_event_id:
+            The ID of the last event received from a previous connection to
+            the event stream. If provided, it is sent as the ``Last-Event-ID``
+            header so that the stream can be resumed.
+        :param skipped_callback:
+            A function that is called with the event type when an event that
+            there is a callback for is skipped because its data is too large.
+        :return:
+            A deferred that fires with the ``SseProtocol`` once the event
+            stream is open. Use ``SseProtocol.when_finished()`` to find out
+            when the connection is closed.
+        """
+        event_types = sorted(callbacks.keys())
+        filtered = self.filter_event_types
+        params = {'event_type': event_types} if filtered else {}
 
-        return d.addCallback(sse_content, handler)
+        headers = {
+            'Accept': 'text/event-stream',
+            'Cache-Control': 'no-store'
+        }
+        if last_event_id is not None:
+            headers['Last-Event-ID'] = last_event_id
+
+        d = self.request(
+            'GET', path='/v2/events', params=params, headers=headers)
+
+        def open_stream(response):
+            if filtered and response.code != OK:
+                return self._retry_events_unfiltered(
+                    response, callbacks, last_event_id, skipped_callback)
+
+            recorder = self.event_stream_recorder
+            record = None
+            if recorder is not None:
+                record = recorder.write
+                recorder.start_connection()
+
+            # Let the protocol skip the events we don't have callbacks for
+            # before their data is decoded
+            return sse_protocol(
+                response, json_event_handler(callbacks),
+                event_types=event_types, last_event_id=last_event_id,
+                timeout=self.event_stream_timeout, reactor=self._reactor,
+                recorder=record, decode_data=False,
+                skipped_handler=skipped_callback,
+                discarded_handler=(
+                    self._event_type_filter_ignored if filtered else None))
+        return d.addCallback(open_stream)
+
+    def _retry_events_unfiltered(self, response, callbacks, last_event_id,
+                                 skipped_callback):
+        """
+        Marathon rejected a request for the event stream filtered by event
+        type. This version of Marathon probably doesn't support filtering, so
+        stop requesting it and connect again without it.
+        """
+        self.log.warn(
+            'Marathon rejected the event stream request with the event_type '
+            'filter (status code {code}). The filter is probably not '
+            'supported by this version of Marathon and will not be used '
+            'again.', code=response.code)
+        self.filter_event_types = False
+
+        # Throw away the body of the rejected response
+        response.content().addErrback(lambda _: None)
+        return self.connect_events(
+            callbacks, last_event_id=last_event_id,
+            skipped_callback=skipped_callback)
+
+    def _event_type_filter_ignored(self, event_type):
+        """
+        Marathon sent an event that we didn't ask for despite us filtering
+        the event stream by event type. This version of Marathon probably
+        ignores the filter, so stop requesting it. The events we don't want
+        are still discarded by the protocol.
+        """
+        if not self.filter_event_types:
+            return
+
+        self.log.warn(
+            'Marathon sent a {event_type} event, which was not requested. The '
+            'event_type filter is probably not supported by this version of '
+            'Marathon and will not be used again.', event_type=event_type)
+        self.filter_event_types = False
 
 
 class MarathonLbClient(HTTPClient):
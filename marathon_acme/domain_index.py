@@ -0,0 +1,134 @@
+class DomainIndex(object):
+    """
+    An index of the domains for each port of each app, with a reverse index
+    of the apps and ports that each domain belongs to.
+
+    The methods that update the index return the domains that were added to
+    the index (that didn't belong to any app before) and the domains that were
+    removed from the index (that no longer belong to any app).
+    """
+
+    def __init__(self):
+        # app ID -> port index -> list of domains
+        self._apps = {}
+        # domain -> set of (app ID, port index)
+        self._owners = {}
+
+    def __len__(self):
+        """ The number of domains in the index. """
+        return len(self._owners)
+
+    def __contains__(self, domain):
+        return domain in self._owners
+
+    def domains(self):
+        """ Get all the domains in the index. """
+        return set(self._owners.keys())
+
+    def owners(self, domain):
+        """
+        Get the apps and ports that the given domain belongs to.
+
+        :return: A set of (app ID, port index) tuples.
+        """
+        return set(self._owners.get(domain, ()))
+
+    def app_domains(self, app_id):
+        """
+        Get the domains for each port of the given app.
+
+        :return: A dict mapping port indexes to lists of domains.
+        """
+        return dict(self._apps.get(app_id, {}))
+
+    def primary_domains(self):
+        """
+        Get the first domain for each port of each app. Each of these names a
+        certificate that covers all the domains for the port.
+        """
+        return set(domains[0] for port_domains in self._apps.values()
+                   for domains in port_domains.values())
+
+    def cert_names(self, domain):
+        """
+        Get the names that the certificate for the given primary domain should
+        cover: the domain itself followed by the other domains of each port
+        that it is the first domain for.
+
+        :return: A list of domains.
+        """
+        names = [domain]
+        for app_id, port in sorted(self._owners.get(domain, ())):
+            domains = self._apps[app_id][port]
+            if domains[0] == domain:
+                names.extend(name for name in domains[1:] if name not in names)
+        return names
+
+    def update_app(self, app_id, port_domains):
+        """
+        Set the domains for each port of an app, replacing any domains that
+        were set for the app before.
+
+        :param app_id: The ID of the app.
+        :param port_domains:
+            A dict mapping port indexes to lists of domains.
+        :return: A tuple of the sets of domains added and removed.
+        """
+        added, removed = set(), set()
+        self._remove_app(app_id, removed)
+        self._add_app(app_id, port_domains, added)
+        # Domains that moved between ports of the app are neither
+        return added - removed, removed - added
+
+    def remove_app(self, app_id):
+        """
+        Remove an app and its domains from the index.
+
+        :return: A tuple of the sets of domains added and removed.
+        """
+        removed = set()
+        self._remove_app(app_id, removed)
+        return set(), removed
+
+    def replace_all(self, apps_port_domains):
+        """
+        Replace the contents of the index, for example after a full sync.
+
+        :param apps_port_domains:
+            A dict mapping app IDs to dicts mapping port indexes to lists of
+            domains.
+        :return: A tuple of the sets of domains added and removed.
+        """
+        before = self.domains()
+        self._apps = {}
+        self._owners = {}
+        for app_id, port_domains in apps_port_domains.items():
+            self._add_app(app_id, port_domains, set())
+
+        after = self.domains()
+        return after - before, before - after
+
+    def _add_app(self, app_id, port_domains, added):
+        port_domains = dict(
+            (port, list(domains)) for port, domains in port_domains.items()
+            if domains)
+        if not port_domains:
+            return
+
+        self._apps[app_id] = port_domains
+        for port, domains in port_domains.items():
+            for domain in domains:
+                owners = self._owners.setdefault(domain, set())
+                if not owners:
+                    added.add(domain)
+                owners.add((app_id, port))
+
+    def _remove_app(self, app_id, removed):
+        port_domains = self._apps.pop(app_id, {})
+        for port, domains in port_domains.items():
+            for domain in domains:
+                owners = self._owners[domain]
+                owners.discard((app_id, port))
+                if not owners:
+                    del self._owners[domain]
+                    removed.add(domain)
@@ -0,0 +1,139 @@
+from collections import deque
+
+from twisted.internet.defer import maybeDeferred
+from twisted.logger import Logger
+
+
+class EventQueue(object):
+    """
+    A bounded queue of events between the event stream and the functions that
+    handle the events. Events are handled one at a time: if a handler returns
+    a deferred, the next event is only handled once that deferred has fired.
+
+    When the queue is full, the producer of events (usually the
+    ``SseProtocol``) is paused until the queue has drained to half its
+    maximum depth. Events that arrive while the queue is full anyway, for
+    example from data that was already received when the producer was paused,
+    are dropped.
+    """
+
+    log = Logger()
+
+    def __init__(self, callbacks, max_depth=100, coalesce=()):
+        """
+        :param callbacks:
+            A dict mapping event types to functions that handle the event data.
+            The functions may return a deferred.
+        :param max_depth:
+            The maximum number of events waiting to be handled.
+        :param coalesce:
+            The event types for which only the most recent of several waiting
+            events needs to be handled. An event of one of these types replaces
+            an event of the same type that is already waiting rather than
+            being added to the queue. May also be a dict mapping the event
+            types to functions that take the event data and return a key, in
+            which case only a waiting event with the same key is replaced.
+        """
+        self.callbacks = callbacks
+        self.max_depth = max_depth
+        if not isinstance(coalesce, dict):
+            coalesce = dict((event_type, None) for event_type in coalesce)
+        self.coalesce = coalesce
+
+        # The number of events coalesced with a waiting event and the number
+        # dropped because the queue was full
+        self.coalesced = 0
+        self.dropped = 0
+
+        self._pending = deque()
+        self._handling = None
+        self._looping = False
+        self._producer = None
+        self._paused = False
+
+    @property
+    def depth(self):
+        """ The number of events waiting to be handled. """
+        return len(self._pending)
+
+    def set_producer(self, producer):
+        """
+        Set the producer of events, which is paused while the queue is full.
+
+        :param producer:
+            An object with ``pauseProducing()`` and ``resumeProducing()``
+            methods, or None if there is no producer.
+        """
+        self._producer = producer
+        self._paused = False
+        self._maybe_pause()
+
+    def put(self, event_type, data):
+        """
+        Add an event to the queue.
+
+        :param event_type: The type of the event.
+        :param data: The event data that is passed to the event's handler.
+        """
+        if event_type in self.coalesce:
+            key = self.coalesce[event_type]
+            for i, (pending_type, pending_data) in enumerate(self._pending):
+                if pending_type != event_type:
+                    continue
+                if key is None or key(pending_data) == key(data):
+                    self._pending[i] = (event_type, data)
+                    self.coalesced += 1
+                    return
+
+        if len(self._pending) >= self.max_depth:
+            self.dropped += 1
+            self.log.warn(
+                'Event queue full, dropping {event_type} event ({dropped} '
+                'dropped so far)', event_type=event_type, dropped=self.dropped)
+            return
+
+        self._pending.append((event_type, data))
+        self._maybe_pause()
+        self._handle_pending()
+
+    def _maybe_pause(self):
+        if (self._producer is not None and not self._paused and
+                len(self._pending) >= self.max_depth):
+            self.log.info('Event queue full, pausing the event stream')
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def _maybe_resume(self):
+        if self._paused and len(self._pending) <= self.max_depth // 2:
+            self.log.info('Event queue drained, resuming the event stream')
+            self._paused = False
+            self._producer.resumeProducing()
+
+    def _handle_pending(self):
+        # Loop rather than recurse so that handlers that return synchronously
+        # don't grow the stack
+        if self._looping:
+            return
+        self._looping = True
+        try:
+            while self._pending and self._handling is None:
+                event_type, data = self._pending.popleft()
+                self._maybe_resume()
+
+                d = maybeDeferred(self.callbacks[event_type], data)
+                d.addErrback(self._log_handler_failure, event_type)
+                # Don't check whether the deferred has been called: one that
+                # has been called with another deferred that hasn't fired yet
+                # is still waiting. Rather let the callback say when it's done.
+                self._handling = d
+                d.addCallback(self._handled)
+        finally:
+            self._looping = False
+
+    def _handled(self, _):
+        self._handling = None
+        self._handle_pending()
+
+    def _log_handler_failure(self, failure, event_type):
+        self.log.failure('Error handling {event_type} event', failure,
+                         event_type=event_type)
@@ -0,0 +1,199 @@
+import random
+from functools import partial
+
+from twisted.internet.defer import Deferred
+from twisted.logger import Logger
+
+
+class EventStreamSupervisor(object):
+    """
+    Keeps a connection to Marathon's event stream open, reconnecting with a
+    jittered exponential backoff whenever the connection is lost or fails.
+
+    Each connection attempt is started afresh rather than from the callback of
+    the previous connection's deferred, so no chain of deferreds builds up and
+    memory use stays flat no matter how many times we reconnect.
+
+    Events are put on an ``EventQueue`` rather than handled as they are
+    parsed, and the connection is paused while the queue is full.
+    """
+
+    STOPPED = 'stopped'
+    CONNECTING = 'connecting'
+    CONNECTED = 'connected'
+    WAITING = 'waiting'
+
+    log = Logger()
+
+    def __init__(self, marathon_client, event_queue, reactor,
+                 on_connecting=None, on_skipped=None, min_delay=1.0,
+                 max_delay=60.0,
+                 jitter=0.5, random=random.random):
+        """
+        :param marathon_client: The Marathon API client.
+        :param event_queue:
+            The ``EventQueue`` to put events on. Only the event types that the
+            queue has callbacks for are listened for.
+        :param reactor: The reactor to use to schedule reconnections.
+        :param on_connecting:
+            A callable that is called before each connection attempt with
+            True if the attempt resumes the stream from the last event ID, or
+            False if it starts a new stream.
+        :param on_skipped:
+            A callable that is called with the event type when an event that
+            the queue has a callback for is skipped because it is too large.
+        :param min_delay:
+            The delay in seconds before the second of several consecutive
+            reconnection attempts. The first attempt is made immediately and
+            the delay doubles for each attempt after the second.
+        :param max_delay:
+            The maximum delay in seconds between reconnection attempts. Once a
+            connection has been open for this long, the backoff is reset.
+        :param jitter:
+            The maximum fraction of each delay that is randomly taken off so
+            that several instances don't reconnect in lockstep.
+        :param random: A callable that returns a random float in [0, 1).
+        """
+        self.marathon_client = marathon_client
+        self.event_queue = event_queue
+        self.callbacks = dict(
+            (event_type, partial(event_queue.put, event_type))
+            for event_type in event_queue.callbacks)
+        self.reactor = reactor
+        self.on_connecting = on_connecting
+        self.on_skipped = on_skipped
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._random = random
+
+        self.state = self.STOPPED
+        self.reconnects = 0
+        self.last_event_id = None
+
+        # The number of reconnection attempts since the last stable connection
+        self._attempts = 0
+        # The reconnection time (in seconds) requested by the server, if any
+        self._reconnection_time = 0
+        self._connected_at = None
+
+        self._connecting = None
+        self._protocol = None
+        self._delayed_call = None
+        self._stopped = None
+
+    def start(self):
+        """
+        Start listening for events.
+
+        :return: A deferred that fires when ``stop()`` is called.
+        """
+        if self._stopped is not None:
+            raise RuntimeError('Already listening for events')
+
+        self._stopped = Deferred()
+        self._connect()
+        return self._stopped
+
+    def stop(self):
+        """
+        Stop listening for events, closing the connection to the event stream
+        or cancelling a pending reconnection.
+        """
+        if self._stopped is None:
+            return
+
+        self.state = self.STOPPED
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+        if self._connecting is not None:
+            self._connecting.cancel()
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+
+        d, self._stopped = self._stopped, None
+        d.callback(None)
+
+    def _connect(self):
+        self._delayed_call = None
+        resuming = self.last_event_id is not None
+        if resuming:
+            self.log.info(
+                'Resuming listening for events from Marathon from event ID '
+                '"{event_id}"...', event_id=self.last_event_id)
+        else:
+            self.log.info('Listening for events from Marathon...')
+
+        if self.on_connecting is not None:
+            self.on_connecting(resuming)
+
+        self.state = self.CONNECTING
+        d = self.marathon_client.connect_events(
+            self.callbacks, last_event_id=self.last_event_id,
+            skipped_callback=self.on_skipped)
+        self._connecting = d
+        d.addCallbacks(self._connected, self._connect_failed)
+
+    def _connected(self, protocol):
+        self._connecting = None
+        self._protocol = protocol
+        self._connected_at = self.reactor.seconds()
+        self.state = self.CONNECTED
+        self.event_queue.set_producer(protocol)
+        protocol.when_finished().addCallback(self._disconnected, protocol)
+
+    def _connect_failed(self, failure):
+        self._connecting = None
+        if self.state == self.STOPPED:
+            # We cancelled the connection attempt
+            return
+
+        self.log.failure('Failed to listen for events', failure)
+        self._reconnect()
+
+    def _disconnected(self, _, protocol):
+        self._protocol = None
+        self.event_queue.set_producer(None)
+        self.last_event_id = protocol.last_event_id
+        if protocol.reconnection_time is not None:
+            self._reconnection_time = protocol.reconnection_time / 1000.0
+
+        if self.state == self.STOPPED:
+            return
+
+        # If the connection was stable then start backing off from scratch
+        if self.reactor.seconds() - self._connected_at >= self.max_delay:
+            self._attempts = 0
+
+        self.log.warn('Connection lost listening for events')
+        self._reconnect()
+
+    def _reconnect(self):
+        delay = self._next_delay()
+        self._attempts += 1
+        self.reconnects += 1
+
+        self.log.warn('Reconnecting in {delay:.2f}s... ({reconnects} so far)',
+                      delay=delay, reconnects=self.reconnects)
+        if delay > 0:
+            self.state = self.WAITING
+            self._delayed_call = self.reactor.callLater(delay, self._connect)
+        else:
+            self._connect()
+
+    def _next_delay(self):
+        """
+        Get the delay before the next reconnection attempt: a jittered,
+        exponentially increasing delay capped at ``max_delay``, but no less
+        than the reconnection time requested by the server.
+        """
+        if self._attempts == 0:
+            backoff = 0
+        else:
+            # Limit the exponent so that the delay can't overflow
+            exponent = min(self._attempts - 1, 32)
+            backoff = min(self.max_delay, self.min_delay * 2 ** exponent)
+            backoff -= backoff * self.jitter * self._random()
+
+        return max(backoff, self._reconnection_time)
@@ -0,0 +1,128 @@
+import json
+
+from twisted.logger import Logger
+
+
+class FailureCache(object):
+    """
+    Remembers domains that certificates persistently fail to be issued for,
+    so that issuance for them can be retried with exponential backoff rather
+    than on every sync. A domain's entry is reset if the names for its
+    certificate change, e.g. because the app's domain label was changed.
+
+    If a path is given, the cache is saved to it as JSON whenever it changes
+    and loaded from it on creation so that it survives restarts.
+    """
+
+    log = Logger()
+
+    def __init__(self, reactor, path=None, base_delay=60.0,
+                 max_delay=24 * 3600.0):
+        """
+        :param reactor: The reactor to use to tell the time.
+        :param path:
+            The ``FilePath`` to persist the cache to, or None to only keep it
+            in memory.
+        :param base_delay:
+            The number of seconds to suppress retries for after the first
+            failure. This doubles with each failure after that.
+        :param max_delay:
+            The maximum number of seconds to suppress retries for.
+        """
+        self.reactor = reactor
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # The number of issuances that were suppressed
+        self.suppressed = 0
+
+        # domain -> dict of the error, attempts, retry time and names
+        self._entries = {}
+        if path is not None and path.exists():
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, domain):
+        """
+        Get the entry for a domain: a dict with the ``error`` code of the last
+        failure, the number of failed ``attempts``, the time to ``retry_at``
+        and the ``names`` that the certificate was for, or None if there is no
+        entry.
+        """
+        entry = self._entries.get(domain)
+        return dict(entry) if entry is not None else None
+
+    def should_skip(self, domain, names):
+        """
+        Check whether issuance for a domain should be skipped because it
+        failed recently. If the names for the certificate have changed since
+        it failed, the entry is reset and issuance isn't skipped.
+
+        :param names: The names that the certificate should cover.
+        """
+        entry = self._entries.get(domain)
+        if entry is None:
+            return False
+
+        if entry['names'] != list(names):
+            self.log.info(
+                'Names for "{domain}" changed, retrying issuance',
+                domain=domain)
+            self.record_success(domain)
+            return False
+
+        if entry['retry_at'] <= self.reactor.seconds():
+            return False
+
+        self.suppressed += 1
+        return True
+
+    def record_failure(self, domain, names, error):
+        """
+        Record that issuance failed for a domain.
+
+        :param names: The names that the certificate was for.
+        :param error: The ACME error code of the failure.
+        :return: The number of seconds that retries will be suppressed for.
+        """
+        entry = self._entries.get(domain)
+        attempts = 1
+        if entry is not None and entry['names'] == list(names):
+            attempts = entry['attempts'] + 1
+
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        self._entries[domain] = {
+            'error': error,
+            'attempts': attempts,
+            'retry_at': self.reactor.seconds() + delay,
+            'names': list(names),
+        }
+        self._save()
+        return delay
+
+    def record_success(self, domain):
+        """ Forget any failures for a domain. """
+        if self._entries.pop(domain, None) is not None:
+            self._save()
+
+    def _load(self):
+        try:
+            self._entries = json.loads(self.path.getContent().decode('utf-8'))
+        except (IOError, OSError, ValueError) as e:
+            self.log.warn(
+                'Unable to load the failure cache from "{path}", starting '
+                'with an empty cache: {error}', path=self.path.path, error=e)
+            self._entries = {}
+
+    def _save(self):
+        if self.path is None:
+            return
+        content = json.dumps(self._entries, sort_keys=True).encode('utf-8')
+        try:
+            self.path.setContent(content)
+        except (IOError, OSError) as e:
+            self.log.warn('Unable to save the failure cache to "{path}": '
+                          '{error}', path=self.path.path, error=e)
@@ -0,0 +1,283 @@
+from collections import deque
+
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+
+from marathon_acme.rate_limiter import RateLimitedError
+
+
+class LaneStats(object):
+    """ Metrics for the issuances started from one priority lane. """
+
+    def __init__(self):
+        # The number of issuances started, and the total and maximum number of
+        # seconds that they waited for
+        self.started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def mean_wait(self):
+        """ The mean number of seconds that started issuances waited for. """
+        if not self.started:
+            return 0.0
+        return self.total_wait / self.started
+
+    def record(self, wait):
+        self.started += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class IssuanceQueue(object):
+    """
+    A queue of certificate issuances that runs at most a fixed number of
+    issuances at a time. A domain that is submitted while it is already
+    waiting or being issued joins that issuance rather than starting another.
+
+    Issuances wait in priority lanes: first issues for new domains, renewals
+    of certificates close to expiry, and early renewals. Issuances in a lane
+    only start once nothing in the lanes above it can, and renewals never
+    take the last free slot, so a new domain doesn't have to wait for a wave
+    of renewals to finish. ACME orders that have started can't be safely
+    interrupted, so running issuances are never preempted.
+
+    If a rate limiter is given, domains are held in the queue until the rate
+    limits allow a certificate to be issued for them. The deferreds for held
+    domains fail with ``RateLimitedError`` so that callers aren't kept waiting,
+    but the domains keep their place in the queue and are issued later. An
+    issuance that fails with ``RateLimitedError`` is recorded with the rate
+    limiter and its domain is held in the same way.
+    """
+
+    FIRST_ISSUE = 0
+    RENEW_URGENT = 1
+    RENEW_EARLY = 2
+    PRIORITIES = (FIRST_ISSUE, RENEW_URGENT, RENEW_EARLY)
+
+    log = Logger()
+
+    def __init__(self, issue, reactor, concurrency=4, rate_limiter=None):
+        """
+        :param issue:
+            The function that issues a certificate for a domain. It may return
+            a deferred, which should only fire once issuance is complete. It
+            must fail if the order fails: only issuances that succeed count
+            towards the rate limit.
+        :param reactor: The reactor to use to measure wait times.
+        :param concurrency:
+            The maximum number of certificates to issue at once.
+        :param rate_limiter:
+            The ``RateLimiter`` to check before issuing certificates, if any.
+        """
+        self._issue = issue
+        self.reactor = reactor
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+
+        # The number of issuances running, the number started, the number of
+        # submissions that joined an issuance in flight, and the total and
+        # maximum number of seconds that started issuances waited for
+        self.active = 0
+        self.started = 0
+        self.joined = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # Metrics for each priority lane
+        self.lane_stats = dict((p, LaneStats()) for p in self.PRIORITIES)
+
+        # A deque of (domain, time submitted) for each priority lane
+        self._lanes = dict((p, deque()) for p in self.PRIORITIES)
+        # domain -> priority of the lane that the domain is waiting in
+        self._priorities = {}
+        # domain -> list of deferreds waiting for the issuance's result
+        self._in_flight = {}
+        # domain -> time that the domain is held until
+        self._held = {}
+        self._starting = False
+        self._delayed_call = None
+
+    @property
+    def depth(self):
+        """ The number of issuances waiting to start. """
+        return len(self._priorities)
+
+    @property
+    def held(self):
+        """ The number of waiting issuances held because of rate limits. """
+        return len(self._held)
+
+    def lane_depth(self, priority):
+        """ The number of issuances waiting to start in a priority lane. """
+        return len(self._lanes[priority])
+
+    def in_flight(self, domain):
+        """ Check whether a domain is waiting or being issued. """
+        return domain in self._in_flight
+
+    def projected_completion(self):
+        """
+        Project the time that all the waiting issuances will have started,
+        according to the rate limits.
+
+        :return:
+            The time in seconds since the epoch, or None if there is no rate
+            limiter.
+        """
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.projected_completion(
+            [domain for p in self.PRIORITIES for domain, _ in self._lanes[p]])
+
+    def stop(self):
+        """ Stop waiting to retry held issuances. """
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+
+    def submit(self, domain, priority=FIRST_ISSUE):
+        """
+        Submit a domain to have a certificate issued for it.
+
+        :param priority:
+            The priority lane to wait in. If the domain is already waiting in
+            a lower priority lane, it is moved up to this one.
+        :return:
+            A deferred that fires with the result of issuing the certificate
+            once that is complete.
+        """
+        if priority < self._priorities.get(domain, priority):
+            self._promote(domain, priority)
+
+        if domain in self._held:
+            self.joined += 1
+            return fail(RateLimitedError(
+                domain, self._held[domain] - self.reactor.seconds()))
+
+        d = Deferred()
+        if domain in self._in_flight:
+            self.joined += 1
+            self.log.debug(
+                'Certificate for "{domain}" is already being issued, waiting '
+                'for that', domain=domain)
+            self._in_flight[domain].append(d)
+            self._start_waiting()
+            return d
+
+        self._in_flight[domain] = [d]
+        self._priorities[domain] = priority
+        self._lanes[priority].append((domain, self.reactor.seconds()))
+        self._start_waiting()
+        return d
+
+    def _promote(self, domain, priority):
+        lane = self._lanes[self._priorities[domain]]
+        entry = next(entry for entry in lane if entry[0] == domain)
+        lane.remove(entry)
+        self._lanes[priority].append(entry)
+        self._priorities[domain] = priority
+
+    def _start_waiting(self):
+        # Issuances that finish synchronously would otherwise start the next
+        # one recursively
+        if self._starting:
+            return
+        self._starting = True
+        try:
+            self._start_loop()
+        finally:
+            self._starting = False
+
+    def _start_loop(self):
+        now = self.reactor.seconds()
+        held_until = []
+        for priority in self.PRIORITIES:
+            lane = self._lanes[priority]
+            # Renewals leave a slot free for new domains
+            limit = self.concurrency
+            if priority != self.FIRST_ISSUE and self.concurrency > 1:
+                limit -= 1
+
+            held = deque()
+            while lane and self.active < limit:
+                domain, submitted = lane.popleft()
+                if self.rate_limiter is not None:
+                    available_at = self.rate_limiter.available_at(domain)
+                    if available_at > now:
+                        self._hold(domain, available_at)
+                        held.append((domain, submitted))
+                        held_until.append(available_at)
+                        continue
+                self._start(domain, submitted, priority)
+
+            # Held domains keep their place at the front of the lane
+            lane.extendleft(reversed(held))
+
+        # Check again once the first held domain is available
+        if held_until:
+            self._retry_at(min(held_until))
+
+    def _hold(self, domain, until):
+        if domain not in self._held:
+            self.log.warn(
+                'Holding certificate for "{domain}" for {delay:.0f}s because '
+                'of rate limits', domain=domain,
+                delay=until - self.reactor.seconds())
+        self._held[domain] = until
+
+        # Don't keep anyone waiting for the held domain
+        waiting, self._in_flight[domain] = self._in_flight[domain], []
+        for d in waiting:
+            d.errback(RateLimitedError(
+                domain, until - self.reactor.seconds()))
+
+    def _retry_at(self, when):
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+        self._delayed_call = self.reactor.callLater(
+            when - self.reactor.seconds(), self._retry)
+
+    def _retry(self):
+        self._delayed_call = None
+        self._start_waiting()
+
+    def _start(self, domain, submitted, priority):
+        del self._priorities[domain]
+        self._held.pop(domain, None)
+        if self.rate_limiter is not None:
+            self.rate_limiter.record_order()
+
+        wait = self.reactor.seconds() - submitted
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.lane_stats[priority].record(wait)
+        self.active += 1
+        self.started += 1
+        self.log.debug(
+            'Issuing certificate for "{domain}" after waiting {wait:.1f}s '
+            '({active} active, {depth} waiting)', domain=domain,
+            wait=wait, active=self.active, depth=self.depth)
+
+        issued = maybeDeferred(self._issue, domain)
+        issued.addBoth(self._finished, domain, priority)
+
+    def _finished(self, result, domain, priority):
+        self.active -= 1
+        if self.rate_limiter is not None:
+            if not isinstance(result, Failure):
+                self.rate_limiter.record_issued(domain)
+            elif result.check(RateLimitedError):
+                self.rate_limiter.rate_limited(
+                    domain, result.value.retry_after)
+                # Wait at the front of the lane to be held
+                self._priorities[domain] = priority
+                self._lanes[priority].appendleft(
+                    (domain, self.reactor.seconds()))
+                self._start_waiting()
+                return
+
+        waiting = self._in_flight.pop(domain)
+        self._start_waiting()
+        for d in waiting:
+            d.callback(result)
@@ -0,0 +1,346 @@
+import codecs
+import json
+import re
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import connectionDone, Protocol
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+
+_WHITESPACE = ' \t\n\r'
+# The characters that can follow a complete scalar value
+_DELIMITERS = ',}]' + _WHITESPACE
+_skip_whitespace = re.compile(r'[ \t\n\r]*').match
+# The characters that matter when scanning for the end of an object, array or
+# string: those that start or end one, and the escape character in a string
+_find_structure = re.compile(r'["{}\[\]]').search
+_find_string_special = re.compile(r'["\\]').search
+# The rest of a string after its opening quote, up to its closing quote
+_match_string_rest = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL).match
+
+
+class JsonFieldStreamProtocol(Protocol):
+    """
+    A protocol that incrementally parses a JSON object of the form
+    ``{"field": [element, ...]}`` from a response body, calling a handler
+    with each element of the array as soon as it has been received.
+
+    Only the element currently being received is buffered, so the memory used
+    doesn't grow with the length of the array. Each element is parsed with
+    the standard library's JSON decoder. An element that isn't complete in
+    the data received so far is scanned for its end as each chunk arrives,
+    keeping track of the nesting depth and whether the scan is inside a
+    string, and the chunks are kept in a list until it is complete. So each
+    chunk is only scanned once, however many chunks the element spans. Other
+    fields in the object are parsed and thrown away.
+    """
+
+    log = Logger()
+
+    def __init__(self, field, handler):
+        """
+        :param field: The name of the field with the array to stream.
+        :param handler:
+            A callable that is called with each element of the array.
+        """
+        self.field = field
+        self._handler = handler
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._raw_decode = json.JSONDecoder().raw_decode
+        self._buffer = ''
+        self._state = self._start
+
+        # The chunks of an object, array or string value that isn't complete
+        # yet, the function to call with the value once it is, and the state
+        # of the scan for its end
+        self._chunks = None
+        self._value_done = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+        self._current_key = None
+        self._found = False
+        self._failure = None
+        self._waiting = []
+
+        # The number of elements parsed
+        self.elements = 0
+
+    def when_finished(self):
+        """
+        Get a deferred that fires with the number of elements parsed once the
+        whole body has been parsed, or fails if the body couldn't be parsed
+        or the field wasn't found.
+        """
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def dataReceived(self, data):
+        if self._failure is not None:
+            return
+
+        try:
+            self._feed(self._decoder.decode(data))
+        except Exception:
+            self._failure = Failure()
+            self._buffer = ''
+            self._chunks = None
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason=connectionDone):
+        failure = self._failure
+        if failure is None and not reason.check(ResponseDone):
+            failure = reason
+        if failure is None:
+            try:
+                self._feed(self._decoder.decode(b'', final=True))
+                self._finish()
+            except Exception:
+                failure = Failure()
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            if failure is None:
+                d.callback(self.elements)
+            else:
+                d.errback(failure)
+
+    def _feed(self, text):
+        if self._chunks is not None:
+            # Only scan the new text for the end of the value
+            end = self._scan(text, 0)
+            if end is None:
+                self._chunks.append(text)
+                return
+            self._chunks.append(text[:end])
+            self._buffer = text[end:]
+            self._value_complete(''.join(self._chunks))
+        else:
+            self._buffer += text
+        self._parse()
+
+    def _finish(self):
+        if (self._state != self._done or self._chunks is not None or
+                self._buffer.strip(_WHITESPACE)):
+            raise ValueError(
+                'Invalid or incomplete JSON object in response body')
+        if not self._found:
+            raise KeyError(
+                'Unable to get value for "%s" from Marathon response'
+                % (self.field,))
+
+    def _parse(self):
+        pos = 0
+        while True:
+            pos = self._skip_whitespace(pos)
+            if pos == len(self._buffer):
+                break
+            new_pos = self._state(pos)
+            if new_pos is None:
+                break
+            pos = new_pos
+        self._buffer = self._buffer[pos:]
+
+    def _skip_whitespace(self, pos):
+        return _skip_whitespace(self._buffer, pos).end()
+
+    def _expect(self, pos, chars):
+        char = self._buffer[pos]
+        if char not in chars:
+            raise ValueError(
+                'Expected one of %r in JSON at %r' % (
+                    chars, self._buffer[pos:pos + 20]))
+        return char
+
+    def _read_value(self, pos, done):
+        """
+        Read the JSON value starting at ``pos``, calling ``done`` with the
+        value once it is complete. Returns the position after whatever was
+        consumed, or None if more data is needed.
+        """
+        if self._buffer[pos] not in '{["':
+            decoded = self._decode(pos)
+            if decoded is None:
+                return None
+            value, end = decoded
+            done(value)
+            return end
+
+        # Most values are complete in the data we have, and the decoder finds
+        # that quickest
+        try:
+            value, end = self._raw_decode(self._buffer, pos)
+        except ValueError:
+            pass
+        else:
+            done(value)
+            return end
+
+        # Otherwise scan what we have once, keep it, and from now on only scan
+        # new data until the value is complete
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._value_done = done
+        end = self._scan(self._buffer, pos)
+        if end is None:
+            self._chunks = [self._buffer[pos:]]
+            return len(self._buffer)
+
+        # Complete, but invalid
+        self._value_complete(self._buffer[pos:end])
+        return end
+
+    def _value_complete(self, text):
+        done = self._value_done
+        self._chunks = None
+        self._value_done = None
+        done(json.loads(text))
+
+    def _scan(self, text, pos):
+        """
+        Scan ``text`` from ``pos`` for the end of the object, array or string
+        being read, continuing from the state left by previous scans. Returns
+        the position after the end of the value, or None if it doesn't end
+        in ``text``.
+        """
+        depth, in_string = self._depth, self._in_string
+        end = len(text)
+        if self._escaped:
+            # The previous text ended with the escape character
+            self._escaped = False
+            pos += 1
+
+        while pos < end:
+            if in_string:
+                match = _find_string_special(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                if match.group() == '\\':
+                    if pos == end:
+                        self._escaped = True
+                        break
+                    pos += 1
+                    continue
+                in_string = False
+                if depth == 0:
+                    return pos
+            else:
+                match = _find_structure(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    # Skip over the whole string if it ends in this text
+                    match = _match_string_rest(text, pos)
+                    if match is None:
+                        in_string = True
+                        continue
+                    pos = match.end()
+                    if depth == 0:
+                        return pos
+                elif char in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth <= 0:
+                        return pos
+
+        self._depth, self._in_string = depth, in_string
+        return None
+
+    def _decode(self, pos):
+        """
+        Decode the scalar JSON value starting at ``pos``. Returns the value
+        and the position after it, or None if the value isn't complete yet.
+        Scalar values are only complete once a delimiter follows them: a
+        number like ``1.5`` may be received as ``1.`` and then ``5``.
+        """
+        try:
+            value, end = self._raw_decode(self._buffer, pos)
+        except ValueError:
+            # Incomplete, or invalid. Invalid values are only found to be
+            # invalid once the whole body has been received.
+            return None
+        if end == len(self._buffer) or self._buffer[end] not in _DELIMITERS:
+            return None
+        return value, end
+
+    # States: each takes the position of the next non-whitespace character
+    # and returns the position after whatever it consumed, or None if more
+    # data is needed.
+
+    def _start(self, pos):
+        self._expect(pos, '{')
+        self._state = self._key_or_end
+        return pos + 1
+
+    def _key_or_end(self, pos):
+        if self._buffer[pos] == '}':
+            self._state = self._done
+            return pos + 1
+        return self._key(pos)
+
+    def _key(self, pos):
+        self._expect(pos, '"')
+        return self._read_value(pos, self._key_read)
+
+    def _key_read(self, key):
+        self._current_key = key
+        self._state = self._colon
+
+    def _colon(self, pos):
+        self._expect(pos, ':')
+        self._state = self._value
+        return pos + 1
+
+    def _value(self, pos):
+        if self._current_key == self.field:
+            self._expect(pos, '[')
+            self._found = True
+            self._state = self._element_or_end
+            return pos + 1
+
+        return self._read_value(pos, self._value_read)
+
+    def _value_read(self, value):
+        self._state = self._separator_or_end
+
+    def _separator_or_end(self, pos):
+        if self._expect(pos, ',}') == ',':
+            self._state = self._key
+        else:
+            self._state = self._done
+        return pos + 1
+
+    def _element_or_end(self, pos):
+        if self._buffer[pos] == ']':
+            self._state = self._separator_or_end
+            return pos + 1
+        return self._element(pos)
+
+    def _element(self, pos):
+        return self._read_value(pos, self._element_read)
+
+    def _element_read(self, element):
+        self.elements += 1
+        self._state = self._element_separator_or_end
+        self._handler(element)
+
+    def _element_separator_or_end(self, pos):
+        if self._expect(pos, ',]') == ',':
+            self._state = self._element
+        else:
+            self._state = self._separator_or_end
+        return pos + 1
+
+    def _done(self, pos):
+        raise ValueError(
+            'Unexpected data after JSON object: %r' % (
+                self._buffer[pos:pos + 20],))
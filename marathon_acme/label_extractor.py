@@ -0,0 +1,118 @@
+import re
+
+
+def parse_domain_label(domain_label):
+    """ Parse the list of comma-separated domains from the app label. """
+    domains = []
+    for domain_string in domain_label.split(','):
+        domain = domain_string.strip()
+        if domain:
+            domains.append(domain)
+    return domains
+
+
+class LabelExtractor(object):
+    """
+    Extracts the marathon-lb group and domains for each port of Marathon
+    apps from their labels.
+
+    Each app's labels are scanned once with a precompiled pattern for the
+    ``HAPROXY_{n}_GROUP`` and ``MARATHON_ACME_{n}_DOMAIN`` labels, rather
+    than looking up the labels for every port. Domain labels are mostly the
+    same from one sync to the next, so parsed labels are memoized by their
+    raw value.
+    """
+
+    # Matches the labels that we're interested in, capturing the port index.
+    # Port indexes are formatted without leading zeros, so don't match those.
+    LABEL_PATTERN = re.compile(
+        r'(?:HAPROXY_(0|[1-9][0-9]*)_GROUP'
+        r'|MARATHON_ACME_(0|[1-9][0-9]*)_DOMAIN)\Z')
+
+    def __init__(self, groups, selector=None, max_cached_labels=100000):
+        """
+        :param groups:
+            The names of the marathon-lb groups to extract domains for.
+        :param selector:
+            A ``LabelSelector`` that apps' labels must match for their domains
+            to be extracted, or None to extract the domains of all apps.
+        :param max_cached_labels:
+            The maximum number of parsed domain labels to remember. The memo
+            is cleared when it grows past this.
+        """
+        self.groups = frozenset(groups)
+        self.selector = selector
+        self.max_cached_labels = max_cached_labels
+
+        # raw domain label -> tuple of domains
+        self._parsed_labels = {}
+
+    def extract(self, app):
+        """
+        Find the group and domains for each port of an app that is in one of
+        our groups and has domains.
+
+        :return: A dict mapping port indexes to (group, domains) tuples.
+        """
+        labels = app['labels']
+        if self.selector is not None and not self.selector.matches(labels):
+            return {}
+
+        # Prefer the 'portDefinitions' field added in Marathon 1.0.0 but fall
+        # back to the deprecated 'ports' array if that's not present.
+        if 'portDefinitions' in app:
+            num_ports = len(app['portDefinitions'])
+        else:
+            num_ports = len(app['ports'])
+
+        port_groups = {}
+        domain_labels = {}
+        match = self.LABEL_PATTERN.match
+        for key, value in labels.items():
+            m = match(key)
+            if m is None:
+                continue
+            group_index, domain_index = m.groups()
+            if group_index is not None:
+                port_groups[int(group_index)] = value
+            else:
+                domain_labels[int(domain_index)] = value
+
+        app_ports = {}
+        if not domain_labels:
+            return app_ports
+
+        # Get the port group label, defaulting to the app group label
+        app_group = labels.get('HAPROXY_GROUP')
+        for port_index, domain_label in domain_labels.items():
+            if port_index >= num_ports:
+                continue
+            port_group = port_groups.get(port_index, app_group)
+            if port_group not in self.groups:
+                continue
+
+            port_domains = self._parse(domain_label)
+            if port_domains:
+                app_ports[port_index] = (port_group, port_domains)
+
+        return app_ports
+
+    def extract_all(self, apps):
+        """
+        Find the group and domains for each port of a list of apps.
+
+        :return:
+            A dict mapping app IDs to dicts mapping port indexes to (group,
+            domains) tuples, for every app.
+        """
+        extract = self.extract
+        return dict((app['id'], extract(app)) for app in apps)
+
+    def _parse(self, domain_label):
+        domains = self._parsed_labels.get(domain_label)
+        if domains is None:
+            if len(self._parsed_labels) >= self.max_cached_labels:
+                self._parsed_labels.clear()
+            domains = tuple(parse_domain_label(domain_label))
+            self._parsed_labels[domain_label] = domains
+        return list(domains)
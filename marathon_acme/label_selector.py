@@ -0,0 +1,109 @@
+import re
+
+
+_EQUALITY_TERM = re.compile(
+    r'((?:\\.|[^\\=!])+?)\s*(==|!=)\s*(.*)\Z', re.DOTALL)
+_SET_TERM = re.compile(
+    r'((?:\\.|[^\\\s])+)\s+(in|notin)\s*\((.*)\)\Z', re.DOTALL)
+_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+
+
+def _unescape(value):
+    return _ESCAPE.sub(r'\1', value.strip())
+
+
+def _split(text, separator):
+    """
+    Split text on a separator character that isn't escaped with a backslash
+    or inside parentheses.
+    """
+    parts = []
+    part = []
+    depth = 0
+    chars = iter(text)
+    for char in chars:
+        if char == '\\':
+            part.append(char)
+            part.append(next(chars, ''))
+            continue
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(''.join(part))
+            part = []
+            continue
+        part.append(char)
+    parts.append(''.join(part))
+    return parts
+
+
+class LabelSelector(object):
+    """
+    A Marathon label selector, as accepted by the ``label`` query parameter
+    of Marathon's ``/v2/apps`` endpoint. A selector is a comma-separated list
+    of terms that all have to match an app's labels:
+
+    * ``KEY``: the label exists
+    * ``KEY==VALUE`` or ``KEY!=VALUE``: the label exists and does or doesn't
+      have the value
+    * ``KEY in (VALUE, ...)`` or ``KEY notin (VALUE, ...)``: the label exists
+      and does or doesn't have one of the values
+
+    Special characters in keys and values can be escaped with a backslash.
+    Selectors are matched locally as well as by Marathon so that apps from
+    the event stream are filtered the same way as apps fetched in a sync.
+    """
+
+    def __init__(self, selector):
+        """
+        :param selector: The label selector string.
+        :raises ValueError: If the selector isn't valid.
+        """
+        self.selector = selector
+        self._terms = [self._parse_term(term)
+                       for term in _split(selector, ',')]
+
+    def __repr__(self):
+        return 'LabelSelector(%r)' % (self.selector,)
+
+    def _parse_term(self, term):
+        match = _SET_TERM.match(term.strip())
+        if match is not None:
+            key, op, values = match.groups()
+            return (_unescape(key), op,
+                    frozenset(_unescape(v) for v in _split(values, ',')))
+
+        match = _EQUALITY_TERM.match(term.strip())
+        if match is not None:
+            key, op, value = match.groups()
+            return _unescape(key), op, _unescape(value)
+
+        key = _unescape(term)
+        if not key or re.search(r'(?<!\\)[\s=!()]', term.strip()):
+            raise ValueError(
+                "'%s' is not a valid label selector term in '%s'" % (
+                    term, self.selector))
+        return key, None, None
+
+    def matches(self, labels):
+        """ Check whether a dict of app labels matches the selector. """
+        for key, op, value in self._terms:
+            # Like Marathon, every operator requires the label to exist
+            label = labels.get(key)
+            if label is None:
+                return False
+            elif op == '==':
+                if label != value:
+                    return False
+            elif op == '!=':
+                if label == value:
+                    return False
+            elif op == 'in':
+                if label not in value:
+                    return False
+            elif op == 'notin':
+                if label in value:
+                    return False
+        return True
@@ -0,0 +1,190 @@
+from bisect import insort
+from collections import deque
+
+from twisted.web.http import stringToDatetime
+
+
+class RateLimitedError(Exception):
+    """
+    Raised when a certificate can't be issued for a domain because of rate
+    limits.
+
+    :ivar domain: The domain that the certificate was for.
+    :ivar retry_after:
+        The number of seconds after which issuance can be retried, or None if
+        unknown.
+    """
+
+    def __init__(self, domain, retry_after=None):
+        super(RateLimitedError, self).__init__(domain, retry_after)
+        self.domain = domain
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value, now):
+    """
+    Parse the value of a ``Retry-After`` header, which may either be a number
+    of seconds or an HTTP date.
+
+    :param value: The header value as bytes.
+    :param now: The current time in seconds since the epoch.
+    :return: The number of seconds to wait, or None if it couldn't be parsed.
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, stringToDatetime(value) - now)
+    except (ValueError, IndexError, KeyError):
+        return None
+
+
+def registered_domain(domain):
+    """
+    Get the registered domain for a domain, approximated as its last two
+    labels, e.g. 'example.com' for 'www.example.com'. Let's Encrypt uses the
+    Public Suffix List, so names like 'example.co.uk' are grouped under
+    'co.uk', which only makes the per-domain limit more conservative.
+    """
+    return '.'.join(domain.rsplit('.', 2)[-2:])
+
+
+class RateLimiter(object):
+    """
+    Tracks certificate issuance against Let's Encrypt-style rate limits: a
+    limit on the certificates issued per registered domain, a limit on the
+    orders made by the account, and any ``Retry-After`` times from
+    rate-limit errors returned by the ACME server.
+    """
+
+    def __init__(self, reactor, domain_limit=50, domain_window=7 * 24 * 3600,
+                 account_limit=300, account_window=3 * 3600,
+                 default_retry_after=3600):
+        """
+        :param reactor: The reactor to use to tell the time.
+        :param domain_limit:
+            The number of certificates that can be issued per registered
+            domain in the domain window.
+        :param domain_window: The domain window in seconds.
+        :param account_limit:
+            The number of orders that the account can make in the account
+            window.
+        :param account_window: The account window in seconds.
+        :param default_retry_after:
+            The number of seconds to wait after a rate-limit error without a
+            ``Retry-After`` time.
+        """
+        self.reactor = reactor
+        self.domain_limit = domain_limit
+        self.domain_window = domain_window
+        self.account_limit = account_limit
+        self.account_window = account_window
+        self.default_retry_after = default_retry_after
+
+        # The number of rate-limit errors received from the ACME server
+        self.rate_limited_errors = 0
+
+        # registered domain -> times that certificates were issued
+        self._issued = {}
+        # Times that orders were made
+        self._orders = deque()
+        # registered domain -> time that issuance may be retried
+        self._retry_at = {}
+
+    def available_at(self, domain):
+        """
+        Get the time that a certificate can next be issued for a domain.
+
+        :return:
+            The time in seconds since the epoch. This is no later than the
+            current time if a certificate can be issued now.
+        """
+        self._expire()
+        now = self.reactor.seconds()
+        reg_domain = registered_domain(domain)
+        return max(
+            now, self._retry_at.get(reg_domain, now),
+            self._next_slot(self._issued.get(reg_domain, ()),
+                            self.domain_limit, self.domain_window),
+            self._next_slot(
+                self._orders, self.account_limit, self.account_window))
+
+    def record_order(self):
+        """ Record that an order for a certificate was made. """
+        self._expire()
+        self._orders.append(self.reactor.seconds())
+
+    def record_issued(self, domain):
+        """ Record that a certificate was issued for a domain. """
+        self._expire()
+        self._issued.setdefault(registered_domain(domain), deque()).append(
+            self.reactor.seconds())
+
+    def rate_limited(self, domain, retry_after=None):
+        """
+        Record that the ACME server returned a rate-limit error for a domain.
+
+        :param retry_after:
+            The number of seconds after which issuance can be retried, or None
+            to use the default.
+        """
+        self.rate_limited_errors += 1
+        if retry_after is None:
+            retry_after = self.default_retry_after
+        self._retry_at[registered_domain(domain)] = (
+            self.reactor.seconds() + retry_after)
+
+    def projected_completion(self, domains):
+        """
+        Project the time that certificates will have been issued for all of
+        the given domains, in order, assuming that each issuance succeeds and
+        takes no time.
+
+        :return: The time in seconds since the epoch.
+        """
+        self._expire()
+        now = self.reactor.seconds()
+        # Projected issuances may be out of order, so keep sorted lists
+        issued = dict((reg_domain, list(times))
+                      for reg_domain, times in self._issued.items())
+        orders = list(self._orders)
+
+        completion = now
+        for domain in domains:
+            reg_domain = registered_domain(domain)
+            domain_issued = issued.setdefault(reg_domain, [])
+            at = max(
+                now, self._retry_at.get(reg_domain, now),
+                self._next_slot(
+                    domain_issued, self.domain_limit, self.domain_window),
+                self._next_slot(
+                    orders, self.account_limit, self.account_window))
+            insort(domain_issued, at)
+            insort(orders, at)
+            completion = max(completion, at)
+        return completion
+
+    def _expire(self):
+        """ Drop the times that are outside their windows. """
+        now = self.reactor.seconds()
+        self._expire_times(self._orders, now - self.account_window)
+        for reg_domain, times in list(self._issued.items()):
+            self._expire_times(times, now - self.domain_window)
+            if not times:
+                del self._issued[reg_domain]
+        for reg_domain, retry_at in list(self._retry_at.items()):
+            if retry_at <= now:
+                del self._retry_at[reg_domain]
+
+    def _expire_times(self, times, cutoff):
+        while times and times[0] <= cutoff:
+            times.popleft()
+
+    def _next_slot(self, times, limit, window):
+        """
+        Get the time that the number of the given sorted times in the window
+        will first be below the limit.
+        """
+        if len(times) < limit:
+            return 0
+        return times[-limit] + window
@@ -0,0 +1,87 @@
+import random
+
+from twisted.logger import Logger
+
+
+class Reconciler(object):
+    """
+    Periodically triggers a full sync as a safety net against missed events.
+
+    While things are healthy (for example, the event stream has stayed
+    connected and the last reconciliation found nothing that the events had
+    missed) the interval is doubled after each reconciliation, up to the
+    maximum interval. Otherwise, it is reset to the base interval. Each
+    interval is jittered so that several instances don't sync in lockstep.
+    """
+
+    log = Logger()
+
+    def __init__(self, trigger, reactor, is_healthy=lambda: False,
+                 interval=300.0, max_interval=None, jitter=0.1,
+                 random=random.random):
+        """
+        :param trigger: A callable that triggers a full sync.
+        :param reactor: The reactor to use to schedule reconciliations.
+        :param is_healthy:
+            A callable that returns True if nothing has gone wrong since the
+            last reconciliation, in which case the interval is stretched.
+        :param interval: The base interval between reconciliations in seconds.
+        :param max_interval:
+            The maximum interval between reconciliations in seconds. Defaults
+            to 4 times the base interval.
+        :param jitter:
+            The maximum fraction of each interval that is randomly taken off.
+        :param random: A callable that returns a random float in [0, 1).
+        """
+        self._trigger = trigger
+        self.is_healthy = is_healthy
+        self.base_interval = interval
+        self.max_interval = (
+            max_interval if max_interval is not None else interval * 4)
+        self.jitter = jitter
+        self._random = random
+
+        self.reconciliations = 0
+        # The current interval before jitter is applied
+        self.interval = interval
+
+        self._reactor = reactor
+        self._delayed_call = None
+
+    def start(self):
+        """ Start reconciling periodically, starting after one interval. """
+        if self._delayed_call is not None:
+            raise RuntimeError('Already reconciling')
+
+        self.interval = self.base_interval
+        self._schedule()
+
+    def stop(self):
+        """ Stop reconciling. """
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+
+    def _schedule(self):
+        # Each run is scheduled from the end of the last one, so a change to
+        # the interval takes effect for the very next run
+        delay = self._jittered(self.interval)
+        self._delayed_call = self._reactor.callLater(delay, self._reconcile)
+        return delay
+
+    def _reconcile(self):
+        self._delayed_call = None
+        self.reconciliations += 1
+        if self.is_healthy():
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = self.base_interval
+        delay = self._schedule()
+
+        self.log.info(
+            'Reconciling with a full sync (next in {next:.0f}s)...',
+            next=delay)
+        self._trigger()
+
+    def _jittered(self, interval):
+        return interval - interval * self.jitter * self._random()
@@ -1,52 +1,203 @@
-from twisted.internet.defer import gatherResults
+from twisted.internet.defer import gatherResults, succeed
 from twisted.logger import Logger, LogLevel
 from twisted.python.failure import Failure
 from txacme.challenges import HTTP01Responder
 from txacme.client import ServerError as txacme_ServerError
-from txacme.service import AcmeIssuingService
 
+from marathon_acme.domain_index import DomainIndex
+from marathon_acme.event_queue import EventQueue
+from marathon_acme.event_stream import EventStreamSupervisor
+from marathon_acme.failure_cache import FailureCache
+from marathon_acme.issuance_queue import IssuanceQueue
+from marathon_acme.label_extractor import LabelExtractor
+from marathon_acme.label_selector import LabelSelector
+from marathon_acme.rate_limiter import (
+    RateLimitedError, RateLimiter, parse_retry_after)
+from marathon_acme.reconciler import Reconciler
 from marathon_acme.server import MarathonAcmeServer
-from marathon_acme.acme_util import MlbCertificateStore
+from marathon_acme.sync_scheduler import SyncScheduler
+from marathon_acme.acme_util import (
+    GroupCertificateStore, MlbCertificateStore, pem_cert_names,
+    SanAcmeIssuingService)
 
 
-def parse_domain_label(domain_label):
-    """ Parse the list of comma-separated domains from the app label. """
-    domains = []
-    for domain_string in domain_label.split(','):
-        domain = domain_string.strip()
-        if domain:
-            domains.append(domain)
-    return domains
+# The errors from the ACME server that are logged when issuing a certificate
+# rather than failing a sync
+_LOGGED_ACME_ERRORS = frozenset([
+    'connection', 'dns', 'unknownHost', 'serverInternal'])
+
+
+def _acme_error_code(server_error):
+    """ Get the ACME error code for a txacme ``ServerError``. """
+    # FIXME: The acme error code stuff is a mess pre- the unreleased 0.10
+    # version. Update this to use the 'code' attribute when the new acme
+    # library is released.
+    return str(server_error.message.typ).split(':')[-1]
+
+
+def _for_group(value, group):
+    """
+    Get the value for a group from a dict of values by group, or the value
+    itself if it isn't a dict.
+    """
+    return value[group] if isinstance(value, dict) else value
+
+
+def _api_post_event_app(event):
+    """
+    Get the app definition from an ``api_post_event`` event, or None if the
+    event doesn't have one that the app can be synced from.
+    """
+    app = event.get('appDefinition')
+    if app is None or 'labels' not in app:
+        return None
+    return app
+
+
+def _api_post_event_app_id(event):
+    """
+    Get the ID of the app that an ``api_post_event`` event syncs, or None if
+    the event triggers a full sync.
+    """
+    app = _api_post_event_app(event)
+    return app['id'] if app is not None else None
 
 
 class MarathonAcme(object):
     log = Logger()
 
     def __init__(self, marathon_client, group, cert_store, mlb_client,
-                 txacme_client_creator, reactor, email=None):
+                 txacme_client_creator, reactor, email=None,
+                 sync_debounce=0, reconcile_interval=300.0,
+                 issue_concurrency=4, rate_limiter=None, failure_cache=None,
+                 app_label_selector=None):
         """
         Create the marathon-acme service.
 
         :param marathon_client: The Marathon API client.
-        :param group: The name of the marathon-lb group.
-        :param cert_store: The ``ICertificateStore`` instance to use.
-        :param mlb_clinet: The marathon-lb API client.
+        :param group:
+            The name of the marathon-lb group, or a list of names of groups.
+        :param cert_store:
+            The ``ICertificateStore`` instance to use, or a dict mapping each
+            group name to the instance to use for that group.
+        :param mlb_clinet:
+            The marathon-lb API client, or a dict mapping each group name to
+            the client for that group's marathon-lb instances.
         :param txacme_client_creator: Callable to create the txacme client.
         :param reactor: The reactor to use.
         :param email: The ACME registration email.
+        :param sync_debounce:
+            The number of seconds to wait after an event triggers a sync
+            before starting it, so that a burst of events results in a single
+            sync.
+        :param reconcile_interval:
+            The base number of seconds between periodic full syncs that catch
+            any changes missed by the event stream, or 0 to not run them.
+        :param issue_concurrency:
+            The maximum number of certificates to issue at once.
+        :param rate_limiter:
+            The ``RateLimiter`` that certificate issuance is held back by.
+            Defaults to one with Let's Encrypt's limits.
+        :param failure_cache:
+            The ``FailureCache`` used to back off issuance for domains that
+            keep failing. Defaults to one that is only kept in memory.
+        :param app_label_selector:
+            A Marathon label selector string that apps must match for
+            certificates to be issued for their domains, or None to consider
+            all apps. The selector is sent to Marathon so that it only returns
+            matching apps in a sync.
         """
         self.marathon_client = marathon_client
-        self.group = group
+        if isinstance(group, (list, tuple)):
+            self.groups = list(group)
+        else:
+            self.groups = [group]
+        self.app_label_selector = app_label_selector
+        self.label_extractor = LabelExtractor(
+            self.groups, selector=(
+                LabelSelector(app_label_selector)
+                if app_label_selector is not None else None))
         self.reactor = reactor
 
         responder = HTTP01Responder()
         self.server = MarathonAcmeServer(responder.resource)
 
-        mlb_cert_store = MlbCertificateStore(cert_store, mlb_client)
-        self.txacme_service = AcmeIssuingService(
-            mlb_cert_store, txacme_client_creator, reactor, [responder], email)
+        # Each group has its own certificate store and marathon-lb instances,
+        # but one ACME client and issuing service is shared between them
+        mlb_cert_stores = dict(
+            (g, MlbCertificateStore(_for_group(cert_store, g),
+                                    _for_group(mlb_client, g)))
+            for g in self.groups)
+        if len(self.groups) == 1:
+            mlb_cert_store = mlb_cert_stores[self.groups[0]]
+        else:
+            mlb_cert_store = GroupCertificateStore(
+                mlb_cert_stores, self._cert_groups)
+        self.txacme_service = SanAcmeIssuingService(
+            mlb_cert_store, txacme_client_creator, reactor, [responder], email,
+            names_for=self._known_cert_names, renew=self._renew_cert)
+
+        # Events trigger syncs through the scheduler so that only one sync
+        # runs at a time
+        self.sync_scheduler = SyncScheduler(
+            self.sync, reactor, debounce=sync_debounce)
+
+        # Attach events trigger a full sync, so a burst of them only needs to
+        # be handled once. API request events sync the app they're for, so
+        # only a burst for the same app can be handled once: the latest app
+        # definition is the one that counts. API request events without an
+        # app definition all trigger a full sync.
+        self.event_queue = EventQueue({
+            'event_stream_attached': self._sync_on_event_stream_attached,
+            'api_post_event': self._sync_on_api_post_event
+        }, coalesce={
+            'event_stream_attached': None,
+            'api_post_event': _api_post_event_app_id,
+        })
+        self.event_stream = EventStreamSupervisor(
+            marathon_client, self.event_queue, reactor,
+            on_connecting=self._on_event_stream_connecting,
+            on_skipped=self._sync_on_skipped_event)
+
+        if failure_cache is None:
+            failure_cache = FailureCache(reactor)
+        self.failure_cache = failure_cache
+
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(reactor)
+        self.rate_limiter = rate_limiter
+        self.issuance_queue = IssuanceQueue(
+            self._issue_cert, reactor, concurrency=issue_concurrency,
+            rate_limiter=rate_limiter)
+
+        self.reconciler = None
+        if reconcile_interval:
+            self.reconciler = Reconciler(
+                self.sync_scheduler.trigger, reactor,
+                is_healthy=self._reconcile_healthy,
+                interval=reconcile_interval)
+        self._reconcile_state = None
+
+        # The number of domains found by full syncs to have been added or
+        # removed without us noticing from the event stream
+        self.drift_added = 0
+        self.drift_removed = 0
+        self._synced = False
+
+        # The number of full syncs skipped because the apps hadn't changed,
+        # and whether the last full sync left no domains to issue
+        # certificates for, so that the next one can be skipped if the apps
+        # haven't changed
+        self.syncs_skipped = 0
+        self._apps_settled = False
 
         self._server_listening = None
+        self._attached = False
+        # The domains for each port of each app, as found during the last full
+        # sync or api_post_event for the app
+        self.domain_index = DomainIndex()
+        # app ID -> port index -> group, for the ports in the domain index
+        self._port_groups = {}
 
     def run(self, endpoint_description):
         self.log.info('Starting marathon-acme...')
@@ -75,6 +226,11 @@ class MarathonAcme(object):
             self.log.failure('Unhandle error during operation', result)
         self.log.warn('Stopping marathon-acme...')
 
+        self.sync_scheduler.stop()
+        self.issuance_queue.stop()
+        if self.reconciler is not None:
+            self.reconciler.stop()
+
         # If the server failed to start we have nothing to cancel yet
         if self._server_listening is not None:
             return gatherResults([
@@ -82,33 +238,42 @@ class MarathonAcme(object):
                 self.txacme_service.stopService()
             ], consumeErrors=True)
 
-    def listen_events(self, reconnects=0):
+    def listen_events(self):
         """
         Start listening for events from Marathon, running a sync when we first
         successfully subscribe and triggering a sync on API request events.
+        The event stream is reconnected whenever the connection is lost. Full
+        syncs are also run periodically in case any events were missed.
         """
-        self.log.info('Listening for events from Marathon...')
-        self._attached = False
-
-        def on_finished(result, reconnects):
-            # If the callback fires then the HTTP request to the event stream
-            # went fine, but the persistent connection for the SSE stream was
-            # dropped. Just reconnect for now- if we can't actually connect
-            # then the errback will fire rather.
-            self.log.warn('Connection lost listening for events, '
-                          'reconnecting... ({reconnects} so far)',
-                          reconnects=reconnects)
-            reconnects += 1
-            return self.listen_events(reconnects)
-
-        def log_failure(failure):
-            self.log.failure('Failed to listen for events', failure)
-            return failure
-
-        return self.marathon_client.get_events({
-            'event_stream_attached': self._sync_on_event_stream_attached,
-            'api_post_event': self._sync_on_api_post_event
-        }).addCallbacks(on_finished, log_failure, callbackArgs=[reconnects])
+        if self.reconciler is not None:
+            self.reconciler.start()
+        return self.event_stream.start()
+
+    def _reconcile_healthy(self):
+        # Things are healthy if the event stream has stayed connected and no
+        # drift was found since the last reconciliation
+        state = (
+            self.event_stream.reconnects, self.drift_added, self.drift_removed)
+        healthy = (self.event_stream.state == self.event_stream.CONNECTED and
+                   state == self._reconcile_state)
+        self._reconcile_state = state
+        return healthy
+
+    def _on_event_stream_connecting(self, resuming):
+        # If Marathon sent event IDs before the connection was lost, the stream
+        # is resumed from the last event ID rather than running another sync.
+        # A server that sends event IDs is expected to replay the events we
+        # missed when we resume with Last-Event-ID.
+        if not resuming:
+            self._attached = False
+
+    def _sync_on_skipped_event(self, event_type):
+        # We don't know what was in an event that was too large to parse, so
+        # run a full sync to pick up whatever it was about
+        self.log.warn(
+            '{event_type} event skipped because it was too large, triggering '
+            'a sync...', event_type=event_type)
+        self.sync_scheduler.trigger()
 
     def _sync_on_event_stream_attached(self, event):
         if self._attached:
@@ -124,14 +289,74 @@ class MarathonAcme(object):
             'event_stream_attached event received (timestamp: "{timestamp}", '
             'remoteAddress: "{remoteAddress}"), running initial sync...',
             timestamp=event['timestamp'], remoteAddress=event['remoteAddress'])
-        return self.sync()
+        self.sync_scheduler.trigger()
 
     def _sync_on_api_post_event(self, event):
+        app = _api_post_event_app(event)
+        if app is None:
+            self.log.info(
+                'api_post_event event received (timestamp: "{timestamp}", '
+                'uri: "{uri}") without an app definition, triggering a '
+                'sync...', timestamp=event['timestamp'], uri=event['uri'])
+            self.sync_scheduler.trigger()
+            return
+
         self.log.info(
             'api_post_event event received (timestamp: "{timestamp}", uri: '
-            '"{uri}"), triggering a sync...', timestamp=event['timestamp'],
-            uri=event['uri'])
-        return self.sync()
+            '"{uri}"), syncing app {app}...', timestamp=event['timestamp'],
+            uri=event['uri'], app=app['id'])
+        # Don't return the sync: the domain index is updated before sync_app()
+        # returns, and issuance is left to the issuance queue so that a slow
+        # ACME order doesn't hold up the events behind it
+        self.sync_app(app)
+
+    def sync_app(self, app):
+        """
+        Find the domains that require certificates for a single app, using the
+        app definition rather than fetching the list of apps from Marathon,
+        and issue certificates for any domains that weren't already in the
+        domain index and don't already have a certificate, or whose
+        certificate's names have changed.
+        """
+        app_id = app['id']
+        ports = self._app_ports(app)
+        port_domains = self._port_domains(ports)
+
+        # Certificates are named by the first domain for each port
+        primary_domains = set(
+            domains[0] for domains in port_domains.values())
+        names_before = dict(
+            (domain, set(self._cert_names(domain)))
+            for domain in primary_domains)
+
+        added, removed = self.domain_index.update_app(app_id, port_domains)
+        self._set_port_groups(app_id, ports)
+        if removed:
+            self.log.info('Domains no longer used by any app: {domains}',
+                          domains=sorted(removed))
+
+        new_domains = sorted(
+            domain for domain in primary_domains
+            if domain in added or
+            set(self._cert_names(domain)) != names_before[domain])
+        if not new_domains:
+            self.log.debug('No new domains for app {app}', app=app_id)
+            return succeed(None)
+
+        # The next full sync mustn't be skipped if these aren't issued
+        self._apps_settled = False
+
+        def log_failure(failure):
+            # Forget the app's domains so that they're retried the next time
+            # the app is posted
+            self.domain_index.remove_app(app_id)
+            self._port_groups.pop(app_id, None)
+            self.log.failure('Sync for app {app} failed', failure,
+                             LogLevel.error, app=app_id)
+
+        return (self._filter_new_domains(new_domains)
+                .addCallback(self._issue_certs)
+                .addErrback(log_failure))
 
     def sync(self):
         """
@@ -146,57 +371,120 @@ class MarathonAcme(object):
             return result
 
         def log_failure(failure):
+            self._apps_settled = False
             self.log.failure('Sync failed', failure, LogLevel.error)
             return failure
 
-        return (self.marathon_client.get_apps()
-                .addCallback(self._apps_acme_domains)
-                .addCallback(self._filter_new_domains)
-                .addCallback(self._issue_certs)
+        # Extract the domains from each app as it is received so that the
+        # full list of app definitions is never held in memory
+        apps_ports = {}
+
+        def extract(app):
+            apps_ports[app['id']] = self.label_extractor.extract(app)
+
+        def sync_apps(count):
+            if count is None:
+                self.syncs_skipped += 1
+                self.log.info(
+                    'Apps unchanged since the last sync, skipping it '
+                    '({hits} unchanged, {misses} changed)',
+                    hits=self.marathon_client.apps_fingerprint_hits,
+                    misses=self.marathon_client.apps_fingerprint_misses)
+                return []
+
+            return (self._filter_new_domains(
+                        self._apps_acme_domains(apps_ports))
+                    .addCallback(self._settle)
+                    .addCallback(self._issue_certs))
+
+        # Only skip unchanged apps if the last sync had nothing to issue, so
+        # that failed issuances are retried
+        return (self.marathon_client.stream_apps(
+                    extract, label=self.app_label_selector,
+                    skip_unchanged=self._apps_settled)
+                .addCallback(sync_apps)
                 .addCallbacks(log_success, log_failure))
 
-    def _apps_acme_domains(self, apps):
-        domains = []
-        for app in apps:
-            domains.extend(self._app_acme_domains(app))
+    def _settle(self, domains):
+        self._apps_settled = not domains
+        return domains
 
-        self.log.debug('Found {len_domains} domains for apps: {domains}',
+    def _apps_acme_domains(self, apps_ports):
+        added, removed = self.domain_index.replace_all(dict(
+            (app_id, self._port_domains(ports))
+            for app_id, ports in apps_ports.items()))
+        self._port_groups = {}
+        for app_id, ports in apps_ports.items():
+            self._set_port_groups(app_id, ports)
+        if removed:
+            self.log.info('Domains no longer used by any app: {domains}',
+                          domains=sorted(removed))
+
+        # After the first full sync, any changes are ones that weren't picked
+        # up from the event stream
+        if self._synced and (added or removed):
+            self.drift_added += len(added)
+            self.drift_removed += len(removed)
+            self.log.warn(
+                'Sync found changes missed by the event stream: {added} '
+                'domains added, {removed} removed', added=sorted(added),
+                removed=sorted(removed))
+        self._synced = True
+
+        # Certificates are named by the first domain for each port
+        domains = sorted(self.domain_index.primary_domains())
+
+        self.log.debug('Found {len_domains} certificates for apps: {domains}',
                        len_domains=len(domains), domains=domains)
 
         return domains
 
-    def _app_acme_domains(self, app):
-        app_domains = []
-        labels = app['labels']
-        app_group = labels.get('HAPROXY_GROUP')
+    def _cert_names(self, domain):
+        """
+        Get the names that the certificate for a domain should cover.
+        """
+        return self.domain_index.cert_names(domain)
 
-        # Prefer the 'portDefinitions' field added in Marathon 1.0.0 but fall
-        # back to the deprecated 'ports' array if that's not present.
-        if 'portDefinitions' in app:
-            ports = app['portDefinitions']
-        else:
-            ports = app['ports']
+    def _known_cert_names(self, domain):
+        """
+        Get the names that the certificate for a domain should cover when it
+        is issued, or None if no app has the domain, e.g. because the
+        certificate is being renewed before the first sync. The certificate
+        then keeps the names it already has.
+        """
+        if domain not in self.domain_index:
+            return None
+        return self._cert_names(domain)
 
-        # Iterate through the ports, checking for corresponding labels
-        for port_index, _ in enumerate(ports):
-            # Get the port group label, defaulting to the app group label
-            port_group = labels.get(
-                'HAPROXY_%d_GROUP' % (port_index,), app_group)
+    def _cert_groups(self, domain):
+        """
+        Get the groups that the certificate for a domain is for: the groups
+        of the ports that it is the first domain for.
+        """
+        groups = set()
+        for app_id, port in self.domain_index.owners(domain):
+            if self.domain_index.app_domains(app_id)[port][0] == domain:
+                groups.add(self._port_groups[app_id][port])
+        return groups
+
+    def _set_port_groups(self, app_id, ports):
+        if ports:
+            self._port_groups[app_id] = dict(
+                (port, group) for port, (group, _) in ports.items())
+        else:
+            self._port_groups.pop(app_id, None)
 
-            if port_group == self.group:
-                domain_label = labels.get(
-                    'MARATHON_ACME_%d_DOMAIN' % (port_index,), '')
-                port_domains = parse_domain_label(domain_label)
+    def _port_domains(self, ports):
+        return dict((port, domains) for port, (_, domains) in ports.items())
 
-                if port_domains:
-                    # TODO: Support SANs- for now just use the first domain
-                    if len(port_domains) > 1:
-                        self.log.warn(
-                            'Multiple domains found for port {port} of app '
-                            '{app}, only the first will be used',
-                            port=port_index, app=app['id'])
+    def _app_ports(self, app):
+        """
+        Find the group and domains for each port of an app that is in one of
+        our groups and has domains.
 
-                    app_domains.append(port_domains[0])
+        :return: A dict mapping port indexes to (group, domains) tuples.
+        """
+        app_domains = self.label_extractor.extract(app)
 
         self.log.debug(
             'Found {len_domains} domains for app {app}: {domains}',
@@ -205,48 +493,139 @@ class MarathonAcme(object):
         return app_domains
 
     def _filter_new_domains(self, marathon_domains):
+        """
+        Get the domains that don't have a certificate yet, or whose stored
+        certificate doesn't cover the names that it should.
+        """
         def filter_domains(stored_domains):
-            return set(marathon_domains) - set(stored_domains.keys())
+            domains = set()
+            for domain in marathon_domains:
+                if domain not in stored_domains:
+                    domains.add(domain)
+                    continue
+
+                names = pem_cert_names(stored_domains[domain])
+                if (names is not None and
+                        set(names) != set(self._cert_names(domain))):
+                    self.log.info(
+                        'Names for the certificate for "{domain}" changed '
+                        'from {old} to {new}, reissuing it', domain=domain,
+                        old=names, new=self._cert_names(domain))
+                    domains.add(domain)
+            return domains
 
         d = self.txacme_service.cert_store.as_dict()
         d.addCallback(filter_domains)
         return d
 
     def _issue_certs(self, domains):
+        domains = [domain for domain in domains
+                   if not self._failing_recently(domain)]
         if domains:
             self.log.info(
                 'Issuing certificates for {len_domains} domains: {domains}',
                 len_domains=len(domains), domains=domains)
         else:
             self.log.debug('No new domains to issue certificates for')
-        return gatherResults([self._issue_cert(domain) for domain in domains])
+        return gatherResults(
+            [self.issuance_queue.submit(domain)
+             .addErrback(self._issue_failed, domain)
+             for domain in domains])
+
+    def _issue_failed(self, failure, domain):
+        # Don't fail the sync on the errors from the ACME server that
+        # _issue_cert() has already logged, so that we can continue with
+        # other domains. There are more error codes but if they happen then
+        # something serious has gone wrong-- carry on error-ing.
+        if failure.check(txacme_ServerError):
+            if _acme_error_code(failure.value) not in _LOGGED_ACME_ERRORS:
+                return failure
+            return None
+
+        # Domains held back by rate limits will be issued later, don't fail
+        # the sync because of them
+        failure.trap(RateLimitedError)
+        completion = self.issuance_queue.projected_completion()
+        self.log.warn(
+            'Certificate for "{domain}" held for {retry_after:.0f}s because '
+            'of rate limits. The {held} held domains are projected to be '
+            'issued within {completion:.0f}s', domain=domain,
+            retry_after=failure.value.retry_after,
+            held=self.issuance_queue.held,
+            completion=completion - self.reactor.seconds())
+
+    def _failing_recently(self, domain):
+        if not self.failure_cache.should_skip(
+                domain, self._cert_names(domain)):
+            return False
+
+        entry = self.failure_cache.get(domain)
+        self.log.debug(
+            'Not issuing certificate for "{domain}" after {attempts} failed '
+            'attempts ({error}), retrying in {delay:.0f}s', domain=domain,
+            attempts=entry['attempts'], error=entry['error'],
+            delay=entry['retry_at'] - self.reactor.seconds())
+        return True
+
+    def _renew_cert(self, domain, urgent):
+        """
+        Renew the certificate for a domain through the issuance queue, in the
+        lane for renewals close to expiry if ``urgent``, else for early
+        renewals.
+        """
+        priority = (IssuanceQueue.RENEW_URGENT if urgent
+                    else IssuanceQueue.RENEW_EARLY)
+        return self.issuance_queue.submit(domain, priority)
 
     def _issue_cert(self, domain):
         """
         Issue a certificate for the given domain.
         """
         def errback(failure):
-            # Don't fail on some of the errors we could get from the ACME
-            # server, rather just log an error so that we can continue with
-            # other domains.
+            # Log the errors we expect from the ACME server, but still pass
+            # them on so that the issuance isn't counted as a success and
+            # renewals that fail can be panicked about. Syncs carry on with
+            # other domains after these errors (see _issue_failed()).
             failure.trap(txacme_ServerError)
             acme_error = failure.value.message
-
-            # FIXME: The acme error code stuff is a mess pre- the unreleased
-            # 0.10 version. Update this to use the 'code' attribute when the
-            # new acme library is released.
-            acme_error_code = str(acme_error.typ).split(':')[-1]
-            if acme_error_code in ['rateLimited', 'serverInternal',
-                                   'connection', 'unknownHost']:
+            acme_error_code = _acme_error_code(failure.value)
+            if acme_error_code == 'rateLimited':
+                # Let the issuance queue hold the domain until we can retry
+                raise RateLimitedError(
+                    domain, self._retry_after(failure.value.response))
+            elif acme_error_code in ['connection', 'dns', 'unknownHost']:
+                # These are problems with the domain, which are likely to
+                # persist, so back off retrying it
+                delay = self.failure_cache.record_failure(
+                    domain, self._cert_names(domain), acme_error_code)
+                self.log.error(
+                    'Error ({code}) issuing certificate for "{domain}", '
+                    'retrying in {delay:.0f}s at the earliest: {detail}',
+                    code=acme_error_code, domain=domain, delay=delay,
+                    detail=acme_error.detail)
+            elif acme_error_code == 'serverInternal':
                 # TODO: Fire off an error to Sentry or something?
                 self.log.error(
                     'Error ({code}) issuing certificate for "{domain}": '
                     '{detail}', code=acme_error_code, domain=domain,
                     detail=acme_error.detail)
-            else:
-                # There are more error codes but if they happen then something
-                # serious has gone wrong-- carry on error-ing.
-                return failure
+            return failure
+
+        def callback(result):
+            self.failure_cache.record_success(domain)
+            return result
 
         d = self.txacme_service.issue_cert(domain)
-        return d.addErrback(errback)
+        return d.addCallbacks(callback, errback)
+
+    def _retry_after(self, response):
+        """
+        Get the number of seconds to wait from the ``Retry-After`` header of
+        an ACME server response, if there is one.
+        """
+        if response is None:
+            return None
+        values = response.headers.getRawHeaders(b'retry-after')
+        if not values:
+            return None
+        return parse_retry_after(values[0], self.reactor.seconds())
@@ -1,78 +1,246 @@
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.protocol import connectionDone, Protocol
 from twisted.logger import Logger, LogLevel
+from twisted.protocols.policies import TimeoutMixin
 
 
-class SseProtocol(Protocol):
+class SseProtocol(Protocol, TimeoutMixin):
     """
     A protocol for Server-Sent Events (SSE).
     https://html.spec.whatwg.org/multipage/comms.html#server-sent-events
     """
 
-    MAX_LENGTH = 1024 * 1024 * 1024  # 1MiB
+    # The maximum length of a line for any field other than 'data'
+    MAX_LENGTH = 1024 * 1024  # 1MiB
+    # The default maximum total length of the 'data' lines for an event
+    MAX_EVENT_SIZE = 1024 * 1024  # 1MiB
     log = Logger()
 
-    def __init__(self, handler):
+    def __init__(self, handler, event_types=None, last_event_id=None,
+                 timeout=None, reactor=None, max_event_size=None,
+                 recorder=None, decode_data=True, skipped_handler=None,
+                 discarded_handler=None):
         """
         :param handler:
             A 2-args callable that will be called back with the event and data
             when a complete message is received.
+        :param event_types:
+            The event types that the handler is interested in. Events of any
+            other type are not passed to the handler and, once their type is
+            known, their data lines are discarded without being decoded or
+            buffered. If None, the handler receives all events.
+        :param last_event_id:
+            The ID of the last event received on a previous connection, if
+            this connection resumes the stream with a ``Last-Event-ID``.
+        :param timeout:
+            The number of seconds the connection may be idle before it is
+            closed. Any bytes received, including comment lines sent as
+            keepalives, reset the timeout. If None, the connection is never
+            closed for being idle.
+        :param reactor: The reactor to use to schedule the timeout.
+        :param max_event_size:
+            The maximum number of bytes of 'data' lines in a single event.
+            Events with more data are skipped: the rest of their data is
+            discarded as it is received, without being buffered. Defaults to
+            ``MAX_EVENT_SIZE``.
+        :param recorder:
+            A callable that is called with each chunk of raw bytes received,
+            for example to record the stream to a file for replaying later.
+        :param decode_data:
+            Whether to decode the data for each event from UTF-8 before
+            passing it to the handler. If False, the handler receives the data
+            as bytes, which saves a copy if, for example, it is passed straight
+            to a JSON decoder.
+        :param skipped_handler:
+            A callable that is called with the event type when an event that
+            the handler would have received is skipped because it is too
+            large, so that whatever the event was for can be done some other
+            way.
+        :param discarded_handler:
+            A callable that is called with the event type when an event is
+            discarded because the handler isn't interested in its type.
         """
         self._handler = handler
+        self._skipped_handler = skipped_handler
+        self._discarded_handler = discarded_handler
+        self._event_types = (
+            frozenset(event_types) if event_types is not None else None)
         self._waiting = []
-        self._buffer = b''
+        self._finished = False
+        self._buffer = bytearray()
+        # Whether the last chunk of data ended with a '\r' that may be the
+        # first half of a '\r\n' line ending
+        self._trailing_cr = False
+        # Whether the rest of the current line is being skipped
+        self._skipping_line = False
+
+        self.max_event_size = (
+            max_event_size if max_event_size is not None
+            else self.MAX_EVENT_SIZE)
+
+        # The number of events discarded because of their type and the number
+        # skipped because they were larger than max_event_size
+        self.discarded_events = 0
+        self.skipped_events = 0
+
+        # The ID of the last event dispatched and the reconnection time (in
+        # milliseconds) requested by the server, if any
+        self.last_event_id = last_event_id
+        self.reconnection_time = None
+        self._event_id_buffer = last_event_id
+
+        self._recorder = recorder
+        self._decode_data = decode_data
+        self._timeout = timeout
+        if reactor is not None:
+            self.callLater = reactor.callLater
 
         self._reset_event_data()
 
     def _reset_event_data(self):
         self._event = 'message'
         self._data_lines = []
+        self._data_size = 0
+        # Whether the data for the current event is being discarded because
+        # of its type or skipped because of its size
+        self._discarding = False
+        self._skipping = False
+
+    def _is_wanted_event(self, event):
+        return self._event_types is None or event in self._event_types
 
     def when_finished(self):
         """
         Get a deferred that will be fired when the connection is closed.
+        Cancelling the deferred closes the connection.
         """
-        d = Deferred()
+        if self._finished:
+            return succeed(None)
+
+        d = Deferred(self._cancel_finished)
         self._waiting.append(d)
         return d
 
+    def _cancel_finished(self, d):
+        self._waiting.remove(d)
+        if self.transport is not None:
+            self.transport.loseConnection()
+
     def dataReceived(self, data):
         """
         Translates bytes into lines, and calls lineReceived.
 
-        Copied from ``twisted.protocols.basic.LineOnlyReceiver`` but using
-        str.splitlines() to split on ``\r\n``, ``\n``, and ``\r``.
+        Lines may end in ``\r\n``, ``\n``, or ``\r``. Only the newly received
+        bytes are scanned for line endings, and bytes belonging to an
+        incomplete line are accumulated in a buffer, so a long line that
+        arrives in many chunks is not copied and re-split for every chunk.
+        Incomplete 'data' lines for events that are being discarded or skipped
+        are not buffered at all.
         """
-        lines = (self._buffer + data).splitlines()
+        if not data:
+            return
 
-        # str.splitlines() doesn't split the string after a trailing newline
-        # character so we must check if there is a trailing newline and, if so,
-        # clear the buffer as the line is "complete". Else, the line is
-        # incomplete and we keep the last line in the buffer.
-        if data.endswith(b'\n') or data.endswith(b'\r'):
-            self._buffer = b''
-        else:
-            self._buffer = lines.pop(-1)
+        self.resetTimeout()
+        if self._recorder is not None:
+            self._recorder(data)
+
+        start = 0
+        if self._trailing_cr:
+            # The previous chunk ended with a '\r' which has already ended a
+            # line. If this chunk starts with '\n' then that's the second half
+            # of a '\r\n' line ending and not the end of another line.
+            self._trailing_cr = False
+            if data[:1] == b'\n':
+                start = 1
 
-        for line in lines:
+        for end, next_start in _line_breaks(data, start):
             if self.transport.disconnecting:
                 # this is necessary because the transport may be told to lose
                 # the connection by a line within a larger packet, and it is
                 # important to disregard all the lines in that packet following
                 # the one that told it to close.
                 return
-            if len(line) > self.MAX_LENGTH:
+
+            if self._skipping_line:
+                # The start of this line has already been discarded
+                self._skipping_line = False
+                start = next_start
+                continue
+
+            if self._buffer:
+                self._buffer.extend(memoryview(data)[start:end])
+                line = bytes(self._buffer)
+                del self._buffer[:]
+            else:
+                line = data[start:end]
+            start = next_start
+
+            if len(line) > self.MAX_LENGTH and not _is_data_line(line):
                 self.lineLengthExceeded(line)
                 return
             else:
                 self.lineReceived(line)
-        if len(self._buffer) > self.MAX_LENGTH:
+
+        if start == len(data):
+            self._trailing_cr = data.endswith(b'\r')
+        elif not self._skipping_line:
+            self._buffer.extend(memoryview(data)[start:])
+            self._check_incomplete_line()
+
+    def _check_incomplete_line(self):
+        """
+        Check the length of the incomplete line in the buffer. If it is a
+        'data' line that won't be used, stop buffering it.
+        """
+        if self._buffer.startswith(b'data:'):
+            if (not self._discarding and not self._skipping and
+                    self._data_size + len(self._buffer) >
+                    self.max_event_size):
+                self._skip_event(self._data_size + len(self._buffer))
+
+            if self._discarding or self._skipping:
+                self._skipping_line = True
+                del self._buffer[:]
+        elif len(self._buffer) > self.MAX_LENGTH:
             self.lineLengthExceeded(self._buffer)
+
+    def connectionMade(self):
+        self.setTimeout(self._timeout)
+
+    def pauseProducing(self):
+        """
+        Stop reading data from the transport, for example because events are
+        being received faster than they can be handled. The idle timeout is
+        suspended while paused.
+        """
+        self.setTimeout(None)
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """ Resume reading data from the transport after it was paused. """
+        if self._finished:
             return
 
+        self.transport.resumeProducing()
+        self.setTimeout(self._timeout)
+
+    def timeoutConnection(self):
+        self.log.warn('SSE connection idle for {timeout}s, closing it',
+                      timeout=self._timeout)
+        self.transport.loseConnection()
+
     def lineReceived(self, line):
-        line = line.decode('utf-8')
+        if _is_data_line(line):
+            if self._discarding or self._skipping:
+                return
+
+            self._data_size += len(line)
+            if self._data_size > self.max_event_size:
+                self._skip_event(self._data_size)
+                return
 
+        # Lines are parsed as bytes and only the values that are used are
+        # decoded, so that the data for an event is decoded at most once
         if not line:
             self._dispatch_event()
             return
@@ -85,24 +253,71 @@ class SseProtocol(Protocol):
                        length=len(line), max=self.MAX_LENGTH)
         self.transport.loseConnection()
 
+    def _skip_event(self, size):
+        """
+        Skip the rest of the current event because its data is too large.
+        """
+        self.skipped_events += 1
+        self.log.warn(
+            'SSE event data too large, skipping event: {size} > {max} bytes '
+            '({skipped} skipped so far)', size=size, max=self.max_event_size,
+            skipped=self.skipped_events)
+        self._skipping = True
+        self._data_lines = []
+
     def _handle_field_value(self, field, value):
-        """ Handle the field, value pair. """
-        if field == 'event':
-            self._event = value
-        elif field == 'data':
+        """ Handle the field, value pair (in bytes). """
+        if field == b'data':
             self._data_lines.append(value)
-        elif field == 'id':
-            # Not implemented
-            pass
-        elif field == 'retry':
-            # Not implemented
-            pass
+        elif field == b'event':
+            value = value.decode('utf-8')
+            self._event = value
+            if not self._is_wanted_event(value):
+                # Drop any data received before the event type and ignore the
+                # rest. Once discarded, the event stays discarded even if the
+                # event type changes again before the event is dispatched.
+                self._discarding = True
+                self._data_lines = []
+        elif field == b'id':
+            # IDs containing NULL characters are ignored. The ID persists for
+            # following events until it is changed.
+            if b'\0' not in value:
+                self._event_id_buffer = value.decode('utf-8')
+        elif field == b'retry':
+            # Only values consisting of ASCII digits are valid
+            if value.isdigit():
+                self.reconnection_time = int(value)
         # Otherwise, ignore
 
     def _dispatch_event(self):
         """
         Dispatch the event to the handler.
         """
+        # The event ID is updated even if the event is discarded so that we
+        # don't ask for events we don't want if we resume the stream
+        self.last_event_id = self._event_id_buffer
+
+        if self._skipping:
+            # The event's type may only be known once the whole event has been
+            # received, so only now can we tell whether the handler wanted it
+            event = self._event
+            wanted = not self._discarding and self._is_wanted_event(event)
+            self._reset_event_data()
+            if wanted and self._skipped_handler is not None:
+                self._skipped_handler(event)
+            return
+
+        if self._discarding or not self._is_wanted_event(self._event):
+            # Don't count blank lines without any event type or data
+            event = self._event
+            discarded = self._discarding or self._data_lines
+            self._reset_event_data()
+            if discarded:
+                self.discarded_events += 1
+                if self._discarded_handler is not None:
+                    self._discarded_handler(event)
+            return
+
         data = self._prepare_data()
         if data is not None:
             self._handler(self._event, data)
@@ -111,36 +326,71 @@ class SseProtocol(Protocol):
 
     def _prepare_data(self):
         """
-        Join the data lines into a single string for delivery to the callback.
+        Join the data lines into a single string for delivery to the callback,
+        decoding it if necessary.
         """
         # If the data is empty, abort
         if not self._data_lines:
             return None
 
         # Add a newline character between lines
-        return '\n'.join(self._data_lines)
+        data = b'\n'.join(self._data_lines)
+        return data.decode('utf-8') if self._decode_data else data
 
     def connectionLost(self, reason=connectionDone):
         self.log.failure('SSE connection lost', reason, LogLevel.warn)
+        self.setTimeout(None)
+        self._finished = True
         for d in list(self._waiting):
             d.callback(None)
         self._waiting = []
 
 
+def _line_breaks(data, start):
+    """
+    Find the line endings (``\r\n``, ``\n``, or ``\r``) in the given bytes,
+    starting at the given index. Yields tuples of the index of the end of each
+    line and the index of the start of the next line.
+
+    Uses ``bytes.find()`` rather than a regex as it is much faster at scanning
+    long lines. The positions of the next '\r' and '\n' are remembered so
+    that the data is scanned at most once for each of the two characters.
+    """
+    cr = data.find(b'\r', start)
+    lf = data.find(b'\n', start)
+    while cr != -1 or lf != -1:
+        if lf == -1 or (cr != -1 and cr < lf):
+            end = cr
+            if lf == cr + 1:
+                next_start = lf + 1
+                lf = data.find(b'\n', next_start)
+            else:
+                next_start = cr + 1
+            cr = data.find(b'\r', next_start)
+        else:
+            end = lf
+            next_start = lf + 1
+            lf = data.find(b'\n', next_start)
+
+        yield end, next_start
+
+
+def _is_data_line(line):
+    """ Check whether a line (in bytes) is for the data field. """
+    return line.startswith(b'data') and (len(line) == 4 or line[4:5] == b':')
+
+
 def _parse_field_value(line):
-    """ Parse the field and value from a line. """
-    if line.startswith(':'):
+    """ Parse the field and value (in bytes) from a line. """
+    if line.startswith(b':'):
         # Ignore the line
         return None, None
 
-    if ':' not in line:
-        # Treat the entire line as the field, use empty string as value
-        return line, ''
-
-    # Else field is before the ':' and value is after
-    field, value = line.split(':', 1)
+    # The field is before the ':' and the value is after. If there is no ':',
+    # the entire line is the field and the value is empty.
+    field, _, value = line.partition(b':')
 
     # If value starts with a space, remove it.
-    value = value[1:] if value.startswith(' ') else value
+    value = value[1:] if value.startswith(b' ') else value
 
     return field, value
@@ -0,0 +1,46 @@
+# A comment line that marks the start of each connection in a recording.
+# Comment lines are ignored by SSE parsers, but the bytes recorded before the
+# marker may end part way through an event, so recordings should be split on
+# the marker (see ``split_connections()``) rather than replayed as a whole.
+CONNECTION_MARKER = b'\r\n: marathon-acme: new connection\r\n'
+
+
+def split_connections(recording):
+    """
+    Split a recording of the event stream into the raw bytes received on each
+    connection.
+    """
+    return [part for part in recording.split(CONNECTION_MARKER) if part]
+
+
+class SseRecorder(object):
+    """
+    Records the raw bytes of the event stream to a file so that they can be
+    replayed later, marking the start of each connection so that an event cut
+    off by a dropped connection doesn't run into the next connection's bytes.
+    Recordings are appended to the file, which is unbuffered so that the
+    recording is complete if we're killed.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path to the file to append the recording to.
+        """
+        self.path = path
+        self._file = None
+
+    def start_connection(self):
+        """ Mark the start of a new connection in the recording. """
+        if self._file is None:
+            self._file = open(self.path, 'ab', 0)
+        self._file.write(CONNECTION_MARKER)
+
+    def write(self, data):
+        """ Record raw bytes received on the current connection. """
+        self._file.write(data)
+
+    def close(self):
+        """ Close the file. A new connection reopens it. """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
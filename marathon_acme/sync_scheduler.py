@@ -0,0 +1,85 @@
+from twisted.internet.defer import maybeDeferred
+from twisted.logger import Logger
+
+
+class SyncScheduler(object):
+    """
+    Schedules syncs so that at most one is running at a time. Triggers that
+    arrive while a sync is waiting to start are coalesced into it, and
+    triggers that arrive while a sync is running are coalesced into a single
+    sync that runs after it.
+    """
+
+    log = Logger()
+
+    def __init__(self, sync, reactor, debounce=0):
+        """
+        :param sync:
+            The function that performs a sync. It may return a deferred, which
+            should only fire once the sync is complete.
+        :param reactor: The reactor to use to schedule syncs.
+        :param debounce:
+            The number of seconds to wait after a sync is triggered before it
+            is started, so that a burst of triggers results in a single sync.
+        """
+        self._sync = sync
+        self.reactor = reactor
+        self.debounce = debounce
+
+        # The number of times a sync was triggered, the number of those
+        # triggers that were coalesced with another, and the number of syncs
+        # started
+        self.triggers = 0
+        self.coalesced = 0
+        self.syncs = 0
+
+        self._delayed_call = None
+        self._running = False
+        self._trailing = False
+
+    def trigger(self):
+        """
+        Trigger a sync. A sync will start after the debounce time unless one
+        is already waiting to start, or after the current sync if one is
+        running.
+        """
+        self.triggers += 1
+        if self._delayed_call is not None or self._trailing:
+            self.coalesced += 1
+        elif self._running:
+            self._trailing = True
+        else:
+            self._schedule()
+
+    def stop(self):
+        """ Cancel any sync that is waiting to start. """
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+        self._trailing = False
+
+    def _schedule(self):
+        if self.debounce > 0:
+            self._delayed_call = self.reactor.callLater(
+                self.debounce, self._run)
+        else:
+            self._run()
+
+    def _run(self):
+        self._delayed_call = None
+        self._running = True
+        self.syncs += 1
+        d = maybeDeferred(self._sync)
+        # Failures are logged by the sync itself
+        d.addErrback(lambda _: None)
+        d.addCallback(self._finished)
+
+    def _finished(self, _):
+        self._running = False
+        if self._trailing:
+            self._trailing = False
+            self.log.debug(
+                'Sync triggered while running, scheduling another sync '
+                '({coalesced} triggers coalesced so far)',
+                coalesced=self.coalesced)
+            self._schedule()
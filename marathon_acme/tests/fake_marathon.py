@@ -1,4 +1,6 @@
+import hashlib
 import json
+import re
 from datetime import datetime
 
 from klein import Klein
@@ -8,6 +10,57 @@ from marathon_acme.clients import get_single_header
 from marathon_acme.server import write_request_json
 
 
+_LABEL_TERM = re.compile(r"""
+    \s*((?:\\.|[^\\\s=!(),])+)\s*                # key
+    (?:(==|!=)\s*((?:\\.|[^\\,])*)                 # equality
+      |(in|notin)\s*\(((?:\\.|[^\\()])*)\))?     # set
+    \s*(?:,(?!\s*\Z)|\Z)
+""", re.VERBOSE | re.DOTALL)
+_LABEL_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+
+_LABEL_OPS = {
+    None: lambda label, value: True,
+    '==': lambda label, value: label == value,
+    '!=': lambda label, value: label != value,
+    'in': lambda label, values: label in values,
+    'notin': lambda label, values: label not in values,
+}
+
+
+def _label_unescape(text):
+    return _LABEL_ESCAPE.sub(r'\1', text.strip())
+
+
+def marathon_label_filter(label):
+    """
+    Parse a label selector the way Marathon does and return a function that
+    checks whether a dict of app labels matches it. Marathon only matches an
+    app if it has the label for every term, whatever the term's operator.
+    """
+    terms = []
+    pos = 0
+    while pos < len(label):
+        match = _LABEL_TERM.match(label, pos)
+        if match is None:
+            raise ValueError('Invalid label selector: %r' % (label,))
+        key, eq_op, eq_value, set_op, set_values = match.groups()
+        if eq_op is not None:
+            terms.append((_label_unescape(key), eq_op,
+                          _label_unescape(eq_value)))
+        elif set_op is not None:
+            values = re.split(r'(?<!\\),', set_values)
+            terms.append((_label_unescape(key), set_op,
+                          set(_label_unescape(v) for v in values)))
+        else:
+            terms.append((_label_unescape(key), None, None))
+        pos = match.end()
+
+    def matches(labels):
+        return all(key in labels and _LABEL_OPS[op](labels[key], value)
+                   for key, op, value in terms)
+    return matches
+
+
 def marathon_timestamp(time=datetime.utcnow()):
     """
     Make a Marathon/JodaTime-like timestamp string in ISO8601 format with
@@ -19,6 +72,7 @@ def marathon_timestamp(time=datetime.utcnow()):
 class FakeMarathon(object):
     def __init__(self):
         self._apps = {}
+        self._events = []
         self.event_callbacks = []
 
     def add_app(self, app, client_ip=None):
@@ -32,8 +86,20 @@ class FakeMarathon(object):
                            uri='/v2/apps/' + app_id.lstrip('/'),
                            appDefinition=app)
 
-    def get_apps(self):
-        return list(self._apps.values())
+    def get_apps(self, label=None):
+        apps = list(self._apps.values())
+        if label is not None:
+            matches = marathon_label_filter(label)
+            apps = [app for app in apps if matches(app.get('labels', {}))]
+        return apps
+
+    def get_events_since(self, event_id):
+        """
+        Get the (event ID, event) pairs for the events triggered after the
+        event with the given ID.
+        """
+        return [(i + 1, event) for i, event in enumerate(self._events)
+                if i + 1 > event_id]
 
     def attach_event_stream(self, callback, remote_address=None):
         assert callback not in self.event_callbacks
@@ -56,8 +122,11 @@ class FakeMarathon(object):
         }
         event.update(kwargs)
 
-        for callback in self.event_callbacks:
-            callback(event)
+        self._events.append(event)
+        event_id = len(self._events)
+
+        for callback in list(self.event_callbacks):
+            callback(event_id, event)
 
 
 class FakeMarathonAPI(object):
@@ -68,6 +137,15 @@ class FakeMarathonAPI(object):
         self.client = StubTreq(self.app.resource())
         self.event_requests = []
         self._called_get_apps = False
+        self.get_apps_args = None
+
+        # Marathon doesn't send event IDs or a reconnection time. These can be
+        # set to simulate a server that does.
+        self.send_event_ids = False
+        self.event_retry = None
+        # Marathon doesn't send ETags for the list of apps. This can be set to
+        # simulate a server that does and honours If-None-Match.
+        self.send_etags = False
 
     def check_called_get_apps(self):
         """ Check and reset the ``_called_get_apps`` flag. """
@@ -77,9 +155,21 @@ class FakeMarathonAPI(object):
     @app.route('/v2/apps', methods=['GET'])
     def get_apps(self, request):
         self._called_get_apps = True
+        self.get_apps_args = request.args
+        label = request.args.get(b'label')
         response = {
-            'apps': self._marathon.get_apps()
+            'apps': self._marathon.get_apps(
+                label=label[0].decode('utf-8') if label else None)
         }
+
+        if self.send_etags:
+            body = json.dumps(response, sort_keys=True).encode('utf-8')
+            etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+            request.setHeader('ETag', etag)
+            if request.getHeader('If-None-Match') == etag:
+                request.setResponseCode(304)
+                return
+
         request.setResponseCode(200)
         write_request_json(request, response)
 
@@ -91,9 +181,27 @@ class FakeMarathonAPI(object):
         request.setResponseCode(200)
         request.setHeader('Content-Type', 'text/event-stream')
 
-        def callback(event):
-            _write_request_event(request, event)
-            self.client.flush()
+        event_types = request.args.get(b'event_type')
+
+        def callback(event_id, event):
+            if (event_types is None or
+                    event['eventType'].encode('utf-8') in event_types):
+                if not self.send_event_ids:
+                    event_id = None
+                _write_request_event(request, event, event_id)
+                self.client.flush()
+
+        if self.event_retry is not None:
+            request.write(b'retry: %d\n' % (self.event_retry,))
+
+        # Replay missed events if the client is resuming the stream
+        last_event_id = get_single_header(
+            request.requestHeaders, 'Last-Event-ID')
+        if self.send_event_ids and last_event_id is not None:
+            for event_id, event in self._marathon.get_events_since(
+                    int(last_event_id)):
+                callback(event_id, event)
+
         self._marathon.attach_event_stream(callback, request.getClientIP())
         self.event_requests.append(request)
 
@@ -107,8 +215,10 @@ class FakeMarathonAPI(object):
         return finished
 
 
-def _write_request_event(request, event):
+def _write_request_event(request, event, event_id=None):
     event_type = event['eventType']
+    if event_id is not None:
+        request.write(b'id: %d\n' % (event_id,))
     request.write(b'event: %s\n' % (event_type.encode('utf-8'),))
     request.write(b'data: %s\n' % (json.dumps(event).encode('utf-8'),))
     request.write(b'\n')
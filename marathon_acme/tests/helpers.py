@@ -1,3 +1,6 @@
+import pem
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
 from treq.client import HTTPClient
 from twisted.internet.defer import fail
 from uritools import urisplit
@@ -37,3 +40,14 @@ class PerLocationAgent(object):
         agent = self.agents[urisplit(uri).authority]
         return agent.request(
             method, uri, headers=headers, bodyProducer=bodyProducer)
+
+
+def cert_names(pem_objects):
+    """ Get the subjectAltNames of the first certificate in PEM objects. """
+    cert_pem = next(
+        o for o in pem_objects if isinstance(o, pem.Certificate))
+    cert = x509.load_pem_x509_certificate(
+        cert_pem.as_bytes(), default_backend())
+    san = cert.extensions.get_extension_for_class(
+        x509.SubjectAlternativeName)
+    return san.value.get_values_for_type(x509.DNSName)
@@ -2,6 +2,7 @@ from datetime import datetime, timedelta
 
 import pem
 import pytest
+from acme import challenges
 from acme.jose import JWKRSA
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
@@ -9,17 +10,22 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from testtools.assertions import assert_that
 from testtools.matchers import (
-    Equals, HasLength, IsInstance, MatchesListwise, MatchesStructure)
+    AfterPreprocessing, Equals, HasLength, IsInstance, MatchesDict,
+    MatchesListwise, MatchesStructure)
 from testtools.twistedsupport import succeeded, failed
 from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
-from txacme.testing import MemoryStore
+from txacme.challenges import HTTP01Responder
+from txacme.testing import FakeClient, MemoryStore
 from txacme.util import generate_private_key
 
 from marathon_acme.acme_util import (
-    generate_wildcard_pem_bytes, maybe_key, MlbCertificateStore)
+    generate_wildcard_pem_bytes, GroupCertificateStore, maybe_key,
+    MlbCertificateStore, SanAcmeIssuingService)
 from marathon_acme.clients import MarathonLbClient
 from marathon_acme.tests.fake_marathon import FakeMarathonLb
+from marathon_acme.tests.helpers import cert_names
 from marathon_acme.tests.matchers import (
     matches_time_or_just_before, WithErrorTypeAndMessage)
 
@@ -175,3 +181,180 @@ class TestMlbCertificateStore(object):
             RuntimeError,
             "Wrapped certificate store returned something non-None. Don't "
             "know what to do with 'foo'.")))
+
+
+class TestGroupCertificateStore(object):
+    def setup_method(self):
+        self.stores = {'external': MemoryStore(), 'internal': MemoryStore()}
+        self.groups = {}
+        self.group_store = GroupCertificateStore(
+            self.stores, lambda name: self.groups.get(name, set()))
+
+    def test_store_routed_to_group(self):
+        """
+        When a certificate is stored, it should only be stored in the stores
+        for the groups that it is for.
+        """
+        self.groups['example.com'] = {'internal'}
+
+        d = self.group_store.store('example.com', EXAMPLE_PEM_OBJECTS)
+        assert_that(d, succeeded(Equals([None])))
+
+        assert_that(self.stores['external'].as_dict(),
+                    succeeded(Equals({})))
+        assert_that(self.stores['internal'].as_dict(), succeeded(
+            Equals({'example.com': EXAMPLE_PEM_OBJECTS})))
+        assert_that(self.group_store.get('example.com'),
+                    succeeded(Equals(EXAMPLE_PEM_OBJECTS)))
+
+    def test_store_multiple_groups(self):
+        """
+        When a certificate is stored that is for several groups, it should be
+        stored in the stores for each of them.
+        """
+        self.groups['example.com'] = {'external', 'internal'}
+
+        d = self.group_store.store('example.com', EXAMPLE_PEM_OBJECTS)
+        assert_that(d, succeeded(Equals([None, None])))
+
+        for store in self.stores.values():
+            assert_that(store.as_dict(), succeeded(
+                Equals({'example.com': EXAMPLE_PEM_OBJECTS})))
+
+    def test_store_unknown_group(self):
+        """
+        When a certificate that isn't known to be for any group is stored, it
+        should replace the certificates in the stores that already have it,
+        or fail if none do.
+        """
+        self.stores['internal'].store('example.com', [])
+
+        d = self.group_store.store('example.com', EXAMPLE_PEM_OBJECTS)
+        assert_that(d, succeeded(Equals([None])))
+        assert_that(self.stores['internal'].as_dict(), succeeded(
+            Equals({'example.com': EXAMPLE_PEM_OBJECTS})))
+
+        assert_that(
+            self.group_store.store('example2.com', EXAMPLE_PEM_OBJECTS),
+            failed(MatchesStructure(value=IsInstance(KeyError))))
+
+    def test_as_dict_missing_from_group(self):
+        """
+        When the certificates are listed, a certificate should only be
+        included if it is in the stores for all the groups it is for, so that
+        it is issued again for the groups missing it. Certificates that aren't
+        known to be for any group should always be included.
+        """
+        self.groups['example.com'] = {'external', 'internal'}
+        self.groups['example2.com'] = {'external'}
+        self.stores['external'].store('example.com', EXAMPLE_PEM_OBJECTS)
+        self.stores['external'].store('example2.com', EXAMPLE_PEM_OBJECTS)
+        self.stores['internal'].store('example3.com', EXAMPLE_PEM_OBJECTS)
+
+        assert_that(self.group_store.as_dict(), succeeded(Equals({
+            'example2.com': EXAMPLE_PEM_OBJECTS,
+            'example3.com': EXAMPLE_PEM_OBJECTS,
+        })))
+
+
+class TestSanAcmeIssuingService(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.clock.rightNow = (
+            datetime.now() - datetime(1970, 1, 1)).total_seconds()
+        client = FakeClient(
+            JWKRSA(key=generate_private_key(u'rsa')), self.clock)
+        client._challenge_types = [challenges.HTTP01]
+
+        self.cert_store = MemoryStore()
+        self.names = {}
+        self.renewals = []
+
+        def renew(server_name, urgent):
+            self.renewals.append((server_name, urgent))
+            return succeed(None)
+        self.service = SanAcmeIssuingService(
+            self.cert_store, lambda: succeed(client), self.clock,
+            [HTTP01Responder()],
+            names_for=lambda name: self.names.get(name, [name]), renew=renew)
+
+    def test_issue_cert_san(self):
+        """
+        When a certificate is issued for a server name, it should cover all
+        the names for that server name and be stored under the server name.
+        """
+        self.names['example.com'] = ['example.com', 'www.example.com']
+
+        d = self.service.issue_cert('example.com')
+        assert_that(d, succeeded(Equals(None)))
+
+        certs = self.cert_store.as_dict()
+        assert_that(certs, succeeded(MatchesDict({
+            'example.com': AfterPreprocessing(
+                cert_names, Equals(['example.com', 'www.example.com']))
+        })))
+
+    def test_issue_cert_single_name(self):
+        """
+        When the server name has no other names, the certificate should just
+        cover the server name.
+        """
+        d = self.service.issue_cert('example.org')
+        assert_that(d, succeeded(Equals(None)))
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.org': AfterPreprocessing(
+                cert_names, Equals(['example.org']))
+        })))
+
+    def test_issue_cert_unknown_names_stored(self):
+        """
+        When the names for a server name aren't known, the certificate should
+        cover the names of the stored certificate.
+        """
+        self.names['example.com'] = ['example.com', 'www.example.com']
+        self.service.issue_cert('example.com')
+
+        self.names['example.com'] = None
+        d = self.service.issue_cert('example.com')
+        assert_that(d, succeeded(Equals(None)))
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': AfterPreprocessing(
+                cert_names, Equals(['example.com', 'www.example.com']))
+        })))
+
+    def test_issue_cert_unknown_names_not_stored(self):
+        """
+        When the names for a server name aren't known and there is no stored
+        certificate, the certificate should just cover the server name.
+        """
+        self.names['example.com'] = None
+        d = self.service.issue_cert('example.com')
+        assert_that(d, succeeded(Equals(None)))
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': AfterPreprocessing(
+                cert_names, Equals(['example.com']))
+        })))
+
+    def test_check_certs_renew(self):
+        """
+        When the periodic check finds certificates that are expiring, they
+        should be renewed through ``renew``, as urgent if they are close to
+        expiry.
+        """
+        self.service.issue_cert('urgent.example.com')
+        self.clock.advance(timedelta(days=10).total_seconds())
+        self.service.issue_cert('early.example.com')
+        # The certificates are valid for 90 days: 'urgent' is now within the
+        # panic interval and 'early' within the reissue interval
+        self.clock.advance(timedelta(days=66).total_seconds())
+
+        # Starting the service runs the check
+        self.service.startService()
+        assert_that(sorted(self.renewals), Equals([
+            ('early.example.com', False), ('urgent.example.com', True)]))
+        assert_that(self.service.ready, Equals(True))
+
+        self.service.stopService()
@@ -11,7 +11,7 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.internet.error import CannotListenError, ConnectionRefusedError
 from txacme.urls import LETSENCRYPT_STAGING_DIRECTORY
 
-from marathon_acme.cli import main, parse_listen_addr
+from marathon_acme.cli import main, parse_group_lb, parse_listen_addr
 
 
 class TestCli(TestCase):
@@ -79,6 +79,44 @@ class TestCli(TestCase):
         flush_logged_errors(CannotListenError)
 
 
+class TestParseGroupLb(object):
+    def test_parse_group_lbs(self):
+        """
+        When marathon-lb addresses are parsed for groups, a dict mapping each
+        group to its list of addresses is returned.
+        """
+        assert_that(
+            parse_group_lb(['external=http://lb1:9090,http://lb2:9090',
+                            'internal=http://lb3:9090'],
+                           ['external', 'internal']),
+            Equals({
+                'external': ['http://lb1:9090', 'http://lb2:9090'],
+                'internal': ['http://lb3:9090'],
+            }))
+
+    def test_parse_no_equals(self):
+        """
+        When marathon-lb addresses are parsed with no '=' character, an error
+        is raised.
+        """
+        with ExpectedException(
+            ValueError,
+            r"'http://lb1:9090' does not have the correct form for a group's "
+                r'marathon-lb addresses: GROUP=LB\[,LB,...\]'):
+            parse_group_lb(['http://lb1:9090'], ['external'])
+
+    def test_parse_unknown_group(self):
+        """
+        When marathon-lb addresses are parsed for a group that certificates
+        aren't being issued for, an error is raised.
+        """
+        with ExpectedException(
+                ValueError,
+                r"'internal' is not one of the groups to issue certificates "
+                'for'):
+            parse_group_lb(['internal=http://lb3:9090'], ['external'])
+
+
 class TestParseListenAddr(object):
     def test_parse_no_colon(self):
         """
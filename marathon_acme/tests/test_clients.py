@@ -5,12 +5,12 @@ from testtools.assertions import assert_that
 from testtools.matchers import (
     Equals, Is, IsInstance, HasLength, MatchesStructure)
 from testtools.twistedsupport import (
-    AsynchronousDeferredRunTest, failed, flush_logged_errors)
+    AsynchronousDeferredRunTest, failed, flush_logged_errors, has_no_result)
 from treq.client import HTTPClient as treq_HTTPClient
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, DeferredQueue
 from twisted.internet.task import Clock
-from twisted.web._newclient import ResponseDone
+from twisted.web._newclient import ResponseDone, ResponseFailed
 from twisted.web.client import Agent
 from twisted.web.http_headers import Headers
 from twisted.web.server import NOT_DONE_YET
@@ -28,6 +28,22 @@ from marathon_acme.tests.matchers import (
     HasHeader, HasRequestProperties, WithErrorTypeAndMessage)
 
 
+class FakeSseRecorder(object):
+    """
+    An ``SseRecorder`` that records bytes in a list, with None marking the
+    start of each connection.
+    """
+
+    def __init__(self):
+        self.recorded = []
+
+    def start_connection(self):
+        self.recorded.append(None)
+
+    def write(self, data):
+        self.recorded.append(data)
+
+
 def read_request_json(request):
     return json.loads(request.content.read().decode('utf-8'))
 
@@ -714,6 +730,212 @@ class TestMarathonClient(TestHTTPClientBase):
         res = yield d
         self.assertThat(res, Equals(apps['apps']))
 
+    @inlineCallbacks
+    def test_get_apps_label(self):
+        """
+        When we request the list of apps from Marathon with a label selector,
+        the selector should be sent as the ``label`` query parameter.
+        """
+        d = self.cleanup_d(
+            self.client.get_apps(label='HAPROXY_GROUP==external'))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/apps'),
+            query={'label': ['HAPROXY_GROUP==external']}))
+
+        apps = {'apps': [{'id': '/my-app', 'labels': {}, 'ports': [9000]}]}
+        json_response(request, apps)
+
+        res = yield d
+        self.assertThat(res, Equals(apps['apps']))
+
+    @inlineCallbacks
+    def test_stream_apps(self):
+        """
+        When we stream the list of apps from Marathon, the handler should be
+        called with each app and we should receive the number of apps.
+        """
+        apps = []
+        d = self.cleanup_d(self.client.stream_apps(
+            apps.append, label='HAPROXY_GROUP==external'))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/apps'),
+            query={'label': ['HAPROXY_GROUP==external']}))
+
+        response_apps = [
+            {'id': '/my-app', 'labels': {}, 'ports': [9000]},
+            {'id': '/my-app2', 'labels': {}, 'ports': [9001]},
+        ]
+        json_response(request, {'apps': response_apps})
+
+        res = yield d
+        self.assertThat(res, Equals(2))
+        self.assertThat(apps, Equals(response_apps))
+
+    @inlineCallbacks
+    def test_stream_apps_unchanged_hash(self):
+        """
+        When we stream the list of apps from Marathon and Marathon doesn't
+        send an ETag, the response body should be hashed so that unchanged
+        apps can be skipped the next time they are fetched, but changed apps
+        should not be skipped.
+        """
+        response_apps = [{'id': '/my-app', 'labels': {}, 'ports': [9000]}]
+        results = []
+        for apps_json in [response_apps, response_apps, []]:
+            d = self.cleanup_d(self.client.stream_apps(
+                lambda app: None, skip_unchanged=True))
+
+            request = yield self.requests.get()
+            self.assertThat(
+                request.requestHeaders.hasHeader('if-none-match'),
+                Equals(False))
+            json_response(request, {'apps': apps_json})
+
+            res = yield d
+            results.append(res)
+
+        self.assertThat(results, Equals([1, None, 0]))
+        self.assertThat(self.client.apps_fingerprint_hits, Equals(1))
+        self.assertThat(self.client.apps_fingerprint_misses, Equals(2))
+
+    @inlineCallbacks
+    def test_stream_apps_unchanged_hash_volatile_fields(self):
+        """
+        When we stream the list of apps from Marathon and Marathon doesn't
+        send an ETag, only the fields that affect certificates should be
+        hashed, so that apps whose tasks or version changed are skipped but
+        apps whose labels or ports changed are not.
+        """
+        app = {
+            'id': '/my-app',
+            'labels': {'HAPROXY_GROUP': 'external'},
+            'portDefinitions': [{'port': 9000}],
+            'tasksRunning': 1,
+            'tasksHealthy': 1,
+            'tasksStaged': 0,
+            'version': '2017-01-01T00:00:00.000Z',
+        }
+        changes = [
+            {},
+            {'tasksRunning': 2, 'tasksHealthy': 0, 'tasksStaged': 1,
+             'version': '2017-01-02T00:00:00.000Z',
+             'lastTaskFailure': {'state': 'TASK_FAILED'}},
+            {'labels': {'HAPROXY_GROUP': 'internal'}},
+            {'portDefinitions': [{'port': 9000}, {'port': 9001}]},
+        ]
+        results = []
+        for change in changes:
+            app = dict(app, **change)
+            d = self.cleanup_d(self.client.stream_apps(
+                lambda app: None, skip_unchanged=True))
+
+            request = yield self.requests.get()
+            json_response(request, {'apps': [app]})
+
+            res = yield d
+            results.append(res)
+
+        self.assertThat(results, Equals([1, None, 1, 1]))
+        self.assertThat(self.client.apps_fingerprint_hits, Equals(1))
+        self.assertThat(self.client.apps_fingerprint_misses, Equals(3))
+
+    @inlineCallbacks
+    def test_stream_apps_unchanged_etag(self):
+        """
+        When we stream the list of apps from Marathon and Marathon sends an
+        ETag, the ETag should be sent back in an If-None-Match header the next
+        time the apps are fetched, and a 304 response means that the apps
+        haven't changed.
+        """
+        d = self.cleanup_d(self.client.stream_apps(
+            lambda app: None, skip_unchanged=True))
+
+        request = yield self.requests.get()
+        request.setHeader('ETag', '"abc"')
+        json_response(request, {'apps': []})
+        res = yield d
+        self.assertThat(res, Equals(0))
+
+        d = self.cleanup_d(self.client.stream_apps(
+            lambda app: None, skip_unchanged=True))
+
+        request = yield self.requests.get()
+        self.assertThat(request.requestHeaders,
+                        HasHeader('if-none-match', ['"abc"']))
+        request.setResponseCode(304)
+        request.setHeader('ETag', '"abc"')
+        request.finish()
+        res = yield d
+        self.assertThat(res, Is(None))
+
+        self.assertThat(self.client.apps_fingerprint_hits, Equals(1))
+        self.assertThat(self.client.apps_fingerprint_misses, Equals(1))
+
+    @inlineCallbacks
+    def test_stream_apps_unchanged_not_skipped(self):
+        """
+        When we stream the list of apps from Marathon without skipping
+        unchanged apps, no If-None-Match header should be sent and unchanged
+        apps should still be counted.
+        """
+        for _ in range(2):
+            apps = []
+            d = self.cleanup_d(self.client.stream_apps(apps.append))
+
+            request = yield self.requests.get()
+            self.assertThat(
+                request.requestHeaders.hasHeader('if-none-match'),
+                Equals(False))
+            request.setHeader('ETag', '"abc"')
+            json_response(request, {'apps': [{'id': '/my-app'}]})
+
+            res = yield d
+            self.assertThat(res, Equals(1))
+            self.assertThat(apps, Equals([{'id': '/my-app'}]))
+
+        self.assertThat(self.client.apps_fingerprint_hits, Equals(1))
+        self.assertThat(self.client.apps_fingerprint_misses, Equals(1))
+
+    @inlineCallbacks
+    def test_stream_json_field_missing(self):
+        """
+        When stream_json_field is used to make a request and the specified
+        field is missing from the response, an error is raised.
+        """
+        d = self.cleanup_d(self.client.stream_json_field(
+            'field-key', lambda element: None, path='/my-path'))
+
+        request = yield self.requests.get()
+        json_response(request, {'other-field-key': 'do-not-care'})
+
+        yield wait0()
+        self.assertThat(d, failed(WithErrorTypeAndMessage(
+            KeyError,
+            '\'Unable to get value for "field-key" from Marathon response\''
+        )))
+
+    @inlineCallbacks
+    def test_stream_json_field_error(self):
+        """
+        When stream_json_field is used to make a request but the response code
+        indicates an error, an HTTPError should be raised.
+        """
+        d = self.cleanup_d(self.client.stream_json_field(
+            'field-key', lambda element: None, path='/my-path'))
+
+        request = yield self.requests.get()
+        request.setResponseCode(500)
+        request.write(b'Oops\n')
+        request.finish()
+
+        yield wait0()
+        self.assertThat(d, failed(WithErrorTypeAndMessage(
+            HTTPError, '500 Server Error for url: %s' % self.uri('/my-path'))))
+
     @inlineCallbacks
     def test_get_events(self):
         """
@@ -725,7 +947,8 @@ class TestMarathonClient(TestHTTPClientBase):
 
         request = yield self.requests.get()
         self.assertThat(request, HasRequestProperties(
-            method='GET', url=self.uri('/v2/events')))
+            method='GET', url=self.uri('/v2/events'),
+            query={'event_type': ['test']}))
         self.assertThat(request.requestHeaders,
                         HasHeader('accept', ['text/event-stream']))
 
@@ -758,7 +981,8 @@ class TestMarathonClient(TestHTTPClientBase):
 
         request = yield self.requests.get()
         self.assertThat(request, HasRequestProperties(
-            method='GET', url=self.uri('/v2/events')))
+            method='GET', url=self.uri('/v2/events'),
+            query={'event_type': ['test']}))
         self.assertThat(request.requestHeaders,
                         HasHeader('accept', ['text/event-stream']))
 
@@ -800,7 +1024,8 @@ class TestMarathonClient(TestHTTPClientBase):
 
         request = yield self.requests.get()
         self.assertThat(request, HasRequestProperties(
-            method='GET', url=self.uri('/v2/events')))
+            method='GET', url=self.uri('/v2/events'),
+            query={'event_type': ['test1', 'test2']}))
         self.assertThat(request.requestHeaders,
                         HasHeader('accept', ['text/event-stream']))
 
@@ -828,17 +1053,249 @@ class TestMarathonClient(TestHTTPClientBase):
         flush_logged_errors(ResponseDone)
 
     @inlineCallbacks
-    def test_get_events_non_200(self):
+    def test_get_events_no_callback(self):
         """
-        When a request is made to Marathon's event stream, and a non-200
-        response code is returned, an error should be raised.
+        When a request is made to Marathon's event stream, and there are
+        events that have no callback, those events should be skipped without
+        their data being parsed.
+        """
+        data = []
+        d = self.cleanup_d(self.client.get_events({'test': data.append}))
+
+        request = yield self.requests.get()
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+
+        request.write(b'event: status_update_event\n')
+        request.write(b'data: not json\n')
+        request.write(b'\n')
+
+        json_data = {'hello': 'world'}
+        request.write(b'event: test\n')
+        request.write(b'data: %s\n' % (json.dumps(json_data).encode('utf-8'),))
+        request.write(b'\n')
+
+        yield wait0()
+        self.assertThat(data, Equals([json_data]))
+
+        request.finish()
+        yield d
+
+        # Expect request.finish() to result in a logged failure
+        flush_logged_errors(ResponseDone)
+
+    @inlineCallbacks
+    def test_get_events_filter_not_supported(self):
+        """
+        When a request is made to Marathon's event stream, and Marathon sends
+        events of types that weren't requested, the event type filter should
+        not be requested the next time the event stream is requested.
         """
         data = []
         d = self.cleanup_d(self.client.get_events({'test': data.append}))
 
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/events'),
+            query={'event_type': ['test']}))
+
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.write(b'event: status_update_event\n')
+        request.write(b'data: {}\n')
+        request.write(b'\n')
+
+        # Noticed as soon as the event is received
+        yield wait0()
+        self.assertThat(self.client.filter_event_types, Equals(False))
+
+        request.finish()
+        yield d
+        flush_logged_errors(ResponseDone)
+
+        d = self.cleanup_d(self.client.get_events({'test': data.append}))
+
         request = yield self.requests.get()
         self.assertThat(request, HasRequestProperties(
             method='GET', url=self.uri('/v2/events')))
+
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+
+        request.finish()
+        yield d
+        flush_logged_errors(ResponseDone)
+
+    @inlineCallbacks
+    def test_get_events_filter_rejected(self):
+        """
+        When a request is made to Marathon's event stream, and Marathon
+        rejects the event type filter with a non-200 response, the event
+        stream should be requested again straight away without the filter,
+        and the filter should not be requested again.
+        """
+        data = []
+        d = self.cleanup_d(self.client.get_events({'test': data.append}))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/events'),
+            query={'event_type': ['test']}))
+        request.setResponseCode(400)
+        request.setHeader('Content-Type', 'application/json')
+        request.write(b'{"message": "Unknown parameter: event_type"}')
+        request.finish()
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/events'), query={}))
+        self.assertThat(self.client.filter_event_types, Equals(False))
+
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.write(b'event: test\n')
+        request.write(b'data: {}\n')
+        request.write(b'\n')
+
+        request.finish()
+        yield d
+        flush_logged_errors(ResponseDone)
+
+        self.assertThat(data, Equals([{}]))
+
+    @inlineCallbacks
+    def test_get_events_filter_supported(self):
+        """
+        When a request is made to Marathon's event stream, and Marathon only
+        sends events of the types that were requested, the event type filter
+        should continue to be requested.
+        """
+        data = []
+        d = self.cleanup_d(self.client.get_events({'test': data.append}))
+
+        request = yield self.requests.get()
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.write(b'event: test\n')
+        request.write(b'data: {}\n')
+        request.write(b'\n')
+
+        request.finish()
+        yield d
+        flush_logged_errors(ResponseDone)
+
+        self.assertThat(data, Equals([{}]))
+        self.assertThat(self.client.filter_event_types, Equals(True))
+
+    @inlineCallbacks
+    def test_get_events_last_event_id(self):
+        """
+        When a request is made to Marathon's event stream with a last event
+        ID, the ID should be sent in the Last-Event-ID header. When the
+        connection is closed, the protocol should be returned with the ID of
+        the last event received and the reconnection time.
+        """
+        data = []
+        d = self.cleanup_d(self.client.get_events(
+            {'test': data.append}, last_event_id='122'))
+
+        request = yield self.requests.get()
+        self.assertThat(request.requestHeaders,
+                        HasHeader('last-event-id', ['122']))
+
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.write(b'retry: 5000\n')
+        request.write(b'id: 123\n')
+        request.write(b'event: test\n')
+        request.write(b'data: {}\n')
+        request.write(b'\n')
+
+        request.finish()
+        protocol = yield d
+        flush_logged_errors(ResponseDone)
+
+        self.assertThat(data, Equals([{}]))
+        self.assertThat(protocol, MatchesStructure(
+            last_event_id=Equals('123'), reconnection_time=Equals(5000)))
+
+    @inlineCallbacks
+    def test_get_events_recorded(self):
+        """
+        When a request is made to Marathon's event stream with an event stream
+        recorder set, the start of the connection and the raw bytes received
+        should be recorded.
+        """
+        recorder = FakeSseRecorder()
+        self.client = MarathonClient(
+            ['http://localhost:8080'],
+            client=treq_HTTPClient(self.fake_server.get_agent()),
+            event_stream_recorder=recorder)
+
+        data = []
+        d = self.cleanup_d(self.client.get_events({'test': data.append}))
+
+        request = yield self.requests.get()
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.write(b'event: test\n')
+        request.write(b'data: {}\n\n')
+
+        request.finish()
+        yield d
+        flush_logged_errors(ResponseDone)
+
+        self.assertThat(data, Equals([{}]))
+        self.assertThat(recorder.recorded, Equals([
+            None, b'event: test\n', b'data: {}\n\n']))
+
+    @inlineCallbacks
+    def test_get_events_idle_timeout(self):
+        """
+        When a request is made to Marathon's event stream with an event stream
+        timeout set, and no data is received for that long, the connection
+        should be closed.
+        """
+        clock = Clock()
+        self.client = MarathonClient(
+            ['http://localhost:8080'],
+            client=treq_HTTPClient(self.fake_server.get_agent()),
+            reactor=clock, event_stream_timeout=10)
+
+        d = self.cleanup_d(self.client.get_events({'test': lambda _: None}))
+
+        request = yield self.requests.get()
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.write(b':keepalive\n')
+
+        yield wait0()
+        clock.advance(9)
+        request.write(b':keepalive\n')
+        yield wait0()
+        clock.advance(9)
+        self.assertThat(d, has_no_result())
+
+        clock.advance(1)
+        yield d
+
+        # Expect the lost connection to result in a logged failure
+        flush_logged_errors(ResponseFailed)
+
+    @inlineCallbacks
+    def test_get_events_non_200(self):
+        """
+        When a request is made to Marathon's event stream without the event
+        type filter, and a non-200 response code is returned, an error should
+        be raised.
+        """
+        self.client.filter_event_types = False
+        data = []
+        d = self.cleanup_d(self.client.get_events({'test': data.append}))
+
+        request = yield self.requests.get()
+        self.assertThat(request, HasRequestProperties(
+            method='GET', url=self.uri('/v2/events'), query={}))
         self.assertThat(request.requestHeaders,
                         HasHeader('accept', ['text/event-stream']))
 
@@ -872,7 +1329,8 @@ class TestMarathonClient(TestHTTPClientBase):
 
         request = yield self.requests.get()
         self.assertThat(request, HasRequestProperties(
-            method='GET', url=self.uri('/v2/events')))
+            method='GET', url=self.uri('/v2/events'),
+            query={'event_type': ['test']}))
         self.assertThat(request.requestHeaders,
                         HasHeader('accept', ['text/event-stream']))
 
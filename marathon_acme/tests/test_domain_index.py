@@ -0,0 +1,129 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Contains, Equals, Not
+
+from marathon_acme.domain_index import DomainIndex
+
+
+class TestDomainIndex(object):
+    def setup_method(self):
+        self.index = DomainIndex()
+
+    def test_update_app_new(self):
+        """
+        When the domains for a new app are set, all of the domains should be
+        added to the index and be owned by the app.
+        """
+        added, removed = self.index.update_app(
+            '/app1', {0: ['a.com'], 1: ['b.com']})
+
+        assert_that(added, Equals({'a.com', 'b.com'}))
+        assert_that(removed, Equals(set()))
+        assert_that(self.index.domains(), Equals({'a.com', 'b.com'}))
+        assert_that(self.index.owners('b.com'), Equals({('/app1', 1)}))
+        assert_that(self.index.app_domains('/app1'), Equals(
+            {0: ['a.com'], 1: ['b.com']}))
+
+    def test_update_app_changed(self):
+        """
+        When the domains for an existing app are changed, the diff should
+        include only the domains that were added and removed.
+        """
+        self.index.update_app('/app1', {0: ['a.com'], 1: ['b.com']})
+        added, removed = self.index.update_app(
+            '/app1', {0: ['a.com'], 1: ['c.com']})
+
+        assert_that(added, Equals({'c.com'}))
+        assert_that(removed, Equals({'b.com'}))
+        assert_that(self.index, Not(Contains('b.com')))
+        assert_that(self.index.owners('b.com'), Equals(set()))
+
+    def test_update_app_port_moved(self):
+        """
+        When a domain moves between ports of an app, it should be neither
+        added nor removed.
+        """
+        self.index.update_app('/app1', {0: ['a.com']})
+        added, removed = self.index.update_app('/app1', {1: ['a.com']})
+
+        assert_that((added, removed), Equals((set(), set())))
+        assert_that(self.index.owners('a.com'), Equals({('/app1', 1)}))
+
+    def test_shared_domain(self):
+        """
+        When a domain belongs to several apps, it should only be added for the
+        first app and only removed when the last app no longer has it.
+        """
+        self.index.update_app('/app1', {0: ['a.com']})
+        added, _ = self.index.update_app('/app2', {0: ['a.com']})
+        assert_that(added, Equals(set()))
+        assert_that(self.index.owners('a.com'), Equals(
+            {('/app1', 0), ('/app2', 0)}))
+
+        _, removed = self.index.remove_app('/app1')
+        assert_that(removed, Equals(set()))
+        _, removed = self.index.remove_app('/app2')
+        assert_that(removed, Equals({'a.com'}))
+        assert_that(len(self.index), Equals(0))
+
+    def test_update_app_no_domains(self):
+        """
+        When an app has no domains, it should not be kept in the index.
+        """
+        self.index.update_app('/app1', {0: ['a.com']})
+        _, removed = self.index.update_app('/app1', {0: []})
+
+        assert_that(removed, Equals({'a.com'}))
+        assert_that(self.index.app_domains('/app1'), Equals({}))
+
+    def test_replace_all(self):
+        """
+        When the whole index is replaced, the diff should include the domains
+        added and removed across all apps, and apps that are gone should be
+        removed.
+        """
+        self.index.update_app('/app1', {0: ['a.com']})
+        self.index.update_app('/app2', {0: ['b.com']})
+
+        added, removed = self.index.replace_all({
+            '/app2': {0: ['b.com']},
+            '/app3': {0: ['c.com']},
+        })
+
+        assert_that(added, Equals({'c.com'}))
+        assert_that(removed, Equals({'a.com'}))
+        assert_that(self.index.app_domains('/app1'), Equals({}))
+        assert_that(self.index.domains(), Equals({'b.com', 'c.com'}))
+
+    def test_primary_domains(self):
+        """
+        The primary domains should be the first domain for each port of each
+        app.
+        """
+        self.index.update_app(
+            '/app1', {0: ['a.com', 'www.a.com'], 1: ['b.com']})
+        self.index.update_app('/app2', {0: ['c.com', 'a.com']})
+
+        assert_that(self.index.primary_domains(),
+                    Equals({'a.com', 'b.com', 'c.com'}))
+
+    def test_cert_names(self):
+        """
+        The names for a certificate should be the primary domain followed by
+        the other domains of each port that it is the first domain for, but
+        not the ports where it isn't the first domain.
+        """
+        self.index.update_app('/app1', {0: ['a.com', 'www.a.com']})
+        self.index.update_app('/app2', {0: ['a.com', 'api.a.com']})
+        self.index.update_app('/app3', {0: ['c.com', 'a.com']})
+
+        assert_that(self.index.cert_names('a.com'),
+                    Equals(['a.com', 'www.a.com', 'api.a.com']))
+        assert_that(self.index.cert_names('c.com'),
+                    Equals(['c.com', 'a.com']))
+
+    def test_cert_names_unknown(self):
+        """
+        The names for a certificate for a domain that isn't in the index
+        should be just the domain.
+        """
+        assert_that(self.index.cert_names('a.com'), Equals(['a.com']))
@@ -0,0 +1,213 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals
+from twisted.internet.defer import Deferred, fail, succeed
+
+from marathon_acme.event_queue import EventQueue
+
+
+class DummyProducer(object):
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class TestEventQueue(object):
+    def setup_method(self):
+        self.handled = []
+        self.waiting = []
+
+        def handle(event_type):
+            def handler(data):
+                self.handled.append((event_type, data))
+                d = Deferred()
+                self.waiting.append(d)
+                return d
+            return handler
+
+        self.queue = EventQueue({
+            'a': handle('a'),
+            'b': handle('b'),
+        }, max_depth=4, coalesce=['b'])
+
+        self.producer = DummyProducer()
+        self.queue.set_producer(self.producer)
+
+    def finish_handling(self):
+        self.waiting.pop(0).callback(None)
+
+    def test_handled_one_at_a_time(self):
+        """
+        When events are put on the queue, each one should be handled only
+        once the deferred returned by the previous handler has fired.
+        """
+        self.queue.put('a', 1)
+        self.queue.put('a', 2)
+
+        assert_that(self.handled, Equals([('a', 1)]))
+        assert_that(self.queue.depth, Equals(1))
+
+        self.finish_handling()
+        assert_that(self.handled, Equals([('a', 1), ('a', 2)]))
+        assert_that(self.queue.depth, Equals(0))
+
+        self.finish_handling()
+        self.queue.put('a', 3)
+        assert_that(self.handled, Equals([('a', 1), ('a', 2), ('a', 3)]))
+
+    def test_synchronous_handlers(self):
+        """
+        When handlers don't return deferreds, all the events should be handled
+        immediately without recursing for each event.
+        """
+        handled = []
+        blocked = Deferred()
+
+        def handler(data):
+            handled.append(data)
+            # Block on the first event so that the rest are queued
+            if data == 0:
+                return blocked
+        queue = EventQueue({'a': handler}, max_depth=2000)
+        for i in range(2000):
+            queue.put('a', i)
+        assert_that(queue.depth, Equals(1999))
+
+        blocked.callback(None)
+
+        assert_that(handled, Equals(list(range(2000))))
+        assert_that(queue.depth, Equals(0))
+
+    def test_handler_chained_deferred(self):
+        """
+        When a handler returns a deferred that has been called with another
+        deferred that hasn't fired yet, the next event should only be handled
+        once that deferred has fired.
+        """
+        handled = []
+        inner = Deferred()
+
+        def handler(data):
+            handled.append(data)
+            if data == 0:
+                return succeed(None).addCallback(lambda _: inner)
+        queue = EventQueue({'a': handler})
+        queue.put('a', 0)
+        queue.put('a', 1)
+
+        assert_that(handled, Equals([0]))
+        assert_that(queue.depth, Equals(1))
+
+        inner.callback(None)
+        assert_that(handled, Equals([0, 1]))
+        assert_that(queue.depth, Equals(0))
+
+    def test_handler_failure(self):
+        """
+        When a handler fails, the failure should be logged and the next event
+        should be handled.
+        """
+        handled = []
+        queue = EventQueue({
+            'a': lambda data: fail(RuntimeError('Oops')),
+            'b': handled.append,
+        })
+
+        queue.put('a', 1)
+        queue.put('b', 2)
+
+        assert_that(handled, Equals([2]))
+
+    def test_coalesce(self):
+        """
+        When an event of a coalesced type is put on the queue while an event of
+        the same type is waiting, it should replace the waiting event.
+        """
+        self.queue.put('b', 1)  # Handled immediately
+        self.queue.put('b', 2)
+        self.queue.put('a', 3)
+        self.queue.put('b', 4)
+
+        assert_that(self.queue.depth, Equals(2))
+        assert_that(self.queue.coalesced, Equals(1))
+
+        self.finish_handling()
+        self.finish_handling()
+        assert_that(self.handled, Equals([('b', 1), ('b', 4), ('a', 3)]))
+
+    def test_coalesce_by_key(self):
+        """
+        When an event of a type that is coalesced by key is put on the queue,
+        it should only replace a waiting event of the same type with the same
+        key.
+        """
+        queue = EventQueue({'a': self.handled.append}, coalesce={
+            'a': lambda data: data['key'],
+        })
+        blocked = Deferred()
+        queue.callbacks['a'] = lambda data: blocked
+
+        queue.put('a', {'key': 1, 'value': 1})  # Handled immediately
+        queue.put('a', {'key': 1, 'value': 2})
+        queue.put('a', {'key': 2, 'value': 3})
+        queue.put('a', {'key': 1, 'value': 4})
+
+        assert_that(queue.depth, Equals(2))
+        assert_that(queue.coalesced, Equals(1))
+
+        queue.callbacks['a'] = self.handled.append
+        blocked.callback(None)
+        assert_that(self.handled, Equals([
+            {'key': 1, 'value': 4}, {'key': 2, 'value': 3}]))
+
+    def test_not_coalesced(self):
+        """
+        When an event of a type that isn't coalesced is put on the queue while
+        an event of the same type is waiting, both should be handled.
+        """
+        self.queue.put('a', 1)
+        self.queue.put('a', 2)
+        self.queue.put('a', 3)
+
+        assert_that(self.queue.depth, Equals(2))
+        assert_that(self.queue.coalesced, Equals(0))
+
+    def test_backpressure(self):
+        """
+        When the queue is full, the producer should be paused and further
+        events dropped. When the queue has drained to half its maximum depth,
+        the producer should be resumed.
+        """
+        for i in range(5):
+            self.queue.put('a', i)
+        assert_that(self.queue.depth, Equals(4))
+        assert_that(self.producer.paused, Equals(True))
+
+        self.queue.put('a', 5)
+        assert_that(self.queue.depth, Equals(4))
+        assert_that(self.queue.dropped, Equals(1))
+
+        self.finish_handling()
+        assert_that(self.producer.paused, Equals(True))
+        self.finish_handling()
+        assert_that(self.queue.depth, Equals(2))
+        assert_that(self.producer.paused, Equals(False))
+
+        self.finish_handling()
+        assert_that(self.handled, Equals([('a', i) for i in range(4)]))
+
+    def test_set_producer_while_full(self):
+        """
+        When a producer is set while the queue is full, the producer should be
+        paused immediately.
+        """
+        self.queue.set_producer(None)
+        for i in range(5):
+            self.queue.put('a', i)
+
+        producer = DummyProducer()
+        self.queue.set_producer(producer)
+        assert_that(producer.paused, Equals(True))
@@ -0,0 +1,319 @@
+from testtools.assertions import assert_that
+from testtools.matchers import (
+    AllMatch, Equals, HasLength, Is, IsInstance, MatchesListwise,
+    MatchesStructure, Not)
+from testtools.twistedsupport import has_no_result, succeeded
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+
+from marathon_acme.event_queue import EventQueue
+from marathon_acme.event_stream import EventStreamSupervisor
+from marathon_acme.sse_protocol import SseProtocol
+
+
+class DummyTransport(object):
+    disconnecting = False
+    paused = False
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class FakeEventsClient(object):
+    """
+    A fake Marathon client that records each attempt to connect to the event
+    stream so that the test can decide what happens with the connection.
+    """
+
+    def __init__(self):
+        self.connections = []
+
+    def connect_events(self, callbacks, last_event_id=None,
+                       skipped_callback=None):
+        self.callbacks = callbacks
+        d = Deferred()
+        self.connections.append((d, last_event_id))
+        return d
+
+    def accept(self, event_id=None, retry=None):
+        """
+        Accept the latest connection attempt, optionally sending an event with
+        an ID and/or a reconnection time. Returns the protocol.
+        """
+        d, last_event_id = self.connections[-1]
+        protocol = SseProtocol(
+            lambda event, data: None, last_event_id=last_event_id)
+        protocol.transport = DummyTransport()
+        d.callback(protocol)
+
+        if retry is not None:
+            protocol.dataReceived(b'retry: %d\n' % (retry,))
+        if event_id is not None:
+            protocol.dataReceived(b'id: %s\ndata: {}\n\n' % (
+                event_id.encode('utf-8'),))
+        return protocol
+
+    def refuse(self):
+        """ Fail the latest connection attempt. """
+        d, _ = self.connections[-1]
+        d.errback(RuntimeError('Connection refused'))
+
+
+class TestEventStreamSupervisor(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.client = FakeEventsClient()
+        self.connecting = []
+        self.queue = EventQueue({})
+        self.supervisor = EventStreamSupervisor(
+            self.client, self.queue, self.clock,
+            on_connecting=self.connecting.append,
+            min_delay=1.0, max_delay=60.0, jitter=0.5, random=lambda: 0.0)
+
+    def test_start_connects(self):
+        """
+        When the supervisor is started, it should try to connect to the event
+        stream and report that it is connecting. When the connection is made,
+        the state should be connected.
+        """
+        d = self.supervisor.start()
+        assert_that(d, has_no_result())
+
+        assert_that(self.client.connections, HasLength(1))
+        assert_that(self.connecting, Equals([False]))
+        assert_that(self.supervisor.state, Equals('connecting'))
+
+        self.client.accept()
+        assert_that(self.supervisor.state, Equals('connected'))
+        assert_that(self.supervisor.reconnects, Equals(0))
+
+    def test_reconnect_immediately_after_first_loss(self):
+        """
+        When the connection is lost for the first time, the supervisor should
+        reconnect immediately and count the reconnection.
+        """
+        self.supervisor.start()
+        protocol = self.client.accept()
+
+        protocol.connectionLost()
+
+        assert_that(self.client.connections, HasLength(2))
+        assert_that(self.supervisor.state, Equals('connecting'))
+        assert_that(self.supervisor.reconnects, Equals(1))
+
+    def test_backoff(self):
+        """
+        When connecting fails repeatedly, the delay between attempts should
+        increase exponentially up to the maximum delay.
+        """
+        self.supervisor.start()
+        self.client.refuse()
+        # First reconnect is immediate
+        assert_that(self.client.connections, HasLength(2))
+
+        delays = []
+        for _ in range(8):
+            self.client.refuse()
+            assert_that(self.supervisor.state, Equals('waiting'))
+            [call] = self.clock.getDelayedCalls()
+            delays.append(call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+
+        assert_that(delays, Equals([1, 2, 4, 8, 16, 32, 60, 60]))
+        assert_that(self.client.connections, HasLength(10))
+        assert_that(self.supervisor.reconnects, Equals(9))
+
+    def test_backoff_jitter(self):
+        """
+        When a reconnection is delayed, up to the jitter fraction of the delay
+        should be randomly subtracted from it.
+        """
+        self.supervisor = EventStreamSupervisor(
+            self.client, self.queue, self.clock, min_delay=4.0, jitter=0.5,
+            random=lambda: 0.5)
+        self.supervisor.start()
+        self.client.refuse()
+        self.client.refuse()
+
+        [call] = self.clock.getDelayedCalls()
+        assert_that(call.getTime() - self.clock.seconds(), Equals(3.0))
+
+    def test_backoff_reset_after_stable_connection(self):
+        """
+        When a connection stays open for at least the maximum delay before it
+        is lost, the backoff should be reset and the reconnection should be
+        immediate.
+        """
+        self.supervisor.start()
+        self.client.refuse()
+        self.client.refuse()
+        self.clock.advance(1)
+        assert_that(self.client.connections, HasLength(3))
+
+        protocol = self.client.accept()
+        self.clock.advance(60)
+        protocol.connectionLost()
+
+        assert_that(self.client.connections, HasLength(4))
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+
+    def test_backoff_not_reset_after_short_connection(self):
+        """
+        When a connection is lost soon after it is made, the backoff should
+        continue to increase so that we don't reconnect in a tight loop.
+        """
+        self.supervisor.start()
+        for _ in range(3):
+            protocol = self.client.accept()
+            protocol.connectionLost()
+            self.clock.advance(60)
+
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+        assert_that(self.client.connections, HasLength(4))
+
+        protocol = self.client.accept()
+        protocol.connectionLost()
+        [call] = self.clock.getDelayedCalls()
+        assert_that(call.getTime() - self.clock.seconds(), Equals(4))
+
+    def test_resume_with_last_event_id(self):
+        """
+        When the connection is lost after events with IDs were received, the
+        supervisor should reconnect with the last event ID and report that it
+        is resuming the stream.
+        """
+        self.supervisor.start()
+        protocol = self.client.accept(event_id='123')
+        protocol.connectionLost()
+
+        assert_that(self.client.connections, MatchesListwise([
+            MatchesListwise([IsInstance(Deferred), Is(None)]),
+            MatchesListwise([IsInstance(Deferred), Equals('123')]),
+        ]))
+        assert_that(self.connecting, Equals([False, True]))
+        assert_that(self.supervisor.last_event_id, Equals('123'))
+
+    def test_reconnection_time(self):
+        """
+        When the server sets a reconnection time, reconnections should be
+        delayed by at least that time.
+        """
+        self.supervisor.start()
+        protocol = self.client.accept(retry=5000)
+        protocol.connectionLost()
+
+        assert_that(self.client.connections, HasLength(1))
+        self.clock.advance(5)
+        assert_that(self.client.connections, HasLength(2))
+
+    def test_stop_while_connected(self):
+        """
+        When the supervisor is stopped while connected, the connection should
+        be closed, the deferred from ``start()`` should fire and no
+        reconnection should be made.
+        """
+        d = self.supervisor.start()
+        protocol = self.client.accept()
+
+        self.supervisor.stop()
+        assert_that(d, succeeded(Is(None)))
+        assert_that(protocol.transport.disconnecting, Equals(True))
+        assert_that(self.supervisor.state, Equals('stopped'))
+
+        protocol.connectionLost()
+        assert_that(self.client.connections, HasLength(1))
+
+    def test_stop_while_waiting(self):
+        """
+        When the supervisor is stopped while waiting to reconnect, the
+        reconnection should be cancelled.
+        """
+        d = self.supervisor.start()
+        self.client.refuse()
+        self.client.refuse()
+        assert_that(self.clock.getDelayedCalls(), HasLength(1))
+
+        self.supervisor.stop()
+        assert_that(d, succeeded(Is(None)))
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+
+    def test_stop_while_connecting(self):
+        """
+        When the supervisor is stopped while connecting, the connection
+        attempt should be cancelled and no reconnection should be made.
+        """
+        d = self.supervisor.start()
+        connecting_d, _ = self.client.connections[0]
+
+        self.supervisor.stop()
+        assert_that(d, succeeded(Is(None)))
+        assert_that(connecting_d.called, Equals(True))
+        assert_that(self.client.connections, HasLength(1))
+
+    def test_no_deferred_chain(self):
+        """
+        When the connection is lost many times, the deferreds for previous
+        connections should not be chained to later ones, so that memory use
+        doesn't grow with the number of reconnections.
+        """
+        self.supervisor.start()
+        for _ in range(1000):
+            protocol = self.client.accept()
+            self.clock.advance(60)
+            protocol.connectionLost()
+
+        assert_that(self.supervisor.reconnects, Equals(1000))
+        assert_that(self.client.connections, HasLength(1001))
+        assert_that(
+            [d for d, _ in self.client.connections[:-1]],
+            AllMatch(MatchesStructure(
+                called=Equals(True), result=Not(IsInstance(Deferred)))))
+
+    def test_connect_failure_retried(self):
+        """
+        When connecting to the event stream fails with an error, the
+        supervisor should keep trying to connect rather than fail.
+        """
+        self.client.connect_events = (
+            lambda callbacks, last_event_id, skipped_callback: fail(
+                RuntimeError('Oops')))
+        d = self.supervisor.start()
+        assert_that(d, has_no_result())
+
+        assert_that(self.supervisor.reconnects, Equals(2))
+        self.clock.advance(1)
+        assert_that(self.supervisor.reconnects, Equals(3))
+        assert_that(self.supervisor.state, Equals('waiting'))
+
+    def test_events_queued(self):
+        """
+        When events are received, they should be put on the event queue and
+        the connection should be paused while the queue is full.
+        """
+        waiting = []
+
+        def handler(data):
+            d = Deferred()
+            waiting.append(d)
+            return d
+        self.queue = EventQueue({'test': handler}, max_depth=1)
+        self.supervisor = EventStreamSupervisor(
+            self.client, self.queue, self.clock)
+        self.supervisor.start()
+        protocol = self.client.accept()
+
+        self.client.callbacks['test']({})
+        self.client.callbacks['test']({})
+        assert_that(waiting, HasLength(1))
+        assert_that(self.queue.depth, Equals(1))
+        assert_that(protocol.transport.paused, Equals(True))
+
+        waiting[0].callback(None)
+        assert_that(waiting, HasLength(2))
+        assert_that(protocol.transport.paused, Equals(False))
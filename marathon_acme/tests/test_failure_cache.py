@@ -0,0 +1,101 @@
+import json
+
+import pytest
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is, MatchesDict
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+
+from marathon_acme.failure_cache import FailureCache
+
+
+class TestFailureCache(object):
+    @pytest.fixture(autouse=True)
+    def setup_cache(self, tmpdir):
+        self.clock = Clock()
+        self.path = FilePath(str(tmpdir)).child('failures.json')
+        self.cache = FailureCache(
+            self.clock, path=self.path, base_delay=10, max_delay=60)
+
+    def test_no_failures(self):
+        """
+        When a domain hasn't failed, issuance for it should not be skipped.
+        """
+        assert_that(self.cache.should_skip('example.com', ['example.com']),
+                    Equals(False))
+
+    def test_backoff(self):
+        """
+        When issuance for a domain fails repeatedly, retries should be
+        suppressed for exponentially longer, up to the maximum delay.
+        """
+        names = ['example.com']
+        delays = [self.cache.record_failure('example.com', names, 'dns')
+                  for _ in range(5)]
+        assert_that(delays, Equals([10, 20, 40, 60, 60]))
+        assert_that(self.cache.get('example.com'), MatchesDict({
+            'error': Equals('dns'),
+            'attempts': Equals(5),
+            'retry_at': Equals(60),
+            'names': Equals(names),
+        }))
+
+        assert_that(self.cache.should_skip('example.com', names),
+                    Equals(True))
+        self.clock.advance(60)
+        assert_that(self.cache.should_skip('example.com', names),
+                    Equals(False))
+        assert_that(self.cache.suppressed, Equals(1))
+
+    def test_names_changed(self):
+        """
+        When the names for a domain's certificate change, its failures should
+        be forgotten.
+        """
+        self.cache.record_failure('example.com', ['example.com'], 'dns')
+
+        assert_that(
+            self.cache.should_skip('example.com', ['example.com', 'a.com']),
+            Equals(False))
+        assert_that(self.cache.get('example.com'), Is(None))
+
+    def test_success(self):
+        """
+        When issuance for a domain succeeds, its failures should be
+        forgotten.
+        """
+        self.cache.record_failure('example.com', ['example.com'], 'dns')
+        self.cache.record_success('example.com')
+
+        assert_that(self.cache.should_skip('example.com', ['example.com']),
+                    Equals(False))
+        assert_that(len(self.cache), Equals(0))
+
+    def test_persisted(self):
+        """
+        The cache should be saved to its path when it changes and loaded from
+        it when created.
+        """
+        self.cache.record_failure('example.com', ['example.com'], 'dns')
+        assert_that(json.loads(self.path.getContent().decode('utf-8')),
+                    Equals({'example.com': {
+                        'error': 'dns', 'attempts': 1, 'retry_at': 10,
+                        'names': ['example.com']}}))
+
+        cache = FailureCache(self.clock, path=self.path, base_delay=10)
+        assert_that(cache.should_skip('example.com', ['example.com']),
+                    Equals(True))
+
+        self.cache.record_success('example.com')
+        assert_that(json.loads(self.path.getContent().decode('utf-8')),
+                    Equals({}))
+
+    def test_load_invalid(self):
+        """
+        When the persisted cache can't be parsed, the cache should start
+        empty.
+        """
+        self.path.setContent(b'{not json')
+
+        cache = FailureCache(self.clock, path=self.path)
+        assert_that(len(cache), Equals(0))
@@ -76,6 +76,32 @@ class TestFakeMarathonAPI(object):
             After(json_content, succeeded(Equals({'apps': [app]})))
         )))
 
+    def test_get_apps_label_selector(self):
+        """
+        When the list of apps is requested with a label selector, only the
+        apps that have the selector's labels should be returned, whatever the
+        selector's operators.
+        """
+        self.marathon._apps = {
+            '/external': {'id': '/external',
+                          'labels': {'HAPROXY_GROUP': 'external'}},
+            '/internal': {'id': '/internal',
+                          'labels': {'HAPROXY_GROUP': 'internal'}},
+            '/unlabelled': {'id': '/unlabelled', 'labels': {}},
+        }
+
+        def app_ids(label):
+            return sorted(app['id'] for app in self.marathon.get_apps(label))
+
+        assert_that(app_ids('HAPROXY_GROUP'),
+                    Equals(['/external', '/internal']))
+        assert_that(app_ids('HAPROXY_GROUP==external'), Equals(['/external']))
+        assert_that(app_ids('HAPROXY_GROUP!=internal'), Equals(['/external']))
+        assert_that(app_ids('HAPROXY_GROUP in (external, other)'),
+                    Equals(['/external']))
+        assert_that(app_ids('HAPROXY_GROUP notin (external)'),
+                    Equals(['/internal']))
+
     def test_get_apps_check_called(self):
         """
         When a client makes a call to the GET /v2/apps API, a flag should be
@@ -120,6 +146,31 @@ class TestFakeMarathonAPI(object):
             )
         )))
 
+    def test_get_events_event_type_filter(self):
+        """
+        When a request is made to the event stream endpoint with event_type
+        query parameters, only events of those types should be received.
+        """
+        response = self.client.get(
+            'http://localhost/v2/events?event_type=event_stream_attached',
+            headers={'Accept': 'text/event-stream'})
+        assert_that(response, succeeded(IsSseResponse()))
+
+        attach_data = []
+        post_data = []
+        sse_content(response.result, dict_handler({
+            'event_stream_attached': attach_data.append,
+            'api_post_event': post_data.append
+        }))
+
+        self.marathon.add_app({'id': '/my-app_1'})
+
+        assert_that(attach_data, MatchesListwise([
+            After(json.loads, IsMarathonEvent(
+                'event_stream_attached', remoteAddress=Equals('127.0.0.1')))
+        ]))
+        assert_that(post_data, Equals([]))
+
     def test_get_events_lost_connection(self):
         """
         When two connections are made to the event stream, the first connection
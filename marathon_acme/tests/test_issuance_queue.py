@@ -0,0 +1,328 @@
+from testtools.assertions import assert_that
+from testtools.matchers import (
+    Equals, HasLength, Is, IsInstance, MatchesAll, MatchesStructure)
+from testtools.twistedsupport import failed, has_no_result, succeeded
+from twisted.internet.defer import Deferred, fail, gatherResults, succeed
+from twisted.internet.task import Clock
+
+from marathon_acme.issuance_queue import IssuanceQueue
+from marathon_acme.rate_limiter import RateLimitedError, RateLimiter
+
+
+class TestIssuanceQueue(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.issuing = []
+
+        def issue(domain):
+            d = Deferred()
+            self.issuing.append((domain, d))
+            return d
+        self.queue = IssuanceQueue(issue, self.clock, concurrency=2)
+
+    def test_concurrency_limit(self):
+        """
+        When more domains are submitted than the concurrency limit, only that
+        many should be issued at once, and the rest should be issued in order
+        as issuances complete.
+        """
+        ds = [self.queue.submit(domain) for domain in ['a', 'b', 'c', 'd']]
+        assert_that([domain for domain, _ in self.issuing],
+                    Equals(['a', 'b']))
+        assert_that(self.queue, MatchesStructure(
+            active=Equals(2), depth=Equals(2), started=Equals(2)))
+
+        self.issuing[1][1].callback('cert b')
+        assert_that([domain for domain, _ in self.issuing],
+                    Equals(['a', 'b', 'c']))
+        assert_that(ds[1], succeeded(Equals('cert b')))
+        assert_that(ds[0], has_no_result())
+
+        # Finishing issuances starts the remaining ones
+        for _, d in self.issuing:
+            if not d.called:
+                d.callback(None)
+        assert_that(self.issuing, HasLength(4))
+        assert_that(self.queue, MatchesStructure(
+            active=Equals(0), depth=Equals(0), started=Equals(4)))
+
+    def test_aggregate_result(self):
+        """
+        When the results of the submitted domains are gathered, the aggregate
+        result should fail if any of the issuances failed, and the other
+        issuances should still complete.
+        """
+        d = gatherResults(
+            [self.queue.submit(domain) for domain in ['a', 'b', 'c']],
+            consumeErrors=True)
+
+        self.issuing[0][1].errback(RuntimeError('Oops'))
+        self.issuing[1][1].callback('cert b')
+        self.issuing[2][1].callback('cert c')
+
+        assert_that(d, failed(MatchesStructure(
+            value=MatchesStructure(index=Equals(0)))))
+        assert_that(self.queue.active, Equals(0))
+
+    def test_duplicate_domains_joined(self):
+        """
+        When a domain is submitted while it is waiting or being issued, the
+        submission should get the result of the issuance in flight rather
+        than starting another.
+        """
+        ds = [self.queue.submit(domain) for domain in ['a', 'b', 'c']]
+        ds.append(self.queue.submit('a'))
+        ds.append(self.queue.submit('c'))
+        assert_that(self.queue.in_flight('c'), Equals(True))
+
+        self.issuing[0][1].callback('cert a')
+        self.issuing[1][1].callback('cert b')
+        self.issuing[2][1].callback('cert c')
+
+        assert_that([domain for domain, _ in self.issuing],
+                    Equals(['a', 'b', 'c']))
+        assert_that(ds[3], succeeded(Equals('cert a')))
+        assert_that(ds[4], succeeded(Equals('cert c')))
+        assert_that(self.queue.joined, Equals(2))
+        assert_that(self.queue.in_flight('c'), Equals(False))
+
+    def test_domain_resubmitted_after_issuance(self):
+        """
+        When a domain is submitted after its issuance completed, it should be
+        issued again.
+        """
+        failed_d = self.queue.submit('a')
+        self.issuing[0][1].errback(RuntimeError('Oops'))
+        assert_that(failed_d, failed(MatchesStructure(
+            value=IsInstance(RuntimeError))))
+        d = self.queue.submit('a')
+
+        assert_that(self.issuing, HasLength(2))
+        assert_that(d, has_no_result())
+
+    def test_wait_times(self):
+        """
+        The time that issuances waited to start should be recorded.
+        """
+        self.queue.submit('a')
+        self.queue.submit('b')
+        self.queue.submit('c')
+
+        self.clock.advance(5)
+        self.issuing[0][1].callback(None)
+        self.clock.advance(5)
+        self.issuing[1][1].callback(None)
+
+        assert_that(self.queue, MatchesStructure(
+            total_wait=Equals(5.0), max_wait=Equals(5.0)))
+
+    def test_synchronous_issuance(self):
+        """
+        When issuances complete synchronously, many domains can be submitted
+        without issuances being started recursively.
+        """
+        queue = IssuanceQueue(succeed, self.clock, concurrency=1)
+        d = gatherResults([queue.submit(i) for i in range(5000)])
+
+        assert_that(d, succeeded(Equals(list(range(5000)))))
+        assert_that(queue.started, Equals(5000))
+
+
+class TestIssuanceQueueRateLimits(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.issuing = []
+        self.rate_limiter = RateLimiter(
+            self.clock, domain_limit=1, domain_window=100, account_limit=10,
+            account_window=100)
+
+        def issue(domain):
+            d = Deferred()
+            self.issuing.append((domain, d))
+            return d
+        self.queue = IssuanceQueue(
+            issue, self.clock, concurrency=2, rate_limiter=self.rate_limiter)
+
+    def test_domain_held(self):
+        """
+        When a domain is over its rate limit, it should be held until the rate
+        limit allows it to be issued, while other domains are issued. The
+        deferred for the held domain should fail with ``RateLimitedError``.
+        """
+        self.queue.submit('a.example.com')
+        self.issuing[0][1].callback(None)
+
+        d = self.queue.submit('b.example.com')
+        self.queue.submit('example.org')
+
+        assert_that(d, failed(MatchesStructure(value=MatchesAll(
+            IsInstance(RateLimitedError),
+            MatchesStructure(domain=Equals('b.example.com'),
+                             retry_after=Equals(100))))))
+        assert_that([domain for domain, _ in self.issuing],
+                    Equals(['a.example.com', 'example.org']))
+        assert_that(self.queue, MatchesStructure(
+            held=Equals(1), depth=Equals(1)))
+        assert_that(self.queue.projected_completion(), Equals(100))
+
+        # Submitting the held domain again should fail without issuing
+        assert_that(self.queue.submit('b.example.com'), failed(
+            MatchesStructure(value=IsInstance(RateLimitedError))))
+
+        self.clock.advance(100)
+        assert_that([domain for domain, _ in self.issuing],
+                    Equals(['a.example.com', 'example.org', 'b.example.com']))
+        assert_that(self.queue, MatchesStructure(
+            held=Equals(0), depth=Equals(0)))
+
+    def test_rate_limited_error(self):
+        """
+        When an issuance fails with ``RateLimitedError``, the domain should be
+        held until the retry time and then issued again.
+        """
+        d = self.queue.submit('example.com')
+        self.issuing[0][1].errback(RateLimitedError('example.com', 60))
+
+        assert_that(d, failed(MatchesStructure(value=MatchesAll(
+            IsInstance(RateLimitedError),
+            MatchesStructure(retry_after=Equals(60))))))
+        assert_that(self.rate_limiter.rate_limited_errors, Equals(1))
+        assert_that(self.queue.held, Equals(1))
+
+        self.clock.advance(60)
+        assert_that(self.issuing, HasLength(2))
+        assert_that(self.queue.active, Equals(1))
+
+    def test_failed_issuance_not_counted(self):
+        """
+        When an issuance fails, it should not count towards the rate limit for
+        its registered domain, so that another domain under it can be issued
+        straight away.
+        """
+        d = self.queue.submit('a.example.com')
+        self.issuing[0][1].errback(RuntimeError('order failed'))
+        assert_that(d, failed(MatchesStructure(
+            value=IsInstance(RuntimeError))))
+
+        assert_that(self.rate_limiter.available_at('b.example.com'),
+                    Equals(self.clock.seconds()))
+        self.queue.submit('b.example.com')
+        assert_that([domain for domain, _ in self.issuing],
+                    Equals(['a.example.com', 'b.example.com']))
+        assert_that(self.queue.held, Equals(0))
+
+    def test_synchronous_rate_limited_error(self):
+        """
+        When an issuance fails synchronously with ``RateLimitedError``, the
+        domain should still be held.
+        """
+        queue = IssuanceQueue(
+            lambda domain: fail(RateLimitedError(domain, 60)), self.clock,
+            rate_limiter=self.rate_limiter)
+        d = queue.submit('example.com')
+
+        assert_that(d, failed(MatchesStructure(
+            value=IsInstance(RateLimitedError))))
+        assert_that(queue, MatchesStructure(held=Equals(1), active=Equals(0)))
+        assert_that(self.clock.getDelayedCalls(), HasLength(1))
+
+    def test_stop(self):
+        """
+        When the queue is stopped, held domains should no longer be retried.
+        """
+        self.queue.submit('example.com')
+        self.issuing[0][1].errback(RateLimitedError('example.com', 60))
+        self.queue.stop()
+
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+
+
+class TestIssuanceQueuePriorities(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.issuing = []
+
+        def issue(domain):
+            d = Deferred()
+            self.issuing.append((domain, d))
+            return d
+        self.queue = IssuanceQueue(issue, self.clock, concurrency=2)
+
+    def issuing_domains(self):
+        return [domain for domain, _ in self.issuing]
+
+    def finish(self, domain):
+        next(d for name, d in self.issuing if name == domain).callback(None)
+
+    def test_priority_order(self):
+        """
+        When issuances are waiting in several lanes, those in higher priority
+        lanes should be started first.
+        """
+        self.queue.submit('first')
+        self.queue.submit('second')
+        self.queue.submit('early', IssuanceQueue.RENEW_EARLY)
+        self.queue.submit('urgent', IssuanceQueue.RENEW_URGENT)
+        self.queue.submit('new')
+
+        self.finish('first')
+        self.finish('second')
+        self.finish('new')
+        assert_that(self.issuing_domains(), Equals(
+            ['first', 'second', 'new', 'urgent']))
+
+        self.finish('urgent')
+        assert_that(self.issuing_domains(), Equals(
+            ['first', 'second', 'new', 'urgent', 'early']))
+
+    def test_renewals_leave_slot_free(self):
+        """
+        When renewals are waiting, they should not take the last free slot so
+        that a new domain can be issued straight away.
+        """
+        self.queue.submit('a', IssuanceQueue.RENEW_EARLY)
+        self.queue.submit('b', IssuanceQueue.RENEW_URGENT)
+        assert_that(self.issuing_domains(), Equals(['a']))
+
+        self.queue.submit('new')
+        assert_that(self.issuing_domains(), Equals(['a', 'new']))
+        assert_that(self.queue.lane_depth(IssuanceQueue.RENEW_URGENT),
+                    Equals(1))
+
+    def test_promote(self):
+        """
+        When a domain waiting in a lower priority lane is submitted with a
+        higher priority, it should be moved up to the higher priority lane
+        and both submissions should get the result.
+        """
+        self.queue.submit('a', IssuanceQueue.RENEW_EARLY)
+        d1 = self.queue.submit('b', IssuanceQueue.RENEW_EARLY)
+        d2 = self.queue.submit('b')
+
+        assert_that(self.issuing_domains(), Equals(['a', 'b']))
+        assert_that(self.queue.lane_depth(IssuanceQueue.RENEW_EARLY),
+                    Equals(0))
+
+        self.finish('b')
+        assert_that(d1, succeeded(Is(None)))
+        assert_that(d2, succeeded(Is(None)))
+
+    def test_lane_stats(self):
+        """
+        The wait times of started issuances should be recorded per lane.
+        """
+        self.queue.submit('b', IssuanceQueue.RENEW_EARLY)
+        self.queue.submit('c', IssuanceQueue.RENEW_EARLY)
+        self.queue.submit('a')
+        self.clock.advance(10)
+        self.finish('a')
+        self.finish('b')
+
+        assert_that(self.queue.lane_stats[IssuanceQueue.FIRST_ISSUE],
+                    MatchesStructure(started=Equals(1), mean_wait=Equals(0)))
+        assert_that(self.queue.lane_stats[IssuanceQueue.RENEW_EARLY],
+                    MatchesStructure(started=Equals(2), total_wait=Equals(10),
+                                     max_wait=Equals(10),
+                                     mean_wait=Equals(5)))
+        assert_that(self.queue.lane_stats[IssuanceQueue.RENEW_URGENT],
+                    MatchesStructure(started=Equals(0), mean_wait=Equals(0)))
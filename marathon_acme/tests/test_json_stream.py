@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+import json
+
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is
+from testtools.twistedsupport import failed, succeeded
+from twisted.internet.error import ConnectionLost
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+from marathon_acme.json_stream import JsonFieldStreamProtocol
+from marathon_acme.tests.matchers import WithErrorTypeAndMessage
+
+
+class DummyTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class TestJsonFieldStreamProtocol(object):
+    def setup_method(self):
+        self.elements = []
+        self.protocol = JsonFieldStreamProtocol('apps', self.elements.append)
+
+        self.transport = DummyTransport()
+        self.protocol.transport = self.transport
+        self.finished = self.protocol.when_finished()
+
+    def deliver(self, body, chunk_size=None):
+        data = body.encode('utf-8')
+        chunk_size = chunk_size or len(data)
+        for i in range(0, len(data), chunk_size):
+            self.protocol.dataReceived(data[i:i + chunk_size])
+
+    def finish(self):
+        self.protocol.connectionLost(Failure(ResponseDone()))
+
+    def test_elements(self):
+        """
+        When a response body with an array in the field is received, the
+        handler should be called with each element of the array and the
+        protocol should finish with the number of elements.
+        """
+        self.deliver('{"apps": [{"id": "/app1"}, {"id": "/app2"}]}')
+        self.finish()
+
+        assert_that(self.elements,
+                    Equals([{'id': '/app1'}, {'id': '/app2'}]))
+        assert_that(self.finished, succeeded(Equals(2)))
+
+    def test_elements_as_received(self):
+        """
+        When a response body is received in chunks, the handler should be
+        called with each element as soon as it has been received, and only the
+        incomplete element should be buffered.
+        """
+        self.deliver('{"apps": [{"id": "/app1"}, {"id": "/ap')
+
+        assert_that(self.elements, Equals([{'id': '/app1'}]))
+        assert_that(''.join(self.protocol._chunks), Equals('{"id": "/ap'))
+
+        self.deliver('p2"}]}')
+        self.finish()
+
+        assert_that(self.elements,
+                    Equals([{'id': '/app1'}, {'id': '/app2'}]))
+        assert_that(self.finished, succeeded(Equals(2)))
+
+    def test_chunk_sizes(self):
+        """
+        When a response body is received in chunks of any size, including
+        chunks that split multi-byte characters and escape sequences, the
+        elements should be parsed the same.
+        """
+        apps = [{
+            'id': '/app%d' % (i,),
+            'labels': {
+                'MARATHON_ACME_0_DOMAIN': u'ëxample.com',
+                'x': '"]},\\',
+            },
+            'ports': [9000, 9001],
+            'mem': 128.5,
+            'cmd': None,
+            'container': {'docker': {'forcePullImage': True}},
+        } for i in range(5)]
+        body = json.dumps(
+            {'version': {'a': [1]}, 'apps': apps, 'after': 'x'}, indent=2,
+            ensure_ascii=False)
+
+        for chunk_size in [1, 2, 3, 7, 100]:
+            self.setup_method()
+            self.deliver(body, chunk_size)
+            self.finish()
+
+            assert_that(self.elements, Equals(apps))
+            assert_that(self.finished, succeeded(Equals(5)))
+
+    def test_large_element_in_many_chunks(self):
+        """
+        When a large element is received in many small chunks, the chunks
+        should be kept as they are received rather than joined until the
+        element is complete.
+        """
+        app = {'id': '/app1', 'env': dict(
+            ('VAR_%d' % (i,), '"value" {[%d]}\\' % (i,)) for i in range(1000))}
+        body = '{"apps": [%s]}' % (json.dumps(app),)
+
+        self.deliver(body[:-3], 16)
+        assert_that(self.elements, Equals([]))
+        assert_that(self.protocol._buffer, Equals(''))
+        assert_that(len(self.protocol._chunks) > 100, Is(True))
+
+        self.deliver(body[-3:])
+        self.finish()
+        assert_that(self.elements, Equals([app]))
+        assert_that(self.finished, succeeded(Equals(1)))
+
+    def test_scalar_elements(self):
+        """
+        When the array has scalar elements, each should only be parsed once
+        it is known to be complete.
+        """
+        self.deliver('{"apps": [12', 1)
+        assert_that(self.elements, Equals([]))
+
+        self.deliver('3, "a", true]}')
+        self.finish()
+        assert_that(self.elements, Equals([123, 'a', True]))
+
+    def test_scalars_one_byte_at_a_time(self):
+        """
+        When scalar values are received one byte at a time, a value that is
+        complete so far but continues in the next byte, like the ``1.`` of
+        ``1.5``, should not be parsed until a delimiter follows it.
+        """
+        body = ('{"count": 12.5, "apps": [1.5, 1e5, -2, 3.25E-1, 10, true, '
+                'null, "a"], "after": -0.5e+2}')
+        self.deliver(body, 1)
+        self.finish()
+
+        assert_that(self.elements,
+                    Equals([1.5, 1e5, -2, 3.25e-1, 10, True, None, 'a']))
+        assert_that(self.finished, succeeded(Equals(8)))
+
+    def test_empty_array(self):
+        """
+        When the array is empty, the handler should not be called and the
+        protocol should finish with no elements.
+        """
+        self.deliver('{"apps": []}')
+        self.finish()
+
+        assert_that(self.elements, Equals([]))
+        assert_that(self.finished, succeeded(Equals(0)))
+
+    def test_field_missing(self):
+        """
+        When the field isn't in the response body, an error should be raised.
+        """
+        self.deliver('{"other": [1, 2]}')
+        self.finish()
+
+        assert_that(self.finished, failed(WithErrorTypeAndMessage(
+            KeyError,
+            '\'Unable to get value for "apps" from Marathon response\'')))
+
+    def test_not_array(self):
+        """
+        When the field isn't an array, an error should be raised and the rest
+        of the response body discarded.
+        """
+        self.deliver('{"apps": {}}')
+        assert_that(self.transport.stopped, Is(True))
+
+        self.deliver('more data')
+        self.finish()
+
+        assert_that(self.finished, failed(WithErrorTypeAndMessage(
+            ValueError, "Expected one of '[' in JSON at '{}}'")))
+
+    def test_incomplete(self):
+        """
+        When the response body ends before the JSON object does, an error
+        should be raised.
+        """
+        self.deliver('{"apps": [{"id": "/app1"}, {"id"')
+        self.finish()
+
+        assert_that(self.elements, Equals([{'id': '/app1'}]))
+        assert_that(self.finished, failed(WithErrorTypeAndMessage(
+            ValueError, 'Invalid or incomplete JSON object in response body')))
+
+    def test_handler_error(self):
+        """
+        When the handler raises an error, the error should be raised and the
+        rest of the response body discarded.
+        """
+        def handler(element):
+            raise RuntimeError('Something bad')
+        self.protocol = JsonFieldStreamProtocol('apps', handler)
+        self.protocol.transport = self.transport
+        finished = self.protocol.when_finished()
+
+        self.deliver('{"apps": [1, 2]}')
+        self.finish()
+
+        assert_that(self.transport.stopped, Is(True))
+        assert_that(finished, failed(WithErrorTypeAndMessage(
+            RuntimeError, 'Something bad')))
+
+    def test_connection_lost(self):
+        """
+        When the connection is lost before the response body is complete, the
+        reason should be raised.
+        """
+        self.deliver('{"apps": [1, ')
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+
+        assert_that(self.finished, failed(WithErrorTypeAndMessage(
+            ConnectionLost, 'Connection to the other side was lost in a '
+                            'non-clean fashion.')))
@@ -0,0 +1,162 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is
+
+from marathon_acme.label_extractor import LabelExtractor, parse_domain_label
+from marathon_acme.label_selector import LabelSelector
+
+
+class TestParseDomainLabel(object):
+    def test_single_domain(self):
+        """
+        When the domain label contains just a single domain, that domain should
+        be parsed into a list containing just the one domain.
+        """
+        domains = parse_domain_label('example.com')
+        assert_that(domains, Equals(['example.com']))
+
+    def test_whitespace(self):
+        """
+        When the domain label contains whitespace, the whitespace should be
+        ignored.
+        """
+        domains = parse_domain_label(' ')
+        assert_that(domains, Equals([]))
+
+    def test_multiple_domains(self):
+        """
+        When the domain label contains multiple comma-separated domains, the
+        domains should be parsed into a list of domains.
+        """
+        domains = parse_domain_label('example.com,example2.com')
+        assert_that(domains, Equals(['example.com', 'example2.com']))
+
+    def test_multiple_domains_whitespace(self):
+        """
+        When the domain label contains multiple comma-separated domains with
+        whitespace inbetween, the domains should be parsed into a list of
+        domains without the whitespace.
+        """
+        domains = parse_domain_label(' example.com, example2.com ')
+        assert_that(domains, Equals(['example.com', 'example2.com']))
+
+
+class TestLabelExtractor(object):
+    def setup_method(self):
+        self.extractor = LabelExtractor(['external', 'internal'])
+
+    def test_extract(self):
+        """
+        When an app's ports are extracted, the group and domains for each
+        port that is in one of the groups and has domains should be returned.
+        """
+        app_ports = self.extractor.extract({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'HAPROXY_1_GROUP': 'internal',
+                'HAPROXY_2_GROUP': 'other',
+                'HAPROXY_0_VHOST': 'example.com',
+                'MARATHON_ACME_0_DOMAIN': 'example.com,www.example.com',
+                'MARATHON_ACME_1_DOMAIN': 'internal.example.com',
+                'MARATHON_ACME_2_DOMAIN': 'other.example.com',
+                'MARATHON_ACME_3_DOMAIN': ' ',
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}},
+                {'port': 9001, 'protocol': 'tcp', 'labels': {}},
+                {'port': 9002, 'protocol': 'tcp', 'labels': {}},
+                {'port': 9003, 'protocol': 'tcp', 'labels': {}},
+            ]
+        })
+
+        assert_that(app_ports, Equals({
+            0: ('external', ['example.com', 'www.example.com']),
+            1: ('internal', ['internal.example.com']),
+        }))
+
+    def test_extract_ports_fallback(self):
+        """
+        When an app has no 'portDefinitions' field, the deprecated 'ports'
+        field should be used to find its ports, and labels for ports that the
+        app doesn't have should be ignored.
+        """
+        app_ports = self.extractor.extract({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com',
+                'MARATHON_ACME_1_DOMAIN': 'example2.com',
+            },
+            'ports': [9000]
+        })
+
+        assert_that(app_ports, Equals({0: ('external', ['example.com'])}))
+
+    def test_extract_leading_zeros(self):
+        """
+        When an app has labels with port indexes that have leading zeros,
+        those labels should be ignored.
+        """
+        app_ports = self.extractor.extract({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'HAPROXY_01_GROUP': 'other',
+                'MARATHON_ACME_01_DOMAIN': 'example.com',
+                'MARATHON_ACME_1_DOMAIN': 'example2.com',
+                'MARATHON_ACME_1_DOMAIN_X': 'example3.com',
+            },
+            'ports': [9000, 9001]
+        })
+
+        assert_that(app_ports, Equals({1: ('external', ['example2.com'])}))
+
+    def test_extract_selector(self):
+        """
+        When the extractor has a label selector, only the domains of apps
+        whose labels match the selector should be extracted.
+        """
+        extractor = LabelExtractor(
+            ['external'], selector=LabelSelector('ACME==true'))
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com',
+            },
+            'ports': [9000]
+        }
+
+        assert_that(extractor.extract(app), Equals({}))
+
+        app['labels']['ACME'] = 'true'
+        assert_that(extractor.extract(app),
+                    Equals({0: ('external', ['example.com'])}))
+
+    def test_extract_all(self):
+        """
+        When the ports of a list of apps are extracted, the ports for every
+        app should be returned by app ID, and a parsed domain label should be
+        reused for apps with the same label without sharing the list.
+        """
+        apps = [{
+            'id': '/my-app_%d' % (i,),
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com',
+            },
+            'ports': [9000]
+        } for i in range(2)]
+        apps.append({'id': '/my-app_2', 'labels': {}, 'ports': [9000]})
+
+        apps_ports = self.extractor.extract_all(apps)
+
+        assert_that(apps_ports, Equals({
+            '/my-app_0': {0: ('external', ['example.com'])},
+            '/my-app_1': {0: ('external', ['example.com'])},
+            '/my-app_2': {},
+        }))
+        assert_that(self.extractor._parsed_labels,
+                    Equals({'example.com': ('example.com',)}))
+        assert_that(apps_ports['/my-app_0'][0][1] is
+                    apps_ports['/my-app_1'][0][1], Is(False))
@@ -0,0 +1,95 @@
+from testtools import ExpectedException
+from testtools.assertions import assert_that
+from testtools.matchers import Equals
+
+from marathon_acme.label_selector import LabelSelector
+
+
+class TestLabelSelector(object):
+    def test_exists(self):
+        """
+        When a selector is just a label key, it should only match labels that
+        have that key.
+        """
+        selector = LabelSelector('MARATHON_ACME_0_DOMAIN')
+        assert_that(selector.matches({'MARATHON_ACME_0_DOMAIN': ''}),
+                    Equals(True))
+        assert_that(selector.matches({'HAPROXY_GROUP': 'external'}),
+                    Equals(False))
+
+    def test_equality(self):
+        """
+        When a selector has an equality or inequality term, it should only
+        match labels where the key exists and does or doesn't have the value.
+        """
+        selector = LabelSelector('HAPROXY_GROUP==external')
+        assert_that(selector.matches({'HAPROXY_GROUP': 'external'}),
+                    Equals(True))
+        assert_that(selector.matches({'HAPROXY_GROUP': 'internal'}),
+                    Equals(False))
+        assert_that(selector.matches({}), Equals(False))
+
+        selector = LabelSelector('HAPROXY_GROUP != internal')
+        assert_that(selector.matches({'HAPROXY_GROUP': 'external'}),
+                    Equals(True))
+        assert_that(selector.matches({'HAPROXY_GROUP': 'internal'}),
+                    Equals(False))
+        assert_that(selector.matches({}), Equals(False))
+
+    def test_set(self):
+        """
+        When a selector has an 'in' or 'notin' term, it should only match
+        labels where the key exists and does or doesn't have one of the
+        values.
+        """
+        selector = LabelSelector('HAPROXY_GROUP in (external, internal)')
+        assert_that(selector.matches({'HAPROXY_GROUP': 'internal'}),
+                    Equals(True))
+        assert_that(selector.matches({'HAPROXY_GROUP': 'other'}),
+                    Equals(False))
+        assert_that(selector.matches({}), Equals(False))
+
+        selector = LabelSelector('HAPROXY_GROUP notin (external,internal)')
+        assert_that(selector.matches({'HAPROXY_GROUP': 'internal'}),
+                    Equals(False))
+        assert_that(selector.matches({'HAPROXY_GROUP': 'other'}),
+                    Equals(True))
+        assert_that(selector.matches({}), Equals(False))
+
+    def test_multiple_terms(self):
+        """
+        When a selector has several comma-separated terms, it should only
+        match labels that match all of the terms.
+        """
+        selector = LabelSelector(
+            'HAPROXY_GROUP in (external,internal),MARATHON_ACME_0_DOMAIN')
+        assert_that(selector.matches({
+            'HAPROXY_GROUP': 'external',
+            'MARATHON_ACME_0_DOMAIN': 'example.com',
+        }), Equals(True))
+        assert_that(selector.matches({'HAPROXY_GROUP': 'external'}),
+                    Equals(False))
+
+    def test_escaped(self):
+        """
+        When a selector has special characters escaped with a backslash, they
+        should be treated as part of the key or value.
+        """
+        selector = LabelSelector(r'DOMAINS==example.com\,example2.com')
+        assert_that(
+            selector.matches({'DOMAINS': 'example.com,example2.com'}),
+            Equals(True))
+
+    def test_invalid(self):
+        """
+        When a selector has a term that isn't valid, an error should be
+        raised.
+        """
+        with ExpectedException(
+                ValueError,
+                r"'HAPROXY_GROUP external' is not a valid label selector "
+                r"term in 'HAPROXY_GROUP external'"):
+            LabelSelector('HAPROXY_GROUP external')
+
+        with ExpectedException(ValueError):
+            LabelSelector('HAPROXY_GROUP==external,')
@@ -0,0 +1,139 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is
+from twisted.internet.task import Clock
+from twisted.web.http import datetimeToString
+
+from marathon_acme.rate_limiter import (
+    RateLimiter, parse_retry_after, registered_domain)
+
+
+class TestParseRetryAfter(object):
+    def test_seconds(self):
+        """
+        When the value is a number of seconds, that number should be returned.
+        """
+        assert_that(parse_retry_after(b' 120 ', 1000), Equals(120))
+
+    def test_http_date(self):
+        """
+        When the value is an HTTP date, the number of seconds until that date
+        should be returned.
+        """
+        assert_that(parse_retry_after(datetimeToString(1060), 1000),
+                    Equals(60))
+
+    def test_http_date_past(self):
+        """
+        When the value is an HTTP date in the past, 0 should be returned.
+        """
+        assert_that(parse_retry_after(datetimeToString(940), 1000),
+                    Equals(0))
+
+    def test_invalid(self):
+        """
+        When the value can't be parsed, None should be returned.
+        """
+        assert_that(parse_retry_after(b'soon', 1000), Is(None))
+
+
+class TestRegisteredDomain(object):
+    def test_subdomain(self):
+        """
+        The registered domain of a subdomain should be its last two labels.
+        """
+        assert_that(registered_domain('a.b.example.com'),
+                    Equals('example.com'))
+
+    def test_registered_domain(self):
+        """
+        The registered domain of a registered domain should be itself.
+        """
+        assert_that(registered_domain('example.com'), Equals('example.com'))
+
+
+class TestRateLimiter(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.limiter = RateLimiter(
+            self.clock, domain_limit=2, domain_window=100, account_limit=3,
+            account_window=10)
+
+    def test_available_now(self):
+        """
+        When no certificates have been issued, a certificate should be
+        available now.
+        """
+        assert_that(self.limiter.available_at('example.com'), Equals(1000))
+
+    def test_domain_limit(self):
+        """
+        When the limit of certificates for a registered domain has been
+        issued, a certificate for any name in that domain should only be
+        available once the oldest issuance is outside the window. Other
+        domains should not be affected.
+        """
+        self.limiter.record_issued('a.example.com')
+        self.clock.advance(20)
+        self.limiter.record_issued('b.example.com')
+
+        assert_that(self.limiter.available_at('c.example.com'), Equals(1100))
+        assert_that(self.limiter.available_at('example.org'), Equals(1020))
+
+        self.clock.advance(80)
+        assert_that(self.limiter.available_at('c.example.com'), Equals(1100))
+
+    def test_account_limit(self):
+        """
+        When the limit of orders for the account has been made, no
+        certificate should be available until the oldest order is outside the
+        window.
+        """
+        for _ in range(3):
+            self.limiter.record_order()
+            self.clock.advance(1)
+
+        assert_that(self.limiter.available_at('example.org'), Equals(1010))
+
+    def test_rate_limited(self):
+        """
+        When a rate-limit error is recorded, certificates for the registered
+        domain should only be available after the retry time, or after the
+        default retry time if none was given.
+        """
+        self.limiter.default_retry_after = 500
+        self.limiter.rate_limited('a.example.com', 60)
+        self.limiter.rate_limited('example.org')
+
+        assert_that(self.limiter.available_at('b.example.com'), Equals(1060))
+        assert_that(self.limiter.available_at('example.org'), Equals(1500))
+        assert_that(self.limiter.rate_limited_errors, Equals(2))
+
+    def test_projected_completion(self):
+        """
+        The projected completion time should account for the issuances that
+        the pending domains would use up.
+        """
+        self.limiter.record_issued('a.example.com')
+        completion = self.limiter.projected_completion(
+            ['b.example.com', 'c.example.com', 'example.org'])
+
+        # c.example.com has to wait for a.example.com's issuance to expire
+        assert_that(completion, Equals(1100))
+
+    def test_projected_completion_account_limit(self):
+        """
+        When the pending domains would exceed the account limit, the projected
+        completion time should account for waiting for the window.
+        """
+        completion = self.limiter.projected_completion(
+            ['a.com', 'b.com', 'c.com', 'd.com', 'e.com'])
+
+        assert_that(completion, Equals(1010))
+
+    def test_projected_completion_empty(self):
+        """
+        When there are no pending domains, the projected completion time
+        should be now.
+        """
+        assert_that(self.limiter.projected_completion([]), Equals(1000))
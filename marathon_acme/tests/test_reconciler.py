@@ -0,0 +1,77 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, HasLength
+from twisted.internet.task import Clock
+
+from marathon_acme.reconciler import Reconciler
+
+
+class TestReconciler(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.triggers = []
+        self.healthy = False
+        self.reconciler = Reconciler(
+            lambda: self.triggers.append(self.clock.seconds()), self.clock,
+            is_healthy=lambda: self.healthy, interval=10.0, jitter=0.5,
+            random=lambda: 0.0)
+
+    def test_reconciles_periodically(self):
+        """
+        When the reconciler is started, a sync should be triggered after each
+        interval but not immediately.
+        """
+        self.reconciler.start()
+        assert_that(self.triggers, HasLength(0))
+
+        self.clock.advance(10)
+        self.clock.advance(10)
+        assert_that(self.triggers, Equals([10, 20]))
+        assert_that(self.reconciler.reconciliations, Equals(2))
+
+    def run_for(self, seconds):
+        """ Advance the clock half a second at a time. """
+        for _ in range(seconds * 2):
+            self.clock.advance(0.5)
+
+    def test_interval_stretches_while_healthy(self):
+        """
+        When things are healthy, the interval should be doubled after each
+        reconciliation up to the maximum, and when they are not, it should be
+        reset to the base interval.
+        """
+        self.healthy = True
+        self.reconciler.start()
+        self.run_for(150)
+        assert_that(self.triggers, Equals([10, 30, 70, 110, 150]))
+        assert_that(self.reconciler.interval, Equals(40))
+
+        # The interval was stretched by the last reconciliation, so the next
+        # one is after 40 seconds and the one after that after 10
+        self.healthy = False
+        self.run_for(50)
+        assert_that(self.triggers, Equals([10, 30, 70, 110, 150, 190, 200]))
+
+    def test_jitter(self):
+        """
+        Each interval should be shortened by up to the jitter fraction of the
+        interval in effect after the previous reconciliation, measured from
+        that reconciliation.
+        """
+        self.healthy = True
+        self.reconciler._random = lambda: 0.5
+        self.reconciler.start()
+        self.run_for(60)
+        # 10 * 0.75, then 20 * 0.75, then 40 * 0.75
+        assert_that(self.triggers, Equals([7.5, 22.5, 52.5]))
+
+    def test_stop(self):
+        """
+        When the reconciler is stopped, no more syncs should be triggered.
+        """
+        self.reconciler.start()
+        self.reconciler.stop()
+        self.reconciler.stop()
+
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+        self.clock.advance(10)
+        assert_that(self.triggers, HasLength(0))
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from acme import challenges
 from acme.jose import JWKRSA
@@ -8,52 +8,20 @@ from testtools.matchers import (
     AfterPreprocessing, Equals, HasLength, Is, IsInstance, MatchesAll,
     MatchesDict, MatchesListwise, MatchesPredicate, MatchesStructure, Not)
 from testtools.twistedsupport import failed, succeeded
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.task import Clock
+from twisted.web.http_headers import Headers
 from txacme.client import ServerError as txacme_ServerError
 from txacme.testing import FakeClient, MemoryStore
 from txacme.util import generate_private_key
 
 from marathon_acme.clients import MarathonClient, MarathonLbClient
-from marathon_acme.service import MarathonAcme, parse_domain_label
+from marathon_acme.service import MarathonAcme
+from marathon_acme.sse_protocol import SseProtocol
 from marathon_acme.tests.fake_marathon import (
     FakeMarathon, FakeMarathonAPI, FakeMarathonLb)
-from marathon_acme.tests.helpers import failing_client
-
-
-class TestParseDomainLabel(object):
-    def test_single_domain(self):
-        """
-        When the domain label contains just a single domain, that domain should
-        be parsed into a list containing just the one domain.
-        """
-        domains = parse_domain_label('example.com')
-        assert_that(domains, Equals(['example.com']))
-
-    def test_whitespace(self):
-        """
-        When the domain label contains whitespace, the whitespace should be
-        ignored.
-        """
-        domains = parse_domain_label(' ')
-        assert_that(domains, Equals([]))
-
-    def test_multiple_domains(self):
-        """
-        When the domain label contains multiple comma-separated domains, the
-        domains should be parsed into a list of domains.
-        """
-        domains = parse_domain_label('example.com,example2.com')
-        assert_that(domains, Equals(['example.com', 'example2.com']))
-
-    def test_multiple_domains_whitespace(self):
-        """
-        When the domain label contains multiple comma-separated domains with
-        whitespace inbetween, the domains should be parsed into a list of
-        domains without the whitespace.
-        """
-        domains = parse_domain_label(' example.com, example2.com ')
-        assert_that(domains, Equals(['example.com', 'example2.com']))
+from marathon_acme.tests.helpers import cert_names, failing_client
+from marathon_acme.tests.matchers import HasHeader
 
 
 is_marathon_lb_sigusr_response = MatchesListwise([  # Per marathon-lb instance
@@ -86,18 +54,25 @@ class FailableTxacmeClient(FakeClient):
         return super(FailableTxacmeClient, self).request_issuance(csr)
 
 
+class FakeResponse(object):
+    """ Just enough of a treq response for txacme's ``ServerError``. """
+
+    def __init__(self, headers):
+        self.headers = Headers(headers)
+
+
 class TestMarathonAcme(object):
 
     def setup_method(self):
         self.fake_marathon = FakeMarathon()
         self.fake_marathon_api = FakeMarathonAPI(self.fake_marathon)
-        marathon_client = MarathonClient(
+        self.marathon_client = MarathonClient(
             ['http://localhost:8080'], client=self.fake_marathon_api.client)
 
         self.cert_store = MemoryStore()
 
         self.fake_marathon_lb = FakeMarathonLb()
-        mlb_client = MarathonLbClient(
+        self.mlb_client = MarathonLbClient(
             ['http://localhost:9090'], client=self.fake_marathon_lb.client)
 
         key = JWKRSA(key=generate_private_key(u'rsa'))
@@ -105,12 +80,13 @@ class TestMarathonAcme(object):
         clock.rightNow = (
             datetime.now() - datetime(1970, 1, 1)).total_seconds()
         self.txacme_client = FailableTxacmeClient(key, clock)
+        self.clock = clock
 
         self.marathon_acme = MarathonAcme(
-            marathon_client,
+            self.marathon_client,
             'external',
             self.cert_store,
-            mlb_client,
+            self.mlb_client,
             lambda: succeed(self.txacme_client),
             clock
         )
@@ -274,6 +250,339 @@ class TestMarathonAcme(object):
         assert_that(
             self.fake_marathon_api.check_called_get_apps(), Equals(True))
 
+    def test_listen_events_resumes_without_sync(self):
+        """
+        When we're listening for events and Marathon sends event IDs, and the
+        connection drops, we should resume the stream from the last event ID
+        and not run another sync as we re-attach.
+        """
+        self.fake_marathon_api.send_event_ids = True
+        self.marathon_acme.listen_events()
+
+        # Check the initial sync happens
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        # Trigger a lost connection
+        requests = self.fake_marathon_api.event_requests
+        assert_that(requests, HasLength(1))
+        requests[0].loseConnection()
+        self.fake_marathon_api.client.flush()
+
+        # We resume from the last event ID and no sync occurs
+        requests = self.fake_marathon_api.event_requests
+        assert_that(requests, HasLength(1))
+        assert_that(requests[0].requestHeaders,
+                    HasHeader('Last-Event-ID', ['1']))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+        # Events are still handled after resuming
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+    def test_listen_events_reconnection_time(self):
+        """
+        When we're listening for events and Marathon sets a reconnection time,
+        and the connection drops, we should wait for the reconnection time
+        before reconnecting.
+        """
+        self.fake_marathon_api.event_retry = 5000
+        self.marathon_acme.listen_events()
+
+        # Trigger a lost connection
+        requests = self.fake_marathon_api.event_requests
+        assert_that(requests, HasLength(1))
+        requests[0].loseConnection()
+        self.fake_marathon_api.client.flush()
+
+        # No reconnection yet...
+        assert_that(self.fake_marathon_api.event_requests, HasLength(0))
+
+        self.clock.advance(4.9)
+        self.fake_marathon_api.client.flush()
+        assert_that(self.fake_marathon_api.event_requests, HasLength(0))
+
+        self.clock.advance(0.1)
+        self.fake_marathon_api.client.flush()
+        assert_that(self.fake_marathon_api.event_requests, HasLength(1))
+
+    def test_listen_events_sync_debounced(self):
+        """
+        When a sync debounce time is set and a burst of events that trigger
+        syncs is received, a single sync should be performed once the debounce
+        time has passed.
+        """
+        self.marathon_acme.sync_scheduler.debounce = 1.0
+        self.marathon_acme.listen_events()
+
+        # The initial sync waits for the debounce time
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+        self.clock.advance(1.0)
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        # API request events without an app definition trigger full syncs
+        for _ in range(3):
+            self.fake_marathon.trigger_event(
+                'api_post_event', clientIp=None, uri='/v2/groups')
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+        self.clock.advance(1.0)
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(self.marathon_acme.sync_scheduler, MatchesStructure(
+            syncs=Equals(2), coalesced=Equals(2)))
+
+    def test_listen_events_api_request_syncs_app(self):
+        """
+        When we listen for events from Marathon and receive an API request
+        event with an app definition, certificates should be issued for the
+        app's new domains without fetching all the apps from Marathon.
+        """
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}},
+                {'port': 9001, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        self.fake_marathon.add_app(app)
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
+
+        # Post the app again with another domain: only the new domain should
+        # be issued
+        app['labels']['MARATHON_ACME_1_DOMAIN'] = 'example2.com'
+        self.fake_marathon.trigger_event(
+            'api_post_event', clientIp=None, uri='/v2/apps/my-app_1',
+            appDefinition=app)
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None)),
+            'example2.com': Not(Is(None)),
+        })))
+
+    def test_listen_events_api_request_too_large_triggers_sync(self):
+        """
+        When we listen for events from Marathon and receive an API request
+        event that is too large to parse, a full sync should be performed so
+        that certificates are still issued for the app's domains.
+        """
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'env': {'BIG': 'x' * SseProtocol.MAX_EVENT_SIZE},
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+    def test_listen_events_api_requests_issue_concurrently(self):
+        """
+        When we receive API request events with app definitions while
+        certificates are being issued for other apps, the events should be
+        handled without waiting for those issuances to finish, so that
+        certificates for different apps are issued concurrently.
+        """
+        self.marathon_acme.listen_events()
+        issuing = []
+        request_issuance = self.txacme_client.request_issuance
+
+        def held_issuance(csr):
+            d = Deferred()
+            issuing.append(d)
+            return d.addCallback(lambda _: request_issuance(csr))
+        self.txacme_client.request_issuance = held_issuance
+
+        def post_app(app_id, domain):
+            self.fake_marathon.trigger_event(
+                'api_post_event', clientIp=None, uri='/v2/apps' + app_id,
+                appDefinition={
+                    'id': app_id,
+                    'labels': {
+                        'HAPROXY_GROUP': 'external',
+                        'MARATHON_ACME_0_DOMAIN': domain
+                    },
+                    'portDefinitions': [
+                        {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+                    ]
+                })
+
+        post_app('/my-app_1', 'example.com')
+        post_app('/my-app_2', 'example2.com')
+        post_app('/my-app_3', 'example3.com')
+
+        assert_that(issuing, HasLength(3))
+        assert_that(self.marathon_acme.event_queue.depth, Equals(0))
+        assert_that(self.marathon_acme.issuance_queue.active, Equals(3))
+
+        # Posting an app again while its certificate is being issued joins the
+        # issuance in flight
+        post_app('/my-app_1', 'example.com')
+        assert_that(issuing, HasLength(3))
+
+        while issuing:
+            issuing.pop(0).callback(None)
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None)),
+            'example2.com': Not(Is(None)),
+            'example3.com': Not(Is(None)),
+        })))
+
+    def test_listen_events_reconciles(self):
+        """
+        When we listen for events from Marathon, full syncs should be run
+        periodically so that certificates are issued for apps that we missed
+        the events for, and the missed changes should be counted as drift.
+        """
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        # Add an app without sending an event
+        self.fake_marathon._apps['/my-app_1'] = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+
+        self.clock.advance(300)
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        assert_that(self.marathon_acme, MatchesStructure(
+            drift_added=Equals(1), drift_removed=Equals(0)))
+        assert_that(self.marathon_acme.reconciler.reconciliations, Equals(1))
+
+    def test_listen_events_reconcile_interval_stretches(self):
+        """
+        When the event stream stays connected and no drift is found, the
+        interval between reconciliations should be stretched.
+        """
+        self.marathon_acme.listen_events()
+        reconciler = self.marathon_acme.reconciler
+
+        self.clock.advance(300)
+        assert_that(reconciler.interval, Equals(300))
+        self.clock.advance(300)
+        assert_that(reconciler.interval, Equals(600))
+
+        # Drift found by a reconciliation resets the interval at the next one
+        self.fake_marathon._apps['/my-app_1'] = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        self.clock.advance(600)
+        assert_that(reconciler.interval, Equals(1200))
+        assert_that(self.marathon_acme.drift_added, Equals(1))
+        self.clock.advance(1200)
+        assert_that(reconciler.interval, Equals(300))
+        assert_that(reconciler.reconciliations, Equals(4))
+
+    def test_sync_app_known_domains(self):
+        """
+        When an app is synced and its domains were already found in a previous
+        sync, no certificates should be issued.
+        """
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        # Pretend the domain was found in a previous sync
+        self.marathon_acme.domain_index.update_app(
+            '/my-app_1', {0: ['example.com']})
+
+        assert_that(self.marathon_acme.sync_app(app), succeeded(Is(None)))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+        assert_that(
+            self.fake_marathon_lb.check_signalled_usr1(), Equals(False))
+
+    def test_sync_app_domain_owned_by_other_app(self):
+        """
+        When an app is synced and its domain already belongs to another app in
+        the domain index, no certificate should be issued.
+        """
+        self.marathon_acme.domain_index.update_app(
+            '/other-app', {0: ['example.com']})
+
+        d = self.marathon_acme.sync_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        assert_that(d, succeeded(Is(None)))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+        assert_that(self.marathon_acme.domain_index.owners('example.com'),
+                    Equals({('/other-app', 0), ('/my-app_1', 0)}))
+
     def test_sync_app(self):
         """
         When a sync is run and there is an app with a domain label and no
@@ -478,7 +787,8 @@ class TestMarathonAcme(object):
     def test_sync_app_multiple_domains(self):
         """
         When a sync is run and there is an app with a domain label containing
-        multiple domains, then only the first domain is considered.
+        multiple domains, then a single certificate should be issued that
+        covers all the domains, stored under the first domain.
         """
         self.fake_marathon.add_app({
             'id': '/my-app_1',
@@ -497,72 +807,197 @@ class TestMarathonAcme(object):
         ])))
 
         assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
-            'example.com': Not(Is(None))
+            'example.com': AfterPreprocessing(
+                cert_names, Equals(['example.com', 'example2.com']))
         })))
 
         assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
 
-    def test_sync_no_apps(self):
-        """
-        When a sync is run and Marathon has no apps for us then no certificates
-        should be fetched and marathon-lb should not be notified.
-        """
-        d = self.marathon_acme.sync()
-        assert_that(d, succeeded(Equals([])))
-
-        # Nothing stored, nothing notified, but Marathon checked
-        assert_that(
-            self.fake_marathon_api.check_called_get_apps(), Equals(True))
-        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
-        assert_that(self.fake_marathon_lb.check_signalled_usr1(),
-                    Equals(False))
-
-    def test_sync_app_no_domains(self):
+    def test_sync_domains_added_to_label(self):
         """
-        When a sync is run and Marathon has an app but that app has no
-        marathon-acme domains, then no certificates should be fetched and
-        marathon-lb should not be notified.
+        When a sync is run and a domain has been added to the label of an app
+        that already has a certificate, the certificate should be reissued to
+        cover the new domain.
         """
-        self.fake_marathon.add_app({
+        app = {
             'id': '/my-app_1',
             'labels': {
-                'HAPROXY_0_VHOST': 'example.com'
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
             },
             'portDefinitions': [
                 {'port': 9000, 'protocol': 'tcp', 'labels': {}}
             ]
-        })
+        }
+        self.fake_marathon.add_app(app)
+        assert_that(self.marathon_acme.sync(), succeeded(HasLength(1)))
 
-        d = self.marathon_acme.sync()
-        assert_that(d, succeeded(Equals([])))
+        app['labels']['MARATHON_ACME_0_DOMAIN'] = 'example.com,example2.com'
+        assert_that(self.marathon_acme.sync(), succeeded(MatchesListwise([
+            is_marathon_lb_sigusr_response
+        ])))
 
-        # Nothing stored, nothing notified, but Marathon checked
-        assert_that(
-            self.fake_marathon_api.check_called_get_apps(), Equals(True))
-        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
-        assert_that(self.fake_marathon_lb.check_signalled_usr1(),
-                    Equals(False))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': AfterPreprocessing(
+                cert_names, Equals(['example.com', 'example2.com']))
+        })))
 
-    def test_sync_app_group_mismatch(self):
+        # Nothing to reissue once the names match
+        assert_that(self.marathon_acme.sync(), succeeded(Equals([])))
+
+    def test_sync_app_domains_added_to_label(self):
         """
-        When a sync is run and Marathon has an app but that app has a different
-        group to the one marathon-acme is configured with, then no certificates
-        should be fetched and marathon-lb should not be notified.
+        When an app is synced from an event and a domain has been added to its
+        label, the existing certificate should be reissued to cover the new
+        domain.
         """
-        self.fake_marathon.add_app({
+        app = {
             'id': '/my-app_1',
             'labels': {
-                'HAPROXY_GROUP': 'internal',
-                'HAPROXY_0_VHOST': 'example.com',
-                'MARATHON_ACME_0_DOMAIN': 'example.com',
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
             },
             'portDefinitions': [
                 {'port': 9000, 'protocol': 'tcp', 'labels': {}}
             ]
-        })
+        }
+        assert_that(self.marathon_acme.sync_app(app), succeeded(HasLength(1)))
 
-        d = self.marathon_acme.sync()
-        assert_that(d, succeeded(Equals([])))
+        app['labels']['MARATHON_ACME_0_DOMAIN'] = 'example.com,example2.com'
+        assert_that(self.marathon_acme.sync_app(app), succeeded(HasLength(1)))
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': AfterPreprocessing(
+                cert_names, Equals(['example.com', 'example2.com']))
+        })))
+
+    def test_renewal_before_sync_keeps_names(self):
+        """
+        When a certificate with several names is renewed before the domains
+        for the apps are known, e.g. by the check when the service starts,
+        the renewed certificate should cover the same names as the stored
+        certificate.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com,example2.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        assert_that(self.marathon_acme.sync(), succeeded(HasLength(1)))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        stored = self.cert_store.as_dict().result['example.com']
+
+        # A new instance with nothing in the domain index yet
+        marathon_acme = MarathonAcme(
+            self.marathon_client, 'external', self.cert_store,
+            self.mlb_client, lambda: succeed(self.txacme_client), self.clock)
+
+        # The certificate is valid for 90 days: make it overdue for renewal
+        self.clock.advance(timedelta(days=80).total_seconds())
+        marathon_acme.txacme_service.startService()
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': MatchesAll(
+                Not(Equals(stored)),
+                AfterPreprocessing(
+                    cert_names, Equals(['example.com', 'example2.com'])))
+        })))
+
+        marathon_acme.txacme_service.stopService()
+
+    def test_sync_app_event_multiple_domains(self):
+        """
+        When an app with a domain label containing multiple domains is synced
+        from its app definition, a single certificate should be issued that
+        covers all the domains.
+        """
+        d = self.marathon_acme.sync_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com,example2.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        assert_that(d, succeeded(MatchesListwise([
+            is_marathon_lb_sigusr_response
+        ])))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': AfterPreprocessing(
+                cert_names, Equals(['example.com', 'example2.com']))
+        })))
+
+    def test_sync_no_apps(self):
+        """
+        When a sync is run and Marathon has no apps for us then no certificates
+        should be fetched and marathon-lb should not be notified.
+        """
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([])))
+
+        # Nothing stored, nothing notified, but Marathon checked
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(),
+                    Equals(False))
+
+    def test_sync_app_no_domains(self):
+        """
+        When a sync is run and Marathon has an app but that app has no
+        marathon-acme domains, then no certificates should be fetched and
+        marathon-lb should not be notified.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_0_VHOST': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([])))
+
+        # Nothing stored, nothing notified, but Marathon checked
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(),
+                    Equals(False))
+
+    def test_sync_app_group_mismatch(self):
+        """
+        When a sync is run and Marathon has an app but that app has a different
+        group to the one marathon-acme is configured with, then no certificates
+        should be fetched and marathon-lb should not be notified.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'internal',
+                'HAPROXY_0_VHOST': 'example.com',
+                'MARATHON_ACME_0_DOMAIN': 'example.com',
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([])))
 
         # Nothing stored, nothing notified, but Marathon checked
         assert_that(
@@ -600,6 +1035,58 @@ class TestMarathonAcme(object):
         assert_that(self.fake_marathon_lb.check_signalled_usr1(),
                     Equals(False))
 
+    def test_sync_app_label_selector(self):
+        """
+        When a sync is run with an app label selector, the selector should be
+        sent to Marathon and certificates should only be issued for the
+        domains of the apps that match it. Apps posted to the event stream
+        that don't match the selector should be ignored too.
+        """
+        marathon_acme = MarathonAcme(
+            self.marathon_client,
+            'external',
+            self.cert_store,
+            self.mlb_client,
+            lambda: succeed(self.txacme_client),
+            self.clock,
+            app_label_selector='MARATHON_ACME_0_DOMAIN'
+        )
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        other_app = {
+            'id': '/my-app_2',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_1_DOMAIN': 'example2.com'
+            },
+            'portDefinitions': [
+                {'port': 9001, 'protocol': 'tcp', 'labels': {}},
+                {'port': 9002, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        self.fake_marathon.add_app(other_app)
+
+        d = marathon_acme.sync()
+        assert_that(d, succeeded(MatchesListwise([
+            is_marathon_lb_sigusr_response
+        ])))
+        assert_that(self.fake_marathon_api.get_apps_args, Equals(
+            {b'label': [b'MARATHON_ACME_0_DOMAIN']}))
+
+        assert_that(marathon_acme.sync_app(other_app),
+                    succeeded(Is(None)))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
     def test_sync_app_existing_cert(self):
         """
         When a sync is run and Marathon has an app with a domain label but we
@@ -630,6 +1117,86 @@ class TestMarathonAcme(object):
         assert_that(self.fake_marathon_lb.check_signalled_usr1(),
                     Equals(False))
 
+    def test_renewal_joins_in_flight_issuance(self):
+        """
+        When the periodic check renews a certificate for a domain that is
+        already being issued, the renewal should go through the issuance
+        queue and join that issuance rather than order another certificate.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        assert_that(self.marathon_acme.sync(), succeeded(HasLength(1)))
+
+        # The certificate is valid for 90 days: make it overdue for renewal
+        self.clock.advance(timedelta(days=80).total_seconds())
+
+        issuing = []
+        request_issuance = self.txacme_client.request_issuance
+
+        def held_issuance(csr):
+            d = Deferred()
+            issuing.append(d)
+            return d.addCallback(lambda _: request_issuance(csr))
+        self.txacme_client.request_issuance = held_issuance
+
+        d = self.marathon_acme.issuance_queue.submit('example.com')
+        # Starting the txacme service runs the periodic check
+        self.marathon_acme.txacme_service.startService()
+
+        assert_that(issuing, HasLength(1))
+        assert_that(self.marathon_acme.issuance_queue.joined, Equals(1))
+
+        issuing.pop().callback(None)
+        assert_that(d, succeeded(is_marathon_lb_sigusr_response))
+        assert_that(issuing, HasLength(0))
+
+        self.marathon_acme.txacme_service.stopService()
+
+    def test_renewal_failure_panics(self):
+        """
+        When the periodic check renews a certificate that is overdue and the
+        ACME server returns an error, even one that a sync would only log, the
+        failure should be passed back to the check so that it panics.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        assert_that(self.marathon_acme.sync(), succeeded(HasLength(1)))
+
+        # The certificate is valid for 90 days: make it overdue for renewal
+        self.clock.advance(timedelta(days=80).total_seconds())
+        acme_error = acme_Error(
+            typ='urn:acme:error:unknownHost', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+
+        panics = []
+        txacme_service = self.marathon_acme.txacme_service
+        txacme_service._panic = (
+            lambda failure, server_name: panics.append(
+                (failure.value, server_name)))
+        txacme_service.startService()
+
+        assert_that(panics, MatchesListwise([MatchesListwise([
+            IsInstance(txacme_ServerError), Equals('example.com')])]))
+
+        txacme_service.stopService()
+
     def test_sync_failure(self):
         """
         When a sync is run and something fails, the failure is propagated to
@@ -672,6 +1239,127 @@ class TestMarathonAcme(object):
         assert_that(self.fake_marathon_lb.check_signalled_usr1(),
                     Equals(False))
 
+    def test_sync_acme_server_rate_limited_retried(self):
+        """
+        When a sync is run and the ACME server returns a rate-limit error with
+        a Retry-After header, the domain should be held and the certificate
+        issued once the retry time has passed.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        acme_error = acme_Error(typ='urn:acme:error:rateLimited', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, FakeResponse({b'Retry-After': [b'120']}))
+
+        d = self.marathon_acme.sync()
+
+        assert_that(d, succeeded(Equals([None])))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+        assert_that(self.marathon_acme.issuance_queue.held, Equals(1))
+
+        # The rate limit passes...
+        self.txacme_client.issuance_error = None
+        self.clock.advance(119)
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+        self.clock.advance(1)
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
+
+    def test_sync_acme_server_failure_backoff(self):
+        """
+        When a sync is run and issuing a certificate fails with an error for
+        the domain, the domain should not be retried by syncs until the
+        backoff time has passed, or its label changes.
+        """
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        self.fake_marathon.add_app(app)
+        acme_error = acme_Error(typ='urn:acme:error:unknownHost', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+
+        assert_that(self.marathon_acme.sync(), succeeded(Equals([None])))
+        assert_that(self.marathon_acme.failure_cache.get('example.com'),
+                    MatchesDict({
+                        'error': Equals('unknownHost'),
+                        'attempts': Equals(1),
+                        'retry_at': Equals(self.clock.seconds() + 60),
+                        'names': Equals(['example.com']),
+                    }))
+
+        # The next sync doesn't retry the domain
+        self.txacme_client.issuance_error = None
+        assert_that(self.marathon_acme.sync(), succeeded(Equals([])))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+        # Changing the label means the domain is retried
+        app['labels']['MARATHON_ACME_0_DOMAIN'] = 'example.com,example2.com'
+        assert_that(self.marathon_acme.sync(), succeeded(HasLength(1)))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        assert_that(self.marathon_acme.failure_cache.get('example.com'),
+                    Is(None))
+
+    def test_sync_acme_server_failure_not_rate_limited(self):
+        """
+        When a sync is run and issuing a certificate fails with an acceptable
+        ACME error, the failed order should not count towards the rate limit
+        for the domain.
+        """
+        self.marathon_acme.rate_limiter.domain_limit = 1
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        acme_error = acme_Error(typ='urn:acme:error:unknownHost', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+        assert_that(self.marathon_acme.sync(), succeeded(Equals([None])))
+
+        # Another domain under the same registered domain is issued at once
+        self.txacme_client.issuance_error = None
+        self.fake_marathon.add_app({
+            'id': '/my-app_2',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'www.example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        assert_that(self.marathon_acme.sync(), succeeded(HasLength(1)))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'www.example.com': Not(Is(None))
+        })))
+        assert_that(self.marathon_acme.issuance_queue.held, Equals(0))
+
     def test_sync_acme_server_failure_unacceptable(self):
         """
         When a sync is run and we try to issue a certificate for a domain but
@@ -746,3 +1434,285 @@ class TestMarathonAcme(object):
         assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
         assert_that(self.fake_marathon_lb.check_signalled_usr1(),
                     Equals(False))
+
+    def test_sync_unchanged_apps_skipped(self):
+        """
+        When a sync is run and the apps haven't changed since the last sync,
+        which had no certificates left to issue, the rest of the sync should
+        be skipped.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(HasLength(1)))
+        # The certificate has been issued now
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([])))
+        assert_that(self.marathon_acme.syncs_skipped, Equals(0))
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([])))
+        assert_that(self.marathon_acme.syncs_skipped, Equals(1))
+        assert_that(self.marathon_client.apps_fingerprint_hits, Equals(2))
+        assert_that(self.marathon_client.apps_fingerprint_misses, Equals(1))
+
+        # Changed apps aren't skipped
+        self.fake_marathon.add_app({
+            'id': '/my-app_2',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example2.com'
+            },
+            'portDefinitions': [
+                {'port': 9001, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(HasLength(1)))
+        assert_that(self.marathon_acme.syncs_skipped, Equals(1))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None)),
+            'example2.com': Not(Is(None)),
+        })))
+
+    def test_sync_unchanged_apps_etag(self):
+        """
+        When a sync is run and Marathon supports ETags for the apps, the ETag
+        from the last sync should be sent and the sync skipped if the apps
+        haven't changed.
+        """
+        self.fake_marathon_api.send_etags = True
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(HasLength(1)))
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([])))
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([])))
+        assert_that(self.marathon_acme.syncs_skipped, Equals(1))
+        assert_that(self.fake_marathon_api.check_called_get_apps(),
+                    Equals(True))
+        assert_that(self.marathon_client.apps_fingerprint_hits, Equals(2))
+
+    def test_sync_unchanged_apps_issue_failed(self):
+        """
+        When a sync is run and the apps haven't changed since the last sync,
+        but the last sync failed to issue a certificate, the sync should not
+        be skipped so that the certificate is issued.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        acme_error = acme_Error(
+            typ='urn:acme:error:serverInternal', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([None])))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+        self.txacme_client.issuance_error = None
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(HasLength(1)))
+        assert_that(self.marathon_acme.syncs_skipped, Equals(0))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+
+class TestMarathonAcmeMultipleGroups(object):
+    def setup_method(self):
+        self.fake_marathon = FakeMarathon()
+        self.fake_marathon_api = FakeMarathonAPI(self.fake_marathon)
+        marathon_client = MarathonClient(
+            ['http://localhost:8080'], client=self.fake_marathon_api.client)
+
+        self.cert_stores = {
+            'external': MemoryStore(),
+            'internal': MemoryStore(),
+        }
+
+        self.fake_marathon_lbs = {
+            'external': FakeMarathonLb(),
+            'internal': FakeMarathonLb(),
+        }
+        mlb_clients = dict(
+            (group, MarathonLbClient(['http://localhost:9090'],
+                                     client=fake_marathon_lb.client))
+            for group, fake_marathon_lb in self.fake_marathon_lbs.items())
+
+        key = JWKRSA(key=generate_private_key(u'rsa'))
+        clock = Clock()
+        clock.rightNow = (
+            datetime.now() - datetime(1970, 1, 1)).total_seconds()
+        self.txacme_client = FailableTxacmeClient(key, clock)
+
+        self.marathon_acme = MarathonAcme(
+            marathon_client,
+            ['external', 'internal'],
+            self.cert_stores,
+            mlb_clients,
+            lambda: succeed(self.txacme_client),
+            clock
+        )
+
+    def test_sync_apps_routed_by_group(self):
+        """
+        When a sync is run with multiple groups, certificates for the domains
+        of each group's apps should be stored in that group's certificate
+        store, and only that group's marathon-lb instances notified.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        self.fake_marathon.add_app({
+            'id': '/my-app_2',
+            'labels': {
+                'HAPROXY_GROUP': 'internal',
+                'MARATHON_ACME_0_DOMAIN': 'internal.example.com'
+            },
+            'portDefinitions': [
+                {'port': 9001, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(HasLength(2)))
+
+        assert_that(self.cert_stores['external'].as_dict(),
+                    succeeded(MatchesDict({'example.com': Not(Is(None))})))
+        assert_that(self.cert_stores['internal'].as_dict(), succeeded(
+            MatchesDict({'internal.example.com': Not(Is(None))})))
+
+        assert_that(
+            self.fake_marathon_lbs['external'].check_signalled_usr1(),
+            Equals(True))
+        assert_that(
+            self.fake_marathon_lbs['internal'].check_signalled_usr1(),
+            Equals(True))
+
+    def test_sync_app_port_groups(self):
+        """
+        When a sync is run with multiple groups and an app has ports in
+        different groups, the certificate for each port should be stored in
+        the store for the port's group.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'HAPROXY_1_GROUP': 'internal',
+                'MARATHON_ACME_0_DOMAIN': 'example.com',
+                'MARATHON_ACME_1_DOMAIN': 'internal.example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}},
+                {'port': 9001, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(HasLength(2)))
+
+        assert_that(self.cert_stores['external'].as_dict(),
+                    succeeded(MatchesDict({'example.com': Not(Is(None))})))
+        assert_that(self.cert_stores['internal'].as_dict(), succeeded(
+            MatchesDict({'internal.example.com': Not(Is(None))})))
+
+    def test_sync_domain_in_multiple_groups(self):
+        """
+        When a sync is run with multiple groups and a domain is served by
+        apps in more than one group, a single certificate should be issued
+        and stored in the store for each group.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        self.fake_marathon.add_app({
+            'id': '/my-app_2',
+            'labels': {
+                'HAPROXY_GROUP': 'internal',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9001, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(HasLength(1)))
+
+        external_certs = self.cert_stores['external'].as_dict()
+        internal_certs = self.cert_stores['internal'].as_dict()
+        assert_that(external_certs,
+                    succeeded(MatchesDict({'example.com': Not(Is(None))})))
+        assert_that(internal_certs, succeeded(
+            Equals(external_certs.result)))
+
+        assert_that(self.marathon_acme.issuance_queue.started, Equals(1))
+        for fake_marathon_lb in self.fake_marathon_lbs.values():
+            assert_that(fake_marathon_lb.check_signalled_usr1(), Equals(True))
+
+    def test_sync_group_ignored(self):
+        """
+        When a sync is run with multiple groups and an app is in a group that
+        isn't one of them, no certificate should be issued for its domains.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'other',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        d = self.marathon_acme.sync()
+        assert_that(d, succeeded(Equals([])))
+
+        for cert_store in self.cert_stores.values():
+            assert_that(cert_store.as_dict(), succeeded(Equals({})))
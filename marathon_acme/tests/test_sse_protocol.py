@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 from testtools.assertions import assert_that
-from testtools.matchers import Equals, Is
+from testtools.matchers import Equals, HasLength, Is
 from testtools.twistedsupport import succeeded
+from twisted.internet.task import Clock
 
 from marathon_acme.sse_protocol import SseProtocol
 
 
 class DummyTransport(object):
     disconnecting = False
+    paused = False
 
     def loseConnection(self):
         self.disconnecting = True
 
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
 
 class TestSseProtocol(object):
     def setup_method(self):
@@ -114,24 +122,96 @@ class TestSseProtocol(object):
             ('test2', 'world')
         ]))
 
-    def test_id_ignored(self):
+    def test_id_not_in_data(self):
         """
-        When the id field is included in an event, it should be ignored.
+        When the id field is included in an event, it should not be included
+        in the data received by the handler.
         """
         self.protocol.dataReceived(b'data:hello\r\n')
         self.protocol.dataReceived(b'id:123\r\n\r\n')
 
         assert_that(self.messages, Equals([('message', 'hello')]))
 
-    def test_retry_ignored(self):
+    def test_retry_not_in_data(self):
         """
-        When the retry field is included in an event, it should be ignored.
+        When the retry field is included in an event, it should not be
+        included in the data received by the handler.
         """
         self.protocol.dataReceived(b'data:hello\r\n')
         self.protocol.dataReceived(b'retry:123\r\n\r\n')
 
         assert_that(self.messages, Equals([('message', 'hello')]))
 
+    def test_last_event_id(self):
+        """
+        When an event with an id field is dispatched, the last event ID should
+        be set to the value of the field. The last event ID should not change
+        until the event is dispatched.
+        """
+        assert_that(self.protocol.last_event_id, Is(None))
+
+        self.protocol.dataReceived(b'id:123\r\ndata:hello\r\n')
+        assert_that(self.protocol.last_event_id, Is(None))
+
+        self.protocol.dataReceived(b'\r\n')
+        assert_that(self.protocol.last_event_id, Equals('123'))
+
+    def test_last_event_id_persists(self):
+        """
+        When an event is dispatched without an id field, the last event ID
+        should be the ID of the previous event.
+        """
+        self.protocol.dataReceived(b'id:123\r\ndata:hello\r\n\r\n')
+        self.protocol.dataReceived(b'data:world\r\n\r\n')
+
+        assert_that(self.protocol.last_event_id, Equals('123'))
+
+    def test_last_event_id_null_ignored(self):
+        """
+        When an id field is received with a value containing a NULL
+        character, the field should be ignored.
+        """
+        self.protocol.dataReceived(b'id:123\r\ndata:hello\r\n\r\n')
+        self.protocol.dataReceived(b'id:4\x0056\r\ndata:world\r\n\r\n')
+
+        assert_that(self.protocol.last_event_id, Equals('123'))
+
+    def test_last_event_id_initial(self):
+        """
+        When the protocol is created with a last event ID, that ID should be
+        the last event ID until an event with a different ID is dispatched.
+        """
+        protocol = SseProtocol(lambda event, data: None, last_event_id='122')
+        protocol.transport = self.transport
+        assert_that(protocol.last_event_id, Equals('122'))
+
+        protocol.dataReceived(b'data:hello\r\n\r\n')
+        assert_that(protocol.last_event_id, Equals('122'))
+
+        protocol.dataReceived(b'id:123\r\ndata:hello\r\n\r\n')
+        assert_that(protocol.last_event_id, Equals('123'))
+
+    def test_reconnection_time(self):
+        """
+        When a retry field is received with an integer value, the reconnection
+        time should be set to that value.
+        """
+        assert_that(self.protocol.reconnection_time, Is(None))
+
+        self.protocol.dataReceived(b'retry:5000\r\n')
+
+        assert_that(self.protocol.reconnection_time, Equals(5000))
+
+    def test_reconnection_time_invalid(self):
+        """
+        When a retry field is received with a value that isn't made up of only
+        ASCII digits, the field should be ignored.
+        """
+        self.protocol.dataReceived(b'retry:5000\r\n')
+        self.protocol.dataReceived(b'retry:-1\r\nretry:1.5\r\nretry:\r\n')
+
+        assert_that(self.protocol.reconnection_time, Equals(5000))
+
     def test_unknown_field_ignored(self):
         """
         When an unknown field is included in an event, it should be ignored.
@@ -184,6 +264,50 @@ class TestSseProtocol(object):
 
         assert_that(self.messages, Equals([('message', 'hello')]))
 
+    def test_line_ending_split_across_parts(self):
+        """
+        When a '\r\n' line ending is split across two parts of data, only a
+        single line ending should be seen and no empty line should be received
+        that would dispatch the event early.
+        """
+        self.protocol.dataReceived(b'data:hello\r')
+        self.protocol.dataReceived(b'\ndata:world\r')
+        self.protocol.dataReceived(b'\n')
+
+        assert_that(self.messages, Equals([]))
+
+        self.protocol.dataReceived(b'\r\n')
+
+        assert_that(self.messages, Equals([('message', 'hello\nworld')]))
+
+    def test_long_line_in_many_parts(self):
+        """
+        When a single line is received in many small parts, the parts should
+        be joined to form the complete line.
+        """
+        value = b'x' * 1000
+        data = b'data:%s\r\n\r\n' % (value,)
+        for i in range(0, len(data), 7):
+            self.protocol.dataReceived(data[i:i + 7])
+
+        assert_that(self.messages, Equals([
+            ('message', value.decode('utf-8'))]))
+
+    def test_multiple_lines_one_part(self):
+        """
+        When a part of data contains the end of one line, complete lines, and
+        the start of another line, each line should be received in order.
+        """
+        self.protocol.dataReceived(b'event:my_event\r\ndata:he')
+        self.protocol.dataReceived(b'llo\r\n\r\ndata:world\n\nda')
+        self.protocol.dataReceived(b'ta:!\r\r')
+
+        assert_that(self.messages, Equals([
+            ('my_event', 'hello'),
+            ('message', 'world'),
+            ('message', '!'),
+        ]))
+
     def test_unicode_data(self):
         """
         When unicode data encoded as UTF-8 is received, the characters should
@@ -200,7 +324,7 @@ class TestSseProtocol(object):
         lose the connection.
         """
         self.protocol.MAX_LENGTH = 8  # Very long bytearrays slow down tests
-        self.protocol.dataReceived(b'data:%s\r\n\r\n' % (
+        self.protocol.dataReceived(b'event:%s\r\n\r\n' % (
             b'x' * (self.protocol.MAX_LENGTH + 1),))
 
         assert_that(self.transport.disconnecting, Equals(True))
@@ -212,11 +336,88 @@ class TestSseProtocol(object):
         request to lose the connection.
         """
         self.protocol.MAX_LENGTH = 8  # Very long bytearrays slow down tests
-        self.protocol.dataReceived(b'data:%s' % (
+        self.protocol.dataReceived(b'event:%s' % (
             b'x' * (self.protocol.MAX_LENGTH + 1),))
 
         assert_that(self.transport.disconnecting, Equals(True))
 
+    def test_event_too_large(self):
+        """
+        When the data lines for an event add up to more than the maximum event
+        size, the event should be skipped and counted, and the connection
+        should be kept open for the following events.
+        """
+        self.protocol.max_event_size = 16
+        self.protocol.dataReceived(b'data:hello\r\ndata:world\r\n\r\n')
+        self.protocol.dataReceived(b'data:small\r\n\r\n')
+
+        assert_that(self.messages, Equals([('message', 'small')]))
+        assert_that(self.protocol.skipped_events, Equals(1))
+        assert_that(self.protocol.discarded_events, Equals(0))
+        assert_that(self.transport.disconnecting, Equals(False))
+
+    def test_event_too_large_not_buffered(self):
+        """
+        When an incomplete data line takes an event over the maximum event
+        size, the event should be skipped and the rest of the line should not
+        be buffered as it is received.
+        """
+        self.protocol.max_event_size = 16
+        self.protocol.dataReceived(b'id:1\r\ndata:%s' % (b'x' * 16,))
+        for _ in range(10):
+            self.protocol.dataReceived(b'x' * 1024)
+            assert_that(len(self.protocol._buffer), Equals(0))
+        self.protocol.dataReceived(b'x\r')
+        self.protocol.dataReceived(b'\ndata:more\r\n\r\ndata:small\r\n\r\n')
+
+        assert_that(self.messages, Equals([('message', 'small')]))
+        assert_that(self.protocol.skipped_events, Equals(1))
+        assert_that(self.protocol.last_event_id, Equals('1'))
+
+    def test_data_line_longer_than_max_length(self):
+        """
+        When a data line is longer than the maximum line length but within
+        the maximum event size, it should be received.
+        """
+        self.protocol.MAX_LENGTH = 8
+        self.protocol.dataReceived(b'data:hello world\r\n\r\n')
+
+        assert_that(self.messages, Equals([('message', 'hello world')]))
+        assert_that(self.transport.disconnecting, Equals(False))
+
+    def test_recorder(self):
+        """
+        When a recorder is set, it should receive each chunk of raw bytes
+        exactly as it was received.
+        """
+        recorded = []
+        protocol = SseProtocol(
+            lambda event, data: None, recorder=recorded.append)
+        protocol.transport = self.transport
+
+        protocol.dataReceived(b'data:hel')
+        protocol.dataReceived(b'lo\r\n\r\n')
+
+        assert_that(recorded, Equals([b'data:hel', b'lo\r\n\r\n']))
+
+    def test_data_not_decoded(self):
+        """
+        When the protocol is created with ``decode_data=False``, the handler
+        should receive the joined data lines as bytes.
+        """
+        messages = []
+        protocol = SseProtocol(
+            lambda event, data: messages.append((event, data)),
+            decode_data=False)
+        protocol.transport = self.transport
+
+        protocol.dataReceived(
+            u'event:status\r\ndata:hello\r\ndata:w\u00f6rld\r\n\r\n'.encode(
+                'utf-8'))
+
+        assert_that(messages, Equals(
+            [('status', u'hello\nw\u00f6rld'.encode('utf-8'))]))
+
     def test_transport_disconnecting(self):
         """
         When the transport for the protocol is disconnecting, processing should
@@ -263,3 +464,211 @@ class TestSseProtocol(object):
             ('status', 'hello'),
             ('message', 'world')
         ]))
+
+
+class TestSseProtocolEventTypes(object):
+    def setup_method(self):
+        self.messages = []
+
+        def append_message(event, data):
+            self.messages.append((event, data))
+        self.protocol = SseProtocol(
+            append_message, event_types=['wanted', 'also_wanted'])
+
+        self.transport = DummyTransport()
+        self.protocol.transport = self.transport
+
+    def test_wanted_events(self):
+        """
+        When events are received with types that are in the set of event
+        types, the handler should receive those events.
+        """
+        self.protocol.dataReceived(b'event:wanted\r\ndata:hello\r\n\r\n')
+        self.protocol.dataReceived(
+            b'event:also_wanted\r\ndata:world\r\n\r\n')
+
+        assert_that(self.messages, Equals([
+            ('wanted', 'hello'),
+            ('also_wanted', 'world'),
+        ]))
+
+    def test_unwanted_event(self):
+        """
+        When an event is received with a type that isn't in the set of event
+        types, the handler should not receive the event and the event's data
+        should not be decoded.
+        """
+        self.protocol.dataReceived(b'event:unwanted\r\ndata:\xff\r\n\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:hello\r\n\r\n')
+
+        assert_that(self.messages, Equals([('wanted', 'hello')]))
+
+    def test_unwanted_event_data_before_type(self):
+        """
+        When an event is received with a type that isn't in the set of event
+        types, and the data is received before the event type, the data should
+        be discarded and not received by the handler with the next event.
+        """
+        self.protocol.dataReceived(b'data:hello\r\nevent:unwanted\r\n\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:world\r\n\r\n')
+
+        assert_that(self.messages, Equals([('wanted', 'world')]))
+
+    def test_unwanted_event_type_changed(self):
+        """
+        When an event's type is set to one that isn't in the set of event types
+        and data is discarded, but then the type is set to one that is wanted,
+        the event should still be discarded as some of the data is missing.
+        """
+        self.protocol.dataReceived(b'event:unwanted\r\ndata:hello\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:world\r\n\r\n')
+
+        assert_that(self.messages, Equals([]))
+
+    def test_default_event_unwanted(self):
+        """
+        When an event is received without a type and the default type isn't in
+        the set of event types, the handler should not receive the event.
+        """
+        self.protocol.dataReceived(b'data:hello\r\n\r\n')
+
+        assert_that(self.messages, Equals([]))
+
+    def test_unwanted_event_data_not_buffered(self):
+        """
+        When part of a data line is received for an unwanted event, it should
+        not be buffered.
+        """
+        self.protocol.dataReceived(b'event:unwanted\r\ndata:hello')
+        assert_that(len(self.protocol._buffer), Equals(0))
+
+        self.protocol.dataReceived(
+            b' world\r\n\r\nevent:wanted\r\ndata:hi\n\n')
+        assert_that(self.messages, Equals([('wanted', 'hi')]))
+
+    def test_discarded_events_counted(self):
+        """
+        When events are discarded because of their type, the number of events
+        discarded should be counted. Blank lines without an event type or data
+        should not be counted.
+        """
+        self.protocol.dataReceived(b'event:unwanted\r\ndata:hello\r\n\r\n')
+        self.protocol.dataReceived(b'data:hello\r\n\r\n')
+        self.protocol.dataReceived(b'\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:hello\r\n\r\n')
+
+        assert_that(self.protocol.discarded_events, Equals(2))
+
+    def test_discarded_event_reported(self):
+        """
+        When an event is discarded because of its type, the discarded handler
+        should be called with the event type.
+        """
+        discarded = []
+        self.protocol._discarded_handler = discarded.append
+        self.protocol.dataReceived(b'event:unwanted\r\ndata:hello\r\n\r\n')
+        self.protocol.dataReceived(b'\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:hello\r\n\r\n')
+
+        assert_that(discarded, Equals(['unwanted']))
+
+    def test_skipped_wanted_event_reported(self):
+        """
+        When an event of a wanted type is skipped because it is too large, the
+        skipped handler should be called with the event type, even if the type
+        is only received after the data.
+        """
+        skipped = []
+        self.protocol._skipped_handler = skipped.append
+        self.protocol.max_event_size = 16
+        self.protocol.dataReceived(
+            b'data:hello\r\ndata:world\r\nevent:wanted\r\n\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:small\r\n\r\n')
+
+        assert_that(skipped, Equals(['wanted']))
+        assert_that(self.messages, Equals([('wanted', 'small')]))
+
+    def test_skipped_unwanted_event_not_reported(self):
+        """
+        When an event of a type that isn't wanted is too large, the skipped
+        handler should not be called.
+        """
+        skipped = []
+        self.protocol._skipped_handler = skipped.append
+        self.protocol.max_event_size = 16
+        self.protocol.dataReceived(
+            b'data:hello\r\ndata:world\r\nevent:unwanted\r\n\r\n')
+        self.protocol.dataReceived(b'data:hello world, again\r\n\r\n')
+
+        assert_that(skipped, Equals([]))
+        assert_that(self.protocol.skipped_events, Equals(2))
+
+
+class TestSseProtocolTimeout(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.protocol = SseProtocol(
+            lambda event, data: None, timeout=10, reactor=self.clock)
+
+        self.transport = DummyTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_idle_timeout(self):
+        """
+        When no data is received for the timeout period, the connection should
+        be closed.
+        """
+        self.clock.advance(9.9)
+        assert_that(self.transport.disconnecting, Equals(False))
+
+        self.clock.advance(0.1)
+        assert_that(self.transport.disconnecting, Equals(True))
+
+    def test_data_resets_timeout(self):
+        """
+        When any data is received, including comment lines and incomplete
+        lines, the timeout should be reset.
+        """
+        self.clock.advance(9)
+        self.protocol.dataReceived(b':keepalive\n')
+        self.clock.advance(9)
+        self.protocol.dataReceived(b'da')
+        self.clock.advance(9)
+        assert_that(self.transport.disconnecting, Equals(False))
+
+        self.clock.advance(1)
+        assert_that(self.transport.disconnecting, Equals(True))
+
+    def test_paused_no_timeout(self):
+        """
+        When the protocol is paused, the transport should be paused and the
+        timeout suspended. When the protocol is resumed, the transport should
+        be resumed and the timeout restarted.
+        """
+        self.protocol.pauseProducing()
+        assert_that(self.transport.paused, Equals(True))
+        self.clock.advance(20)
+        assert_that(self.transport.disconnecting, Equals(False))
+
+        self.protocol.resumeProducing()
+        assert_that(self.transport.paused, Equals(False))
+        self.clock.advance(10)
+        assert_that(self.transport.disconnecting, Equals(True))
+
+    def test_connection_lost_cancels_timeout(self):
+        """
+        When the connection is lost, the timeout should be cancelled.
+        """
+        self.protocol.connectionLost()
+
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+
+    def test_no_timeout(self):
+        """
+        When no timeout is set, the connection should never be closed for
+        being idle.
+        """
+        protocol = SseProtocol(lambda event, data: None, reactor=self.clock)
+        protocol.makeConnection(DummyTransport())
+
+        assert_that(self.clock.getDelayedCalls(), HasLength(1))
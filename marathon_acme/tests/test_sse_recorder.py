@@ -0,0 +1,64 @@
+import pytest
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is
+
+from marathon_acme.sse_recorder import split_connections, SseRecorder
+
+
+class TestSseRecorder(object):
+    @pytest.fixture(autouse=True)
+    def setup_recorder(self, tmpdir):
+        self.path = str(tmpdir.join('events.sse'))
+        self.recorder = SseRecorder(self.path)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_connections_split(self):
+        """
+        When several connections are recorded, and one of them is cut off part
+        way through an event, the recording should be split into the bytes
+        received on each connection.
+        """
+        self.recorder.start_connection()
+        self.recorder.write(b'event: test\r\ndata: {"a":')
+        self.recorder.start_connection()
+        self.recorder.write(b'event: test\r\n')
+        self.recorder.write(b'data: {}\r\n\r\n')
+        self.recorder.close()
+
+        assert_that(split_connections(self.read()), Equals([
+            b'event: test\r\ndata: {"a":',
+            b'event: test\r\ndata: {}\r\n\r\n',
+        ]))
+
+    def test_appends(self):
+        """
+        When a recording is made to a file that already has a recording, the
+        new recording should be appended as a new connection.
+        """
+        self.recorder.start_connection()
+        self.recorder.write(b'data: 1\r\n\r\n')
+        self.recorder.close()
+
+        recorder = SseRecorder(self.path)
+        recorder.start_connection()
+        recorder.write(b'data: 2\r\n\r\n')
+        recorder.close()
+
+        assert_that(split_connections(self.read()), Equals([
+            b'data: 1\r\n\r\n', b'data: 2\r\n\r\n']))
+
+    def test_close(self):
+        """
+        When the recorder is closed, the file should be closed. Closing it
+        again should do nothing.
+        """
+        self.recorder.start_connection()
+        f = self.recorder._file
+        self.recorder.close()
+        self.recorder.close()
+
+        assert_that(f.closed, Equals(True))
+        assert_that(self.recorder._file, Is(None))
@@ -0,0 +1,103 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, HasLength
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+
+from marathon_acme.sync_scheduler import SyncScheduler
+
+
+class TestSyncScheduler(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.syncs = []
+
+        def sync():
+            d = Deferred()
+            self.syncs.append(d)
+            return d
+        self.scheduler = SyncScheduler(sync, self.clock)
+
+    def test_trigger_syncs(self):
+        """
+        When a sync is triggered and no sync is running, a sync should be
+        started immediately.
+        """
+        self.scheduler.trigger()
+
+        assert_that(self.syncs, HasLength(1))
+        assert_that(self.scheduler.syncs, Equals(1))
+
+    def test_single_flight(self):
+        """
+        When syncs are triggered while a sync is running, only a single sync
+        should be run after the running sync completes.
+        """
+        self.scheduler.trigger()
+        self.scheduler.trigger()
+        self.scheduler.trigger()
+        self.scheduler.trigger()
+        assert_that(self.syncs, HasLength(1))
+
+        self.syncs[0].callback(None)
+        assert_that(self.syncs, HasLength(2))
+
+        self.syncs[1].callback(None)
+        assert_that(self.syncs, HasLength(2))
+        assert_that(self.scheduler.triggers, Equals(4))
+        assert_that(self.scheduler.coalesced, Equals(2))
+
+    def test_sync_failure(self):
+        """
+        When a sync fails, the next sync should still be run.
+        """
+        self.scheduler = SyncScheduler(
+            lambda: fail(RuntimeError('Oops')), self.clock)
+        self.scheduler.trigger()
+        self.scheduler.trigger()
+
+        assert_that(self.scheduler.syncs, Equals(2))
+
+    def test_debounce(self):
+        """
+        When a debounce time is set, a sync should only be started once that
+        time has passed after the first trigger, and triggers within that time
+        should be coalesced.
+        """
+        self.scheduler.debounce = 1.0
+        self.scheduler.trigger()
+        self.clock.advance(0.5)
+        self.scheduler.trigger()
+        assert_that(self.syncs, HasLength(0))
+
+        self.clock.advance(0.5)
+        assert_that(self.syncs, HasLength(1))
+        assert_that(self.scheduler.coalesced, Equals(1))
+
+    def test_debounce_trailing_sync(self):
+        """
+        When a debounce time is set and a sync is triggered while a sync is
+        running, the trailing sync should also wait for the debounce time.
+        """
+        self.scheduler.debounce = 1.0
+        self.scheduler.trigger()
+        self.clock.advance(1.0)
+        self.scheduler.trigger()
+
+        self.syncs[0].callback(None)
+        assert_that(self.syncs, HasLength(1))
+
+        self.clock.advance(1.0)
+        assert_that(self.syncs, HasLength(2))
+
+    def test_stop(self):
+        """
+        When the scheduler is stopped, syncs waiting to start should be
+        cancelled.
+        """
+        self.scheduler.debounce = 1.0
+        self.scheduler.trigger()
+        self.scheduler.stop()
+
+        assert_that(self.clock.getDelayedCalls(), Equals([]))
+        self.clock.advance(1.0)
+        assert_that(self.syncs, HasLength(0))
@@ -25,6 +25,7 @@ install_requires = [
     'acme',
     'cryptography',
     'klein == 15.3.1',
+    'pem',
     'requests',
     'treq',
     # Twisted 17.1.0 causes problems with treq.testing